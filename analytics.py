@@ -0,0 +1,209 @@
+import numpy as np
+
+SIDES = ("bid", "ask")
+
+
+class BookAnalytics:
+    """
+    Vectorized analytics of an OrderBook
+
+    The aggregated price levels of each side are mirrored into NumPy arrays of float prices and
+    sizes, sorted by ascending price, and kept up to date by an OrderBook level listener, so a
+    query never rebuilds them from the book. Every metric takes an array of sizes or thresholds
+    and computes all of them in one vectorized pass.
+
+    """
+
+    def __init__(self, order_book, capacity=1024):
+        """
+        initialize analytics, and attach them to the order book
+
+        :param order_book: OrderBook
+        :param capacity: initial number of price levels per side, the arrays grow as needed
+
+        """
+        self.order_book = order_book
+        self._price_scale = order_book.price_scale.scale if order_book.price_scale else None
+        self._size_scale = order_book.size_scale.scale if order_book.size_scale else None
+        self._prices = {side: np.empty(capacity) for side in SIDES}
+        self._sizes = {side: np.empty(capacity) for side in SIDES}
+        self._count = {side: 0 for side in SIDES}
+        # cumulative sizes and notionals from the best price, None once the side changed
+        self._cumulative = {side: None for side in SIDES}
+
+        for side in SIDES:
+            for price, size in order_book.iter_levels(side):
+                self._on_level(side, price, size)
+        order_book.add_level_listener(self._on_level)
+
+    def close(self):
+        """detach from the order book"""
+        self.order_book.remove_level_listener(self._on_level)
+
+    def _on_level(self, side, price, size):
+        """
+        level listener, update the arrays of one side
+
+        :param side: "bid" or "ask"
+        :param price: price level, as stored in the order book
+        :param size: aggregate size of the price level, 0 if it was removed
+
+        """
+        price = price / self._price_scale if self._price_scale else float(price)
+        size = size / self._size_scale if self._size_scale else float(size)
+        prices, sizes, count = self._prices[side], self._sizes[side], self._count[side]
+        self._cumulative[side] = None
+
+        i = int(np.searchsorted(prices[:count], price))
+        if i < count and prices[i] == price:
+            if size:
+                sizes[i] = size
+            else:
+                prices[i:count - 1] = prices[i + 1:count]
+                sizes[i:count - 1] = sizes[i + 1:count]
+                self._count[side] = count - 1
+            return
+        if not size:
+            return
+
+        if count == len(prices):
+            prices = self._prices[side] = np.concatenate((prices, np.empty(len(prices))))
+            sizes = self._sizes[side] = np.concatenate((sizes, np.empty(len(sizes))))
+        prices[i + 1:count + 1] = prices[i:count]
+        sizes[i + 1:count + 1] = sizes[i:count]
+        prices[i] = price
+        sizes[i] = size
+        self._count[side] = count + 1
+
+    def levels(self, side="bid"):
+        """
+        aggregated price levels of one side, views on the arrays, invalidated by the next update
+
+        :param side: "bid" or "ask", default "bid"
+        :return: tuple of (prices, sizes) arrays, best price first
+
+        """
+        count = self._count[side]
+        prices, sizes = self._prices[side][:count], self._sizes[side][:count]
+        if side == "bid":
+            return prices[::-1], sizes[::-1]
+        return prices, sizes
+
+    def _cumulative_levels(self, side):
+        """
+        :param side: "bid" or "ask"
+        :return: tuple of (prices, cumulative sizes, cumulative notionals) arrays, best price first
+
+        """
+        if self._cumulative[side] is None:
+            prices, sizes = self.levels(side)
+            self._cumulative[side] = (prices, np.cumsum(sizes), np.cumsum(prices * sizes))
+        return self._cumulative[side]
+
+    def mid_price(self):
+        """:return: mid price, None if either side is empty"""
+        if not self._count["bid"] or not self._count["ask"]:
+            return None
+        return (self._prices["bid"][self._count["bid"] - 1] + self._prices["ask"][0]) / 2
+
+    def microprice(self):
+        """
+        mid price weighted by the size on the other side of the best levels
+
+        :return: microprice, None if either side is empty
+
+        """
+        if not self._count["bid"] or not self._count["ask"]:
+            return None
+        bid_price, bid_size = self._prices["bid"][self._count["bid"] - 1], self._sizes["bid"][self._count["bid"] - 1]
+        ask_price, ask_size = self._prices["ask"][0], self._sizes["ask"][0]
+        return (bid_price * ask_size + ask_price * bid_size) / (bid_size + ask_size)
+
+    def depth_within(self, bps, reference=None):
+        """
+        cumulative size of each side within thresholds of the reference price
+
+        :param bps: array-like of thresholds in basis points
+        :param reference: reference price, default the mid price
+        :return: dict of side -> array of cumulative sizes, one per threshold
+
+        """
+        bps = np.asarray(bps, dtype=float)
+        reference = self.mid_price() if reference is None else reference
+        if reference is None:
+            return {side: np.zeros(bps.shape) for side in SIDES}
+        depth = {}
+        for side in SIDES:
+            prices, cumulative_sizes, _ = self._cumulative_levels(side)
+            if not len(prices):
+                depth[side] = np.zeros(bps.shape)
+                continue
+            if side == "bid":
+                # prices are descending, count the levels at or above the limit
+                limits = reference * (1 - bps / 10000)
+                counts = len(prices) - np.searchsorted(prices[::-1], limits, side="left")
+            else:
+                limits = reference * (1 + bps / 10000)
+                counts = np.searchsorted(prices, limits, side="right")
+            depth[side] = np.where(counts > 0, cumulative_sizes[np.maximum(counts - 1, 0)], 0.0)
+        return depth
+
+    def imbalance(self, levels=(1,)):
+        """
+        order book imbalance over the best levels, (bid size - ask size) / (bid size + ask size)
+
+        :param levels: array-like of numbers of best price levels per side
+        :return: array of imbalances in [-1, 1], one per number of levels, nan if both sides are empty
+
+        """
+        levels = np.asarray(levels, dtype=int)
+        totals = {}
+        for side in SIDES:
+            _, cumulative_sizes, _ = self._cumulative_levels(side)
+            if not len(cumulative_sizes):
+                totals[side] = np.zeros(levels.shape)
+            else:
+                totals[side] = cumulative_sizes[np.clip(levels, 1, len(cumulative_sizes)) - 1]
+        total = totals["bid"] + totals["ask"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (totals["bid"] - totals["ask"]) / total
+
+    def vwap(self, sizes, side="ask"):
+        """
+        volume weighted average price of market orders walking one side of the book
+
+        :param sizes: array-like of order sizes
+        :param side: side of the book consumed, "ask" to buy or "bid" to sell, default "ask"
+        :return: array of average fill prices, one per size, nan when the side is not deep enough
+
+        """
+        sizes = np.asarray(sizes, dtype=float)
+        prices, cumulative_sizes, cumulative_notionals = self._cumulative_levels(side)
+        if not len(prices):
+            return np.full(sizes.shape, np.nan)
+        # level completing each fill, and the size and notional of the levels before it
+        index = np.searchsorted(cumulative_sizes, sizes, side="left")
+        filled = index < len(prices)
+        index = np.minimum(index, len(prices) - 1)
+        size_before = np.where(index > 0, cumulative_sizes[index - 1], 0.0)
+        notional_before = np.where(index > 0, cumulative_notionals[index - 1], 0.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            average = (notional_before + (sizes - size_before) * prices[index]) / sizes
+        return np.where(filled, average, np.nan)
+
+    def slippage(self, sizes, side="ask"):
+        """
+        expected cost of market orders against the mid price, in basis points
+
+        :param sizes: array-like of order sizes
+        :param side: side of the book consumed, "ask" to buy or "bid" to sell, default "ask"
+        :return: array of slippages in bps, positive when the fill is worse than the mid price,
+                 nan when the side is not deep enough or the book is one-sided
+
+        """
+        mid = self.mid_price()
+        average = self.vwap(sizes, side)
+        if mid is None:
+            return np.full(average.shape, np.nan)
+        sign = 1 if side == "ask" else -1
+        return sign * (average - mid) / mid * 10000
@@ -0,0 +1,234 @@
+import time
+import asyncio
+import logging
+
+import websockets
+
+from coinbase_websocket_client import CoinbaseWebsocketClient
+from message_decoder import decode_message
+
+
+class BookUpdates:
+    """
+    Async iterator of order book updates
+
+    Each update is a dict with "product_id", "sequence", and the "bid" and "ask" lists of the
+    best aggregated (price, size) levels. When the consumer falls behind, the oldest update is
+    dropped, so a slow consumer never blocks message processing.
+
+    """
+
+    def __init__(self, depth=5, maxsize=1000):
+        """
+        initialize book updates
+
+        :param depth: number of price levels per side, default 5
+        :param maxsize: maximum number of updates waiting for the consumer, default 1000
+
+        """
+        self.depth = depth
+        self.dropped = 0
+        self._queue = asyncio.Queue(maxsize)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        update = await self._queue.get()
+        if update is None:
+            raise StopAsyncIteration
+        return update
+
+    def put(self, update):
+        """
+        queue an update, dropping the oldest one when the queue is full
+
+        :param update: update dict, None to end the iteration
+
+        """
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(update)
+
+
+class AsyncCoinbaseWebsocketClient(CoinbaseWebsocketClient):
+    """
+    Coinbase Pro Websocket API on asyncio
+
+    One task reads frames into a bounded queue, another parses and applies them to the order
+    books, so the client can be embedded in an asyncio service without a thread per feed.
+    Sequence checking, recovery and the order books are the same as CoinbaseWebsocketClient.
+    The processing task drains every queued frame at once, up to batch_size, and applies them
+    with OrderBook.apply_batch, so a burst is published once instead of once per message.
+
+    """
+
+    def __init__(self, *args, queue_size=10000, batch_size=1000, **kwargs):
+        """
+        initialize asyncio websocket client, see CoinbaseWebsocketClient for the other parameters
+
+        :param queue_size: maximum number of frames read but not yet processed, default 10000
+        :param batch_size: maximum number of queued frames applied as one batch, default 1000,
+                           1 to apply and publish every message on its own; with metrics every
+                           message is timed on its own
+
+        """
+        super().__init__(*args, **kwargs)
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self._updates = []
+        self._closing = asyncio.Event()
+
+    def updates(self, depth=5, maxsize=1000):
+        """
+        subscribe to order book updates
+
+        :param depth: number of price levels per side, default 5
+        :param maxsize: maximum number of updates waiting for the consumer, default 1000
+        :return: BookUpdates async iterator, ending when the client stops
+
+        """
+        updates = BookUpdates(depth, maxsize)
+        self._updates.append(updates)
+        return updates
+
+    async def run(self):
+        """connect websocket, process messages until the connection or the client is closed"""
+        self._closing.clear()
+        self.books.start()
+        if self.publisher is not None:
+            self.publisher.start()
+        queue = asyncio.Queue(self.queue_size)
+        try:
+            async with websockets.connect(self.url) as ws:
+                self.ws = ws
+                logging.info("Websocket connected")
+                await ws.send(self._subscribe_message())
+                logging.info(f"Subscribed to channels:{self.channels}")
+
+                reader = asyncio.create_task(self._read(ws, queue))
+                processor = asyncio.create_task(self._process(ws, queue))
+                poller = asyncio.create_task(self._poll(ws))
+                closing = asyncio.create_task(self._closing.wait())
+                # the processing task drains the queue and returns once the connection closed
+                await asyncio.wait([processor, closing], return_when=asyncio.FIRST_COMPLETED)
+                for task in (reader, processor, poller, closing):
+                    task.cancel()
+                await asyncio.gather(reader, processor, poller, closing, return_exceptions=True)
+                if not processor.cancelled() and processor.exception() is not None:
+                    raise processor.exception()
+        finally:
+            self.ws = None
+            logging.info("Websocket closed")
+            self.books.stop()
+            if self.publisher is not None:
+                self.publisher.stop()
+            if self.capture is not None:
+                self.capture.flush()
+            for updates in self._updates:
+                updates.put(None)
+            self._updates = []
+
+    async def _read(self, ws, queue):
+        """
+        read frames into the queue, None marks the end of the connection
+
+        :param ws: websocket
+        :param queue: frame queue
+
+        """
+        try:
+            async for frame in ws:
+                received_ns = time.perf_counter_ns() if self.metrics is not None else None
+                if self.capture is not None:
+                    self.capture.write(frame)
+                await queue.put(frame if received_ns is None else (frame, received_ns))
+        except websockets.ConnectionClosedError as e:
+            logging.error(f"Websocket connection closed: {e}")
+        await queue.put(None)
+
+    async def _process(self, ws, queue):
+        """
+        parse the queued frames and apply them to the order books
+
+        :param ws: websocket
+        :param queue: frame queue
+
+        """
+        while True:
+            frame = await queue.get()
+            if frame is None:
+                return
+            if self.metrics is not None:
+                self._handle_message_timed(ws, *frame)
+                continue
+            if self.batch_size <= 1 or queue.empty():
+                message = decode_message(frame)
+                order_book = self._handle_message(ws, message)
+                if order_book is not None:
+                    self._publish(message, order_book)
+                continue
+
+            messages = [decode_message(frame)]
+            end = False
+            while len(messages) < self.batch_size and not queue.empty():
+                frame = queue.get_nowait()
+                if frame is None:
+                    end = True
+                    break
+                messages.append(decode_message(frame))
+            for message, order_book in self._handle_batch(ws, messages).values():
+                self._publish(message, order_book)
+            if end:
+                return
+
+    async def _poll(self, ws):
+        """
+        poll the recoveries every RECOVERY_POLL_INTERVAL seconds, so that they complete without new messages
+
+        :param ws: websocket
+
+        """
+        while True:
+            await asyncio.sleep(self.RECOVERY_POLL_INTERVAL)
+            if self._recoveries:
+                self._poll_recoveries_timed(ws)
+
+    def _publish(self, message: dict, order_book):
+        """
+        publish the order book of the message's product
+
+        :param message: message dict
+        :param order_book: order book
+
+        """
+        product_id = message["product_id"]
+        sequence = self.books.sequences.get(product_id)
+        if self.publisher is not None:
+            self.publisher.notify(order_book, product_id, sequence)
+        for updates in self._updates:
+            updates.put({"product_id": product_id, "sequence": sequence,
+                         "bid": order_book.top_levels("bid", updates.depth),
+                         "ask": order_book.top_levels("ask", updates.depth)})
+
+    def on_error(self, ws, error: str):
+        """
+        on error
+        :param ws: websocket
+        :param error: error message
+
+        """
+        logging.error(error)
+        self.error_count += 1
+        if self.error_count > self.MAX_ERROR_COUNT:
+            logging.error("Max error count reached, close websocket")
+            self.close()
+
+    def close(self):
+        """stop the client, run() returns once the websocket is closed"""
+        self._closing.set()
+
+    def connect(self):
+        """connect websocket, blocking until the connection or the client is closed"""
+        asyncio.run(self.run())
@@ -0,0 +1,314 @@
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import platform
+from decimal import Decimal
+
+from orderbook import OrderBook
+from publisher import BookPublisher
+from fixed_point import product_scales
+from message_decoder import decode_message
+from coinbase_websocket_client import CoinbaseWebsocketClient
+
+
+def generate_messages(count=100000, depth=50, cancel_ratio=0.45, volatility=1.0, seed=0,
+                      product_id="BTC-USD", mid_price="20000.00", sequence=1):
+    """
+    generate a synthetic Coinbase full channel message stream
+
+    Limit orders rest within depth ticks of a random walk mid price, are canceled, changed or
+    filled by matches, so that the book stays uncrossed and the sequences are contiguous.
+
+    :param count: number of messages
+    :param depth: number of price ticks on each side of the mid price orders rest on
+    :param cancel_ratio: share of the order book events canceling a resting order
+    :param volatility: standard deviation of the mid price random walk, in ticks per message
+    :param seed: random seed
+    :param product_id: product id
+    :param mid_price: initial mid price
+    :param sequence: first sequence
+    :return: list of message dicts
+
+    """
+    rng = random.Random(seed)
+    tick = Decimal("0.01")
+    mid = Decimal(mid_price)
+    drift = 0.0
+    resting = {"buy": {}, "sell": {}}
+    messages = []
+
+    def append(message):
+        nonlocal sequence
+        message["product_id"] = product_id
+        message["sequence"] = sequence
+        message["time"] = "2022-09-26T03:10:27.067787Z"
+        sequence += 1
+        messages.append(message)
+
+    while len(messages) < count:
+        drift += rng.gauss(0, volatility)
+        if abs(drift) >= 1:
+            mid += tick * int(drift)
+            drift -= int(drift)
+
+        side = rng.choice(("buy", "sell"))
+        orders = resting[side]
+        event = rng.random()
+        if orders and event < cancel_ratio:
+            order_id = rng.choice(list(orders))
+            size, price = orders.pop(order_id)
+            append({"type": "done", "side": side, "order_id": order_id, "reason": "canceled",
+                    "price": str(price), "remaining_size": str(size)})
+        elif orders and event < cancel_ratio + 0.1:
+            order_id = rng.choice(list(orders))
+            size, price = orders[order_id]
+            new_size = (size / 2).quantize(Decimal("0.00000001"))
+            orders[order_id] = (new_size, price)
+            append({"type": "change", "side": side, "order_id": order_id, "price": str(price),
+                    "old_size": str(size), "new_size": str(new_size)})
+        elif orders and event < cancel_ratio + 0.2:
+            # a taker order fills the best maker order of the side, partially or completely
+            best = max if side == "buy" else min
+            order_id = best(orders, key=lambda oid: orders[oid][1])
+            size, price = orders[order_id]
+            fill = size if rng.random() < 0.5 else (size / 3).quantize(Decimal("0.00000001"))
+            append({"type": "match", "side": side, "maker_order_id": order_id,
+                    "taker_order_id": str(uuid.UUID(int=rng.getrandbits(128))), "trade_id": len(messages),
+                    "price": str(price), "size": str(fill)})
+            if fill == size:
+                del orders[order_id]
+                append({"type": "done", "side": side, "order_id": order_id, "reason": "filled",
+                        "price": str(price), "remaining_size": "0.00000000"})
+            else:
+                orders[order_id] = (size - fill, price)
+        else:
+            order_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            offset = tick * rng.randint(1, depth)
+            price = mid - offset if side == "buy" else mid + offset
+            size = Decimal(rng.randint(1, 100000000)).scaleb(-8)
+            append({"type": "received", "side": side, "order_id": order_id, "order_type": "limit",
+                    "price": str(price), "size": str(size)})
+            # drop the resting orders of the other side the new order would cross
+            other = "sell" if side == "buy" else "buy"
+            for crossed in [oid for oid, (_, p) in resting[other].items()
+                            if (side == "buy" and p <= price) or (side == "sell" and p >= price)]:
+                crossed_size, crossed_price = resting[other].pop(crossed)
+                append({"type": "done", "side": other, "order_id": crossed, "reason": "canceled",
+                        "price": str(crossed_price), "remaining_size": str(crossed_size)})
+            orders[order_id] = (size, price)
+            append({"type": "open", "side": side, "order_id": order_id, "price": str(price),
+                    "remaining_size": str(size)})
+    return messages
+
+
+def _percentile(sorted_values, percent):
+    """
+    percentile of sorted values, nearest rank
+
+    :param sorted_values: sorted list of numbers
+    :param percent: percentile, 0 to 100
+    :return: value
+
+    """
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+def _summary(latencies_ns, elapsed_s):
+    """
+    summary of a timed operation
+
+    :param latencies_ns: list of per-call latencies in ns
+    :param elapsed_s: total elapsed seconds
+    :return: dict of ops per second and latency percentiles in ns
+
+    """
+    latencies_ns.sort()
+    return {"ops": len(latencies_ns),
+            "ops_per_second": round(len(latencies_ns) / elapsed_s) if elapsed_s else 0,
+            "p50_ns": _percentile(latencies_ns, 50),
+            "p99_ns": _percentile(latencies_ns, 99),
+            "max_ns": latencies_ns[-1] if latencies_ns else 0}
+
+
+def _time_calls(calls):
+    """
+    time each call
+
+    :param calls: list of (function, args)
+    :return: summary dict
+
+    """
+    clock = time.perf_counter_ns
+    latencies = []
+    append = latencies.append
+    start = time.perf_counter()
+    for function, args in calls:
+        t0 = clock()
+        function(*args)
+        append(clock() - t0)
+    return _summary(latencies, time.perf_counter() - start)
+
+
+def bench_order_book(orders=100000, depth=50, seed=0, fixed_point=False):
+    """
+    benchmark the OrderBook operations on random orders
+
+    :param orders: number of orders
+    :param depth: number of price levels per side
+    :param seed: random seed
+    :param fixed_point: use fixed point prices and sizes
+    :return: dict of operation name -> summary dict
+
+    """
+    rng = random.Random(seed)
+    if fixed_point:
+        price_scale, size_scale = product_scales("BTC-USD")
+        order_book = OrderBook(price_scale, size_scale)
+        make_price, make_size = (lambda ticks: 2000000 + ticks), (lambda units: units)
+    else:
+        order_book = OrderBook()
+        make_price = lambda ticks: Decimal(2000000 + ticks).scaleb(-2)
+        make_size = lambda units: Decimal(units).scaleb(-8)
+
+    placed = []
+    for i in range(orders):
+        side = "bid" if i % 2 else "ask"
+        ticks = -rng.randint(1, depth) if side == "bid" else rng.randint(1, depth)
+        placed.append((str(uuid.UUID(int=rng.getrandbits(128))), make_size(rng.randint(2, 100000000)),
+                       make_price(ticks), side))
+
+    tick = make_price(1) - make_price(0)
+    results = {"insert_order": _time_calls([(order_book.insert_order, order) for order in placed])}
+    # move every other order one tick away from the mid price
+    results["change_order_price"] = _time_calls(
+        [(order_book.change_order_price, (order_id, price, price - tick if side == "bid" else price + tick, side))
+         for order_id, _, price, side in placed[::2]])
+    results["match_order"] = _time_calls(
+        [(order_book.match_order, (order_id, make_size(1), side)) for order_id, _, _, side in placed[1::2]])
+    rng.shuffle(placed)
+    results["delete_order"] = _time_calls(
+        [(order_book.delete_order, (order_id, side)) for order_id, _, _, side in placed])
+    return results
+
+
+def bench_pipeline(messages, fixed_point=False):
+    """
+    benchmark the end-to-end message processing of the websocket client
+
+    :param messages: list of message dicts
+    :param fixed_point: use fixed point prices and sizes
+    :return: dict of stage name -> summary dict
+
+    """
+    client = CoinbaseWebsocketClient(fixed_point=fixed_point)
+    results = {"_process_message": _time_calls([(client._process_message, (None, message))
+                                                for message in messages])}
+
+    # decoding, sequence check and order book update of the raw frames, without publishing
+    client = CoinbaseWebsocketClient(fixed_point=fixed_point)
+
+    def handle(frame):
+        client._handle_message(None, decode_message(frame))
+
+    raw = [json.dumps(message, separators=(",", ":")) for message in messages]
+    results["_handle_message"] = _time_calls([(handle, (frame,)) for frame in raw])
+
+    # the client callback, publishing through the default interval publisher to a sink doing nothing
+    publisher = BookPublisher(sink=lambda snapshot: None)
+    client = CoinbaseWebsocketClient(fixed_point=fixed_point, publisher=publisher)
+    publisher.start()
+    try:
+        results["on_message"] = _time_calls([(client.on_message, (None, frame)) for frame in raw])
+    finally:
+        publisher.stop()
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    compare benchmark results with stored baseline results of the same parameters
+
+    :param results: results dict of run
+    :param baseline: results dict of an earlier run
+    :param tolerance: fraction of the baseline throughput an operation may lose, default 0.1
+    :return: dict of "group.operation" -> dict of the throughput and p50 latency ratios to the baseline,
+             and "regression" True when the throughput fell below 1 - tolerance of the baseline
+
+    """
+    comparison = {}
+    for group in ("order_book", "pipeline"):
+        for name, summary in results[group].items():
+            reference = baseline.get(group, {}).get(name)
+            if not reference or not reference["ops_per_second"] or not reference["p50_ns"]:
+                continue
+            ratio = summary["ops_per_second"] / reference["ops_per_second"]
+            comparison[f"{group}.{name}"] = {"ops_per_second_ratio": round(ratio, 3),
+                                             "p50_ratio": round(summary["p50_ns"] / reference["p50_ns"], 3),
+                                             "regression": ratio < 1 - tolerance}
+    return comparison
+
+
+def run(args):
+    """
+    run the benchmarks
+
+    :param args: parsed arguments
+    :return: results dict
+
+    """
+    messages = generate_messages(args.messages, args.depth, args.cancel_ratio, args.volatility, args.seed)
+    return {
+        "python": platform.python_version(),
+        "fixed_point": args.fixed_point,
+        "parameters": {"orders": args.orders, "messages": args.messages, "depth": args.depth,
+                       "cancel_ratio": args.cancel_ratio, "volatility": args.volatility, "seed": args.seed},
+        "order_book": bench_order_book(args.orders, args.depth, args.seed, args.fixed_point),
+        "pipeline": bench_pipeline(messages, args.fixed_point),
+    }
+
+
+def main(argv=None):
+    """run the benchmarks and write the results as json"""
+    parser = argparse.ArgumentParser(description="Benchmark the order book and the message pipeline")
+    parser.add_argument("--orders", type=int, default=100000, help="number of orders of the OrderBook benchmark")
+    parser.add_argument("--messages", type=int, default=100000, help="number of synthetic messages")
+    parser.add_argument("--depth", type=int, default=50, help="number of price levels per side")
+    parser.add_argument("--cancel-ratio", type=float, default=0.45, help="share of events canceling an order")
+    parser.add_argument("--volatility", type=float, default=1.0, help="mid price random walk, in ticks per message")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--fixed-point", action="store_true", help="use fixed point prices and sizes")
+    parser.add_argument("--output", default=None, help="json output file, default stdout")
+    parser.add_argument("--baseline", default=None, help="json results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="fraction of the baseline throughput an operation may lose, default 0.1")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline.get("parameters") != results["parameters"] or baseline.get("fixed_point") != args.fixed_point:
+            print("Warning: the baseline was run with other parameters", file=sys.stderr)
+        results["comparison"] = compare(results, baseline, args.tolerance)
+        regressions = [name for name, ratios in results["comparison"].items() if ratios["regression"]]
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if regressions:
+        print(f"Regressions against the baseline: {', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
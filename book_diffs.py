@@ -0,0 +1,145 @@
+from itertools import islice
+
+SIDES = ("bid", "ask")
+
+
+class _DepthSubscription:
+    """level diff subscriber, with the top depth price levels it was sent when depth is limited"""
+    __slots__ = ("callback", "depth", "levels", "worst")
+
+    def __init__(self, callback, depth):
+        self.callback = callback
+        self.depth = depth
+        # price -> size of the levels the subscriber mirrors, and the worst mirrored price of each side
+        self.levels = {side: {} for side in SIDES}
+        self.worst = {side: None for side in SIDES}
+
+
+class BookDiffStream:
+    """
+    Stream the changes of an order book as per level diffs
+
+    Subscribers receive lists of (side, price, size) diffs, size 0 meaning the price level is gone,
+    first for the current levels and then for every change, so they can keep their own mirror of
+    the book. A subscriber limited to the top depth levels also receives the levels entering and
+    leaving its window. Top of book subscribers receive the best bid and ask when they change.
+    Works with OrderBook and L2OrderBook, through their level listeners.
+
+    """
+
+    def __init__(self, order_book):
+        """
+        initialize diff stream, and attach it to the order book
+
+        :param order_book: OrderBook or L2OrderBook
+
+        """
+        self.order_book = order_book
+        self._subscriptions = []
+        self._top_callbacks = []
+        self._top = None
+        order_book.add_level_listener(self._on_level)
+
+    def close(self):
+        """detach from the order book"""
+        self.order_book.remove_level_listener(self._on_level)
+
+    def subscribe(self, callback, depth=None):
+        """
+        subscribe to level diffs, the current levels are sent right away
+
+        :param callback: callable receiving a list of (side, price, size) diffs
+        :param depth: number of best price levels per side, default None for the full depth
+        :return: subscription, to unsubscribe
+
+        """
+        subscription = _DepthSubscription(callback, depth)
+        self._subscriptions.append(subscription)
+        diffs = []
+        for side in SIDES:
+            if depth is None:
+                levels = self.order_book.top_levels(side, self.order_book.level_count(side))
+                diffs.extend((side, price, size) for price, size in levels)
+            else:
+                diffs.extend(self._refresh(subscription, side))
+        if diffs:
+            callback(diffs)
+        return subscription
+
+    def subscribe_top(self, callback):
+        """
+        subscribe to top of book changes, the current top of book is sent right away
+
+        :param callback: callable receiving (best bid, best ask), each (price, size) or None
+        :return: subscription, to unsubscribe
+
+        """
+        self._top_callbacks.append(callback)
+        self._top = self._current_top()
+        callback(*self._top)
+        return callback
+
+    def unsubscribe(self, subscription):
+        """
+        stop sending diffs or top of book changes to a subscriber
+
+        :param subscription: value returned by subscribe or subscribe_top
+
+        """
+        if subscription in self._top_callbacks:
+            self._top_callbacks.remove(subscription)
+        else:
+            self._subscriptions.remove(subscription)
+
+    def _current_top(self):
+        """:return: tuple of (best bid, best ask)"""
+        return self.order_book.best_bid(), self.order_book.best_ask()
+
+    def _refresh(self, subscription, side):
+        """
+        update the mirrored top levels of a depth limited subscriber
+
+        :param subscription: _DepthSubscription
+        :param side: "bid" or "ask"
+        :return: list of (side, price, size) diffs between the mirrored and the current top levels
+
+        """
+        current = dict(islice(self.order_book.iter_levels(side), subscription.depth))
+        mirrored = subscription.levels[side]
+
+        level_out = self.order_book.level_out
+        diffs = [(side, *level_out(price, 0)) for price in mirrored if price not in current]
+        diffs.extend((side, *level_out(price, size)) for price, size in current.items()
+                     if mirrored.get(price) != size)
+        subscription.levels[side] = current
+        subscription.worst[side] = next(reversed(current)) if current else None
+        return diffs
+
+    def _on_level(self, side, price, size):
+        """
+        level listener, send the diffs and the top of book change
+
+        :param side: "bid" or "ask"
+        :param price: price level, as stored in the order book
+        :param size: aggregate size of the price level, 0 if it was removed
+
+        """
+        for subscription in self._subscriptions:
+            if subscription.depth is None:
+                diffs = [(side, *self.order_book.level_out(price, size))]
+            else:
+                worst = subscription.worst[side]
+                if (price not in subscription.levels[side] and len(subscription.levels[side]) == subscription.depth
+                        and (price < worst if side == "bid" else price > worst)):
+                    # outside of a full window
+                    continue
+                diffs = self._refresh(subscription, side)
+            if diffs:
+                subscription.callback(diffs)
+
+        if self._top_callbacks:
+            top = self._current_top()
+            if top != self._top:
+                self._top = top
+                for callback in self._top_callbacks:
+                    callback(*top)
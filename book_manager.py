@@ -0,0 +1,484 @@
+import queue
+import logging
+import functools
+import multiprocessing
+from decimal import Decimal
+
+from orderbook import OrderBook, L2OrderBook
+from fixed_point import product_scales
+
+
+def decimal_round(num, num_digits=8):
+    """
+    round the number to num_digits decimal places
+
+    :param num: number
+    :param num_digits: number of decimal places, either 2 or 8
+    :return: rounded number
+
+    """
+    digit = "1.00000000" if num_digits == 8 else "1.00"
+    return Decimal(num).quantize(Decimal(digit))
+
+
+class ProductBook:
+    """order book of one product, with the parsers of its prices and sizes"""
+
+    def __init__(self, product_id, fixed_point=False, increments=None, level2=False):
+        """
+        initialize product book
+
+        :param product_id: product id, e.g. "BTC-USD"
+        :param fixed_point: keep prices and sizes as scaled ints instead of Decimal, default False
+        :param increments: optional dict of product id -> (quote increment, base increment)
+        :param level2: keep an L2OrderBook fed by the level2 channels instead of an OrderBook, default False
+
+        """
+        self.product_id = product_id
+        book_class = L2OrderBook if level2 else OrderBook
+        if fixed_point:
+            price_scale, size_scale = product_scales(product_id, increments)
+            self.order_book = book_class(price_scale, size_scale)
+            self.parse_price, self.parse_size = price_scale.parse, size_scale.parse
+        else:
+            self.order_book = book_class()
+            self.parse_price = functools.partial(decimal_round, num_digits=2)
+            self.parse_size = decimal_round
+
+    def load_snapshot(self, snapshot):
+        """
+        replace the order book content with a level 3 snapshot
+
+        :param snapshot: dict with "bids" and "asks" lists of [price, size, order_id],
+                         best price first and FIFO within a price level
+
+        """
+        with self.order_book.lock:
+            self.order_book.clear()
+            for side, key in (("bid", "bids"), ("ask", "asks")):
+                for price, size, order_id in snapshot[key]:
+                    self.order_book.insert_order(order_id, self.parse_size(size), self.parse_price(price), side)
+
+
+# order book side of the message side
+SIDES = {"buy": "bid", "sell": "ask"}
+
+
+def _apply_open(product, message: dict):
+    """
+    apply an open message, the order is now resting on the order book
+
+    :param product: ProductBook
+    :param message: message dict
+
+    """
+    product.order_book.insert_order(message["order_id"],
+                                    product.parse_size(message["remaining_size"]),
+                                    product.parse_price(message["price"]), SIDES[message["side"]])
+
+
+def _apply_done(product, message: dict):
+    """
+    apply a done message, the order is no longer on the order book
+
+    :param product: ProductBook
+    :param message: message dict
+
+    """
+    product.order_book.delete_order(message["order_id"], SIDES[message["side"]])
+
+
+def _apply_change(product, message: dict):
+    """
+    apply a change message, the price or the size of the order changed
+
+    :param product: ProductBook
+    :param message: message dict
+
+    """
+    side = SIDES[message["side"]]
+    if "new_price" in message:
+        product.order_book.change_order_price(message["order_id"],
+                                              product.parse_price(message["old_price"]),
+                                              product.parse_price(message["new_price"]), side)
+    if "new_size" in message and message["new_size"] != message["old_size"]:
+        # string comparison, no need to worry about precision
+        product.order_book.change_order_size(message["order_id"],
+                                             product.parse_size(message["new_size"]), side)
+
+
+def _apply_match(product, message: dict):
+    """
+    apply a match message, the side of the message is the side of the maker order
+
+    :param product: ProductBook
+    :param message: message dict
+
+    """
+    product.order_book.match_order(message["maker_order_id"], product.parse_size(message["size"]),
+                                   SIDES[message["side"]])
+
+
+def _apply_l2_snapshot(product, message: dict):
+    """
+    apply a level2 snapshot message, replacing every price level
+
+    :param product: ProductBook of an L2OrderBook
+    :param message: message dict with "bids" and "asks" lists of [price, size]
+
+    """
+    order_book = product.order_book
+    order_book.clear()
+    for side, key in (("bid", "bids"), ("ask", "asks")):
+        for price, size in message[key]:
+            order_book.update_level(product.parse_price(price), product.parse_size(size), side)
+
+
+def _apply_l2update(product, message: dict):
+    """
+    apply a level2 update message, every change is the new size of a price level
+
+    :param product: ProductBook of an L2OrderBook
+    :param message: message dict with "changes" list of [side, price, size]
+
+    """
+    order_book = product.order_book
+    for side, price, size in message["changes"]:
+        order_book.update_level(product.parse_price(price), product.parse_size(size), SIDES[side])
+
+
+# full and level2 channel message handlers, received and activate messages do not change the order book
+MESSAGE_HANDLERS = {
+    "open": _apply_open,
+    "done": _apply_done,
+    "change": _apply_change,
+    "match": _apply_match,
+    "snapshot": _apply_l2_snapshot,
+    "l2update": _apply_l2update,
+}
+
+
+def apply_message(product, message: dict):
+    """
+    apply a full channel message to the product's order book
+
+    :param product: ProductBook
+    :param message: message dict
+
+    """
+    handler = MESSAGE_HANDLERS.get(message["type"])
+    if handler is not None:
+        with product.order_book.lock:
+            handler(product, message)
+
+
+def _open_events(product, message: dict):
+    """order book events of an open message, see _apply_open"""
+    return (("insert_order", message["order_id"], product.parse_size(message["remaining_size"]),
+             product.parse_price(message["price"]), SIDES[message["side"]]),)
+
+
+def _done_events(product, message: dict):
+    """order book events of a done message, see _apply_done"""
+    return (("delete_order", message["order_id"], SIDES[message["side"]]),)
+
+
+def _change_events(product, message: dict):
+    """order book events of a change message, see _apply_change"""
+    side = SIDES[message["side"]]
+    events = []
+    if "new_price" in message:
+        events.append(("change_order_price", message["order_id"], product.parse_price(message["old_price"]),
+                       product.parse_price(message["new_price"]), side))
+    if "new_size" in message and message["new_size"] != message["old_size"]:
+        events.append(("change_order_size", message["order_id"], product.parse_size(message["new_size"]), side))
+    return events
+
+
+def _match_events(product, message: dict):
+    """order book events of a match message, see _apply_match"""
+    return (("match_order", message["maker_order_id"], product.parse_size(message["size"]),
+             SIDES[message["side"]]),)
+
+
+def _l2update_events(product, message: dict):
+    """order book events of a level2 update message, see _apply_l2update"""
+    return [("update_level", product.parse_price(price), product.parse_size(size), SIDES[side])
+            for side, price, size in message["changes"]]
+
+
+# message -> apply_batch events
+MESSAGE_EVENTS = {
+    "open": _open_events,
+    "done": _done_events,
+    "change": _change_events,
+    "match": _match_events,
+    "l2update": _l2update_events,
+}
+
+
+def apply_messages(product, messages):
+    """
+    apply a batch of messages to the product's order book in one apply_batch
+
+    :param product: ProductBook
+    :param messages: list of message dicts, in sequence order
+
+    """
+    events = []
+    with product.order_book.lock:
+        for message in messages:
+            builder = MESSAGE_EVENTS.get(message["type"])
+            if builder is not None:
+                events.extend(builder(product, message))
+            elif message["type"] in MESSAGE_HANDLERS:
+                # messages replacing the order book, e.g. level2 snapshots, are applied in order
+                product.order_book.apply_batch(events)
+                events = []
+                MESSAGE_HANDLERS[message["type"]](product, message)
+        product.order_book.apply_batch(events)
+
+
+def _product_book(products, product_id, fixed_point, increments, level2):
+    """
+    product book of a product, created on first use
+
+    :param products: dict of product id -> ProductBook, a created product book is added to it
+    :param product_id: product id
+    :param fixed_point: keep prices and sizes as scaled ints
+    :param increments: optional dict of product id -> (quote increment, base increment)
+    :param level2: True or collection of the product ids kept as L2OrderBook
+    :return: ProductBook
+
+    """
+    product = products.get(product_id)
+    if product is None:
+        product = products[product_id] = ProductBook(product_id, fixed_point, increments,
+                                                     level2 is True or product_id in level2)
+    return product
+
+
+def _worker_main(inbox, outbox, fixed_point, increments, level2):
+    """
+    worker process, owns the order books of the products routed to it
+
+    :param inbox: queue of (command, payload)
+    :param outbox: queue of snapshot replies
+    :param fixed_point: keep prices and sizes as scaled ints
+    :param increments: optional dict of product id -> (quote increment, base increment)
+    :param level2: True or collection of the product ids kept as L2OrderBook
+
+    """
+    products = {}
+    while True:
+        command, payload = inbox.get()
+        if command == "message":
+            # drain the queued messages, and apply them as one batch per product
+            batches = {}
+            while command == "message":
+                batches.setdefault(payload["product_id"], []).append(payload)
+                try:
+                    command, payload = inbox.get_nowait()
+                except queue.Empty:
+                    command = None
+            for product_id, messages in batches.items():
+                apply_messages(_product_book(products, product_id, fixed_point, increments, level2), messages)
+
+        if command == "messages":
+            product_id, messages = payload
+            apply_messages(_product_book(products, product_id, fixed_point, increments, level2), messages)
+        elif command == "snapshot":
+            product_id, snapshot = payload
+            _product_book(products, product_id, fixed_point, increments, level2).load_snapshot(snapshot)
+        elif command == "levels":
+            product_id, depth = payload
+            if product_id in products:
+                order_book = products[product_id].order_book
+                outbox.put({"bid": order_book.top_levels("bid", depth), "ask": order_book.top_levels("ask", depth)})
+            else:
+                outbox.put({"bid": [], "ask": []})
+        elif command == "stop":
+            return
+
+
+class BookManager:
+    """
+    Route full channel messages by product id to the order book of each product
+
+    Every product has its own order book and its own sequence tracker. With workers > 0 the
+    products are spread over worker processes, each owning the order books of its products, and
+    applying the messages queued to it in batches. Decoding, sequencing and pickling every message
+    onto a multiprocessing.Queue still run on this process's core, so workers only pay off when
+    applying the messages dominates, e.g. with many busy products; apply_batch puts a whole batch
+    per product on the queue at once. The books are not in this process: book() returns None, so
+    publishers and level listeners cannot be used, and top_levels queries a worker synchronously.
+
+    """
+
+    def __init__(self, product_ids, fixed_point=False, increments=None, workers=0, level2=None):
+        """
+        initialize book manager
+
+        :param product_ids: list of product ids
+        :param fixed_point: keep prices and sizes as scaled ints instead of Decimal, default False
+        :param increments: optional dict of product id -> (quote increment, base increment)
+        :param workers: number of worker processes, default 0 to keep every book in this process
+        :param level2: True to keep every product as an L2OrderBook, or list of the product ids kept as
+                       L2OrderBook, default None to keep every product as an OrderBook
+
+        """
+        self.product_ids = list(product_ids)
+        self.fixed_point = fixed_point
+        self.increments = increments
+        self.workers = workers
+        self.level2 = True if level2 is True else frozenset(level2 or ())
+        # last applied sequence of each product
+        self.sequences = {product_id: None for product_id in self.product_ids}
+
+        self.products = {}
+        self._routes = {}
+        self._processes = []
+        self._inboxes = []
+        self._outboxes = []
+        if not workers:
+            for product_id in self.product_ids:
+                self.product(product_id)
+        else:
+            for i, product_id in enumerate(self.product_ids):
+                self._routes[product_id] = i % workers
+
+    def start(self):
+        """start the worker processes"""
+        if not self.workers or self._processes:
+            return
+        for _ in range(self.workers):
+            inbox, outbox = multiprocessing.Queue(), multiprocessing.Queue()
+            process = multiprocessing.Process(target=_worker_main,
+                                              args=(inbox, outbox, self.fixed_point, self.increments, self.level2),
+                                              daemon=True)
+            process.start()
+            self._inboxes.append(inbox)
+            self._outboxes.append(outbox)
+            self._processes.append(process)
+        logging.info(f"Started {self.workers} book worker processes")
+
+    def stop(self):
+        """stop the worker processes after they applied the queued messages"""
+        for inbox in self._inboxes:
+            inbox.put(("stop", None))
+        for process in self._processes:
+            process.join()
+        self._processes, self._inboxes, self._outboxes = [], [], []
+
+    def is_level2(self, product_id):
+        """
+        :param product_id: product id
+        :return: True if the product is kept as an L2OrderBook
+
+        """
+        return self.level2 is True or product_id in self.level2
+
+    def _worker(self, product_id):
+        """
+        worker index of a product, products not subscribed up front are assigned on first use
+
+        :param product_id: product id
+        :return: worker index
+
+        """
+        if not self._processes:
+            self.start()
+        if product_id not in self._routes:
+            self._routes[product_id] = len(self._routes) % self.workers
+        return self._routes[product_id]
+
+    def product(self, product_id):
+        """
+        product book of a product in this process, created on first use
+
+        :param product_id: product id
+        :return: ProductBook, None when the products live in worker processes
+
+        """
+        if self.workers:
+            return None
+        return _product_book(self.products, product_id, self.fixed_point, self.increments, self.level2)
+
+    def book(self, product_id):
+        """
+        order book of a product in this process
+
+        :param product_id: product id
+        :return: OrderBook, None when the products live in worker processes
+
+        """
+        product = self.product(product_id)
+        return product.order_book if product is not None else None
+
+    def apply(self, message: dict):
+        """
+        apply a full channel message to the order book of its product
+
+        :param message: message dict
+
+        """
+        product_id = message["product_id"]
+        if self.workers:
+            self._inboxes[self._worker(product_id)].put(("message", message))
+        else:
+            apply_message(self.product(product_id), message)
+
+    def apply_batch(self, messages):
+        """
+        apply a batch of full channel messages, netted and applied once per product order book
+
+        :param messages: list of message dicts, in sequence order
+
+        """
+        batches = {}
+        for message in messages:
+            batches.setdefault(message["product_id"], []).append(message)
+        for product_id, batch in batches.items():
+            if self.workers:
+                self._inboxes[self._worker(product_id)].put(("messages", (product_id, batch)))
+            else:
+                apply_messages(self.product(product_id), batch)
+
+    def load_snapshot(self, product_id, snapshot):
+        """
+        replace the order book of a product with a level 3 snapshot, and set its sequence
+
+        :param product_id: product id
+        :param snapshot: dict with "sequence", and "bids" and "asks" lists of [price, size, order_id]
+
+        """
+        if self.workers:
+            self._inboxes[self._worker(product_id)].put(("snapshot", (product_id, snapshot)))
+        else:
+            self.product(product_id).load_snapshot(snapshot)
+        self.sequences[product_id] = snapshot["sequence"]
+
+    def reset(self, product_id):
+        """
+        empty the order book of a product and forget its sequence, so that it is bootstrapped again
+
+        :param product_id: product id
+
+        """
+        self.load_snapshot(product_id, {"sequence": None, "bids": [], "asks": []})
+
+    def top_levels(self, product_id, depth=5):
+        """
+        best aggregated price levels of a product, works for books in worker processes as well
+
+        :param product_id: product id
+        :param depth: number of price levels per side, default 5
+        :return: dict of side -> list of (price, size), best price first
+
+        """
+        if not self.workers:
+            order_book = self.book(product_id)
+            return {"bid": order_book.top_levels("bid", depth), "ask": order_book.top_levels("ask", depth)}
+        worker = self._worker(product_id)
+        self._inboxes[worker].put(("levels", (product_id, depth)))
+        return self._outboxes[worker].get()
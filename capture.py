@@ -0,0 +1,199 @@
+import os
+import sys
+import gzip
+import mmap
+import time
+import queue
+import struct
+import logging
+import argparse
+import threading
+
+from message_decoder import decode_message
+from coinbase_websocket_client import CoinbaseWebsocketClient
+
+# file header, followed by records of (receive timestamp in ns, payload length) and the utf-8 payload
+MAGIC = b"CBCAP\x01"
+RECORD_HEADER = struct.Struct("<qI")
+
+
+class CaptureWriter:
+    """
+    Append-only capture of the raw websocket messages with their receive timestamps
+
+    Records are length-prefixed so the file can be memory-mapped and replayed without parsing
+    line breaks. With compress=True the file is gzip compressed, and is replayed as a stream.
+    The ingest thread only timestamps and queues the messages, encoding, compression and file
+    writes run on a writer thread.
+
+    """
+
+    def __init__(self, path, compress=None):
+        """
+        initialize capture writer
+
+        :param path: capture file path, appended to if it exists
+        :param compress: gzip compress the file, default True if path ends with ".gz"
+
+        """
+        self.path = path
+        self.compress = path.endswith(".gz") if compress is None else compress
+        self.count = 0
+        self._lock = threading.Lock()
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = gzip.open(path, "ab") if self.compress else open(path, "ab")
+        if new_file:
+            self._file.write(MAGIC)
+        # (timestamp_ns, message) records, threading.Event flush markers, and None to stop the writer
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._run, name="capture", daemon=True)
+        self._writer.start()
+
+    def write(self, message: str, timestamp_ns=None):
+        """
+        append a message, written to the file by the writer thread
+
+        :param message: raw incoming message
+        :param timestamp_ns: receive timestamp in ns since epoch, default now
+
+        """
+        self._queue.put((time.time_ns() if timestamp_ns is None else timestamp_ns, message))
+        self.count += 1
+
+    def _run(self):
+        """writer thread, write the queued records until close"""
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            if isinstance(record, threading.Event):
+                with self._lock:
+                    self._file.flush()
+                record.set()
+                continue
+            timestamp_ns, message = record
+            payload = message.encode() if isinstance(message, str) else message
+            with self._lock:
+                self._file.write(RECORD_HEADER.pack(timestamp_ns, len(payload)))
+                self._file.write(payload)
+
+    def flush(self):
+        """wait for the queued messages to be written, and flush them to the file"""
+        if not self._writer.is_alive():
+            return
+        flushed = threading.Event()
+        self._queue.put(flushed)
+        flushed.wait()
+
+    def close(self):
+        """write the queued messages and close the capture file"""
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+                logging.info(f"Captured {self.count} messages to {self.path}")
+
+
+def _read_records(buffer, offset=0):
+    """
+    read the records of a buffer supporting slicing
+
+    :param buffer: bytes or mmap
+    :param offset: offset of the first record
+    :return: generator of (timestamp_ns, message)
+
+    """
+    size = len(buffer)
+    header_size = RECORD_HEADER.size
+    unpack_from = RECORD_HEADER.unpack_from
+    while offset + header_size <= size:
+        timestamp_ns, length = unpack_from(buffer, offset)
+        offset += header_size
+        if offset + length > size:
+            logging.warning("Truncated record at the end of the capture file")
+            return
+        yield timestamp_ns, buffer[offset:offset + length].decode()
+        offset += length
+
+
+def read_capture(path):
+    """
+    read a capture file, memory-mapped when it is not compressed
+
+    :param path: capture file path
+    :return: generator of (timestamp_ns, message)
+
+    """
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    if compressed:
+        with gzip.open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a capture file")
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                timestamp_ns, length = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    logging.warning("Truncated record at the end of the capture file")
+                    return
+                yield timestamp_ns, payload.decode()
+    else:
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a capture file")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield from _read_records(buffer, len(MAGIC))
+
+
+def replay_capture(path, client, after_sequences=None):
+    """
+    replay a capture file through a client's sequencing and order books at full speed
+
+    :param path: capture file path
+    :param client: CoinbaseWebsocketClient
+    :param after_sequences: optional dict of product id -> sequence, the messages of a product up to its
+                            sequence and the messages of the products missing from the dict are skipped
+    :return: number of replayed messages
+
+    """
+    count = 0
+    for _, raw in read_capture(path):
+        message = decode_message(raw)
+        if after_sequences is not None and "product_id" in message:
+            after_sequence = after_sequences.get(message["product_id"])
+            if after_sequence is None:
+                continue
+            sequence = message.get("sequence")
+            if sequence is not None and sequence <= after_sequence:
+                continue
+        client._handle_message(None, message)
+        count += 1
+    return count
+
+
+def main(argv=None):
+    """replay a capture file and print the resulting order book"""
+    parser = argparse.ArgumentParser(description="Replay a capture file through the order book")
+    parser.add_argument("path", help="capture file path")
+    parser.add_argument("--products", nargs="+", default=None, help="product ids, default BTC-USD")
+    parser.add_argument("--fixed-point", action="store_true", help="use fixed point prices and sizes")
+    args = parser.parse_args(argv)
+
+    client = CoinbaseWebsocketClient(products=args.products, fixed_point=args.fixed_point)
+    start = time.perf_counter()
+    count = replay_capture(args.path, client)
+    elapsed = time.perf_counter() - start
+    for product_id in client.product_ids:
+        print(product_id)
+        client.books.book(product_id).print_price()
+    print(f"replayed {count} messages in {elapsed:.3f}s, {count / elapsed if elapsed else 0:.0f} messages/s",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+import os
+import time
+import uuid
+import struct
+import logging
+import threading
+from decimal import Decimal
+
+from fixed_point import FixedPoint
+
+# file header, followed by the product id, the last applied sequence, the fixed point increments
+# ("" in Decimal mode) and the orders of both sides in price level and FIFO order
+MAGIC = b"CBCKP\x02"
+SIDES = ("bid", "ask")
+_LENGTH = struct.Struct("<H")
+_SEQUENCE = struct.Struct("<q")
+_COUNT = struct.Struct("<I")
+_INT = struct.Struct("<q")
+# order id tags, followed by the 16 uuid bytes or by a length-prefixed string
+_UUID_TAG = 0
+_STR_TAG = 1
+
+
+def _pack_str(text):
+    data = text.encode()
+    return _LENGTH.pack(len(data)) + data
+
+
+def _pack_order_id(order_id):
+    """
+    pack an order id, uuids take 17 bytes, other ids are tagged length-prefixed strings
+
+    :param order_id: order id
+    :return: bytes
+
+    """
+    if len(order_id) == 36:
+        try:
+            return bytes((_UUID_TAG,)) + uuid.UUID(order_id).bytes
+        except ValueError:
+            pass
+    return bytes((_STR_TAG,)) + _pack_str(order_id)
+
+
+def dump_book(product_id, sequence, orders, price_scale=None, size_scale=None):
+    """
+    serialize the state of an order book
+
+    :param product_id: product id
+    :param sequence: last applied sequence
+    :param orders: dict of side -> iterable of (order_id, size, price) in price level and FIFO order
+    :param price_scale: FixedPoint of the prices, None if prices are Decimal
+    :param size_scale: FixedPoint of the sizes, None if sizes are Decimal
+    :return: bytes
+
+    """
+    fixed_point = price_scale is not None
+    chunks = [MAGIC, _pack_str(product_id), _SEQUENCE.pack(sequence),
+              _pack_str(price_scale.increment if fixed_point else ""),
+              _pack_str(size_scale.increment if fixed_point else "")]
+    for side in SIDES:
+        side_chunks = []
+        for order_id, size, price in orders[side]:
+            side_chunks.append(_pack_order_id(order_id))
+            if fixed_point:
+                side_chunks.append(_INT.pack(price))
+                side_chunks.append(_INT.pack(size))
+            else:
+                side_chunks.append(_pack_str(str(price)))
+                side_chunks.append(_pack_str(str(size)))
+        chunks.append(_COUNT.pack(len(side_chunks) // 3))
+        chunks.extend(side_chunks)
+    return b"".join(chunks)
+
+
+def load_book(data):
+    """
+    deserialize the state of an order book
+
+    :param data: bytes written by dump_book
+    :return: dict with "product_id", "sequence", "price_increment" and "size_increment" (None in Decimal
+             mode), and "bid" and "ask" lists of (order_id, size, price), as scaled ints in fixed point mode
+
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("not an order book checkpoint")
+    offset = len(MAGIC)
+
+    def read_str():
+        nonlocal offset
+        (length,) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        offset += length
+        return data[offset - length:offset].decode()
+
+    product_id = read_str()
+    (sequence,) = _SEQUENCE.unpack_from(data, offset)
+    offset += _SEQUENCE.size
+    price_increment, size_increment = read_str() or None, read_str() or None
+    fixed_point = price_increment is not None
+
+    state = {"product_id": product_id, "sequence": sequence,
+             "price_increment": price_increment, "size_increment": size_increment}
+    for side in SIDES:
+        (count,) = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        orders = []
+        for _ in range(count):
+            tag = data[offset]
+            offset += 1
+            if tag == _UUID_TAG:
+                order_id = str(uuid.UUID(bytes=data[offset:offset + 16]))
+                offset += 16
+            else:
+                order_id = read_str()
+            if fixed_point:
+                (price,) = _INT.unpack_from(data, offset)
+                (size,) = _INT.unpack_from(data, offset + _INT.size)
+                offset += 2 * _INT.size
+            else:
+                price, size = Decimal(read_str()), Decimal(read_str())
+            orders.append((order_id, size, price))
+        state[side] = orders
+    return state
+
+
+def load_into(product, state):
+    """
+    replace the content of a product's order book with a checkpoint state
+
+    :param product: ProductBook
+    :param state: dict returned by load_book
+
+    """
+    order_book = product.order_book
+    order_book.clear()
+    if state["price_increment"] is not None:
+        price_scale, size_scale = FixedPoint(state["price_increment"]), FixedPoint(state["size_increment"])
+    else:
+        price_scale = size_scale = None
+    same_scale = (price_scale is not None and order_book.price_scale is not None and
+                  order_book.price_scale.increment == price_scale.increment and
+                  order_book.size_scale.increment == size_scale.increment)
+    for side in SIDES:
+        for order_id, size, price in state[side]:
+            if not same_scale:
+                # written in another mode, convert through the decimal strings
+                if price_scale is not None:
+                    size, price = size_scale.to_decimal(size), price_scale.to_decimal(price)
+                size, price = product.parse_size(str(size)), product.parse_price(str(price))
+            order_book.insert_order(order_id, size, price, side)
+
+
+def _iter_orders(levels):
+    """
+    orders of captured price levels, from the lowest price level to the highest and FIFO within a price level
+
+    :param levels: dict of price -> dict of order id -> size
+    :return: generator of (order_id, size, price)
+
+    """
+    for price in sorted(levels):
+        for order_id, size in levels[price].items():
+            yield order_id, size, price
+
+
+class _LevelCopies:
+    """
+    Copies of the price levels of an order book, kept up to date incrementally
+
+    A level listener records the price levels changed since the last capture, and only those are copied
+    again, so a capture costs the changed price levels instead of every resting order. A captured dict is
+    never modified afterwards, so the background thread can serialize it while the order book keeps changing.
+
+    """
+
+    def __init__(self, order_book):
+        """
+        copy every price level of an order book and start recording its changes, called with its lock held
+
+        :param order_book: OrderBook
+
+        """
+        self.order_book = order_book
+        self.levels = {side: order_book.copy_levels(side) for side in SIDES}
+        # (side, price) of the price levels changed since the last capture
+        self.changed = set()
+        order_book.add_level_listener(self._level_changed)
+
+    def _level_changed(self, side, price, size):
+        """level listener, see BaseOrderBook.add_level_listener"""
+        self.changed.add((side, price))
+
+    def capture(self):
+        """
+        copy the changed price levels, called with the order book lock held
+
+        :return: dict of side -> dict of price -> dict of order id -> size
+
+        """
+        levels = {side: self.levels[side].copy() for side in SIDES}
+        for side, price in self.changed:
+            orders = self.order_book.level_orders(price, side)
+            if orders:
+                levels[side][price] = orders
+            else:
+                levels[side].pop(price, None)
+        self.changed.clear()
+        self.levels = levels
+        return levels
+
+
+class Checkpointer:
+    """
+    Periodically write the order books and their last applied sequence to checkpoint files
+
+    The client calls maybe_checkpoint after every message. On the ingest thread a checkpoint only copies
+    the price levels changed since the previous one, see _LevelCopies, the orders are sorted, serialized
+    and written on a background thread. The order books must be in this process, with BookManager workers
+    there is nothing to copy and checkpoint raises ValueError.
+
+    """
+
+    def __init__(self, directory, interval=60, keep=3):
+        """
+        initialize checkpointer
+
+        :param directory: checkpoint directory, created if needed
+        :param interval: seconds between two checkpoints, default 60
+        :param keep: number of checkpoints kept per product, default 3
+
+        """
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self._last_checkpoint = time.monotonic()
+        self._thread = None
+        # price level copies of the checkpointed order books, key is product id
+        self._copies = {}
+
+    def maybe_checkpoint(self, books):
+        """
+        checkpoint the books if the interval elapsed, called on the ingest thread
+
+        :param books: BookManager
+
+        """
+        if time.monotonic() - self._last_checkpoint >= self.interval:
+            self.checkpoint(books)
+
+    def checkpoint(self, books):
+        """
+        checkpoint every product of the books with a known sequence, called on the ingest thread
+
+        :param books: BookManager
+        :return: True if a checkpoint was started, False if the previous one is still being written
+
+        """
+        self._last_checkpoint = time.monotonic()
+        if books.workers:
+            raise ValueError("the order books are in worker processes, they cannot be checkpointed")
+        if self.busy():
+            logging.warning("Previous checkpoint still being written, skipping checkpoint")
+            return False
+        products = [(product_id, sequence, books.product(product_id))
+                    for product_id, sequence in books.sequences.items() if sequence is not None]
+        products = [(product_id, sequence, product) for product_id, sequence, product in products
+                    if product is not None]
+        if not products:
+            return False
+
+        copies = [(product_id, sequence, product.order_book, self._capture(product_id, product.order_book))
+                  for product_id, sequence, product in products]
+        self._thread = threading.Thread(target=self._write_all, args=(copies,), name="checkpoint", daemon=True)
+        self._thread.start()
+        return True
+
+    def _capture(self, product_id, order_book):
+        """
+        copy the price levels of an order book changed since its previous checkpoint
+
+        :param product_id: product id
+        :param order_book: OrderBook
+        :return: dict of side -> dict of price -> dict of order id -> size
+
+        """
+        with order_book.lock:
+            copies = self._copies.get(product_id)
+            if copies is None or copies.order_book is not order_book:
+                copies = self._copies[product_id] = _LevelCopies(order_book)
+            return copies.capture()
+
+    def busy(self):
+        """:return: True if a checkpoint is being written"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait(self):
+        """wait for the checkpoint being written"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _write_all(self, copies):
+        """
+        write the copied order books
+
+        :param copies: list of (product_id, sequence, order_book, dict of side -> captured price levels)
+
+        """
+        for product_id, sequence, order_book, levels in copies:
+            try:
+                self._write(product_id, sequence, order_book, {side: _iter_orders(levels[side]) for side in SIDES})
+            except OSError as e:
+                logging.error(f"Checkpoint error: {product_id} {e}")
+
+    def _write(self, product_id, sequence, order_book, orders):
+        """
+        write a checkpoint file atomically and remove the oldest ones
+
+        :param product_id: product id
+        :param sequence: last applied sequence
+        :param order_book: order book, for its fixed point scales
+        :param orders: dict of side -> iterable of (order_id, size, price)
+
+        """
+        data = dump_book(product_id, sequence, orders, order_book.price_scale, order_book.size_scale)
+        path = os.path.join(self.directory, f"{product_id}-{sequence:020d}.ckpt")
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        for old in self.checkpoints(product_id)[:-self.keep]:
+            os.remove(old)
+
+    def checkpoints(self, product_id):
+        """
+        :param product_id: product id
+        :return: checkpoint file paths of the product, oldest first
+
+        """
+        prefix = f"{product_id}-"
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith(prefix) and name.endswith(".ckpt"))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def latest(self, product_id):
+        """
+        :param product_id: product id
+        :return: state of the latest checkpoint of the product, see load_book, None if there is none
+
+        """
+        for path in reversed(self.checkpoints(product_id)):
+            try:
+                with open(path, "rb") as f:
+                    return load_book(f.read())
+            except (OSError, ValueError, struct.error) as e:
+                logging.error(f"Checkpoint error: {path} {e}")
+        return None
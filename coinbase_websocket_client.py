@@ -1,48 +1,163 @@
 import os
 import json
+import time
+import random
+import threading
 import datetime
 import logging
-from decimal import Decimal
 
 import websocket
 from websocket import WebSocketApp
 from dateutil.tz import tzlocal
-from orderbook import OrderBook
+from book_manager import BookManager
+from recovery import BookRecovery
+from message_decoder import decode_message
+
+
+def setup_logging(filename="order_book.log"):
+    """
+    log to a fresh log file
+
+    :param filename: log file name, removed first if it exists, default "order_book.log"
+
+    """
+    if os.path.exists(filename):
+        os.remove(filename)
+    logging.basicConfig(filename=filename, level=logging.INFO)
 
 
 class CoinbaseWebsocketClient:
     """Coinbase Pro Websocket API"""
     # max error count before close websocket
     MAX_ERROR_COUNT = 5
+    # seconds without any message before the watchdog closes a connection, heartbeats arrive every second
+    HEARTBEAT_TIMEOUT = 5
+    # seconds between two polls of the ongoing recoveries when no message arrives
+    RECOVERY_POLL_INTERVAL = 0.1
+    # maximum number of messages buffered per product during a recovery
+    MAX_RECOVERY_BUFFER = 100000
+    # with a standby connection, messages after a missing sequence are held back until the other connection
+    # delivers it, passes it too, or HOLD_TIMEOUT seconds or MAX_HELD messages are reached
+    HOLD_TIMEOUT = 0.5
+    MAX_HELD = 1000
+    # first and max delay in seconds before reconnecting, doubled after every failed attempt
+    RECONNECT_BACKOFF = 0.5
+    MAX_RECONNECT_BACKOFF = 30
+    # full channel message types carrying a sequence
+    FULL_CHANNEL = frozenset({"open", "done", "match", "change", "activate", "received"})
+    # channel subscribed for the products kept as L2OrderBook, same messages as level2 batched every 50ms
+    LEVEL2_CHANNEL = "level2_batch"
+
+    def __init__(self, url=None, products=None, channels=None, publisher=None, fixed_point=False, increments=None,
+                 workers=0, snapshot_provider=None, threaded_recovery=True, capture=None,
+                 metrics=None, checkpointer=None, level2=None, trades=None, reconnect=True, standby=False):
+        """
+        initialize websocket client
 
-    # logging settings
-    if os.path.exists("order_book.log"):
-        os.remove("order_book.log")
-    logging.basicConfig(filename='order_book.log', level=logging.INFO)
+        :param url: websocket url, default Coinbase Pro websocket feed
+        :param products: list of product ids, default ["BTC-USD"]
+        :param channels: list of channels, default ["heartbeat", "full"], with the level2 products
+                         subscribed to LEVEL2_CHANNEL instead of "full"
+        :param publisher: BookPublisher publishing the order book off the message processing thread,
+                          or SharedBookPublisher publishing it to other processes through shared memory,
+                          default None to print the order book after every message
+        :param fixed_point: keep prices and sizes as scaled ints instead of Decimal, default False
+        :param increments: optional dict of product id -> (quote increment, base increment)
+                           for the fixed point scales, e.g. from fixed_point.fetch_increments, default
+                           fixed_point.PRODUCT_INCREMENTS, then DEFAULT_INCREMENTS for the other products
+        :param workers: number of worker processes the product order books are spread over,
+                        default 0 to keep every order book in this process; the books are then only read
+                        through books.top_levels, nothing is published and no publisher or checkpointer
+                        is accepted
+        :param snapshot_provider: SnapshotProvider bootstrapping the order books and recovering them
+                                  after a sequence gap, default None to only report sequence gaps
+        :param threaded_recovery: fetch snapshots on a background thread, default True
+        :param capture: CaptureWriter recording every incoming message, default None
+        :param metrics: Metrics timing the message processing stages, default None
+        :param checkpointer: Checkpointer periodically writing the order books, default None
+        :param level2: True to track every product as an L2OrderBook from the level2 snapshot and l2update
+                       messages, or list of the product ids tracked so, default None to track every
+                       order of every product from the full channel
+        :param trades: TradeRecorder recording the trades of the match messages, default None
+        :param reconnect: reconnect with a jittered exponential backoff when a connection closes,
+                          until close() is called, default True
+        :param standby: keep a hot standby second connection subscribed to the same channels, default False,
+                        full channel messages are taken from whichever connection delivers their sequence
+                        first and the standby takes over at once when the primary connection closes
 
-    def __init__(self, url=None, products=None, channels=None):
+        """
+        if workers and publisher is not None:
+            raise ValueError("publishers read the order books of this process, they cannot be used with workers")
+        if workers and checkpointer is not None:
+            raise ValueError("checkpoints copy the order books of this process, they cannot be used with workers")
         self.url = "wss://ws-feed.exchange.coinbase.com" if not url else url
         self.product_ids = ["BTC-USD"] if not products else products
-        self.channels = ["heartbeat", "full"] if not channels else channels
+        self.books = BookManager(self.product_ids, fixed_point, increments, workers, level2)
+        self.channels = self._default_channels() if not channels else channels
         self.heartbeat = datetime.datetime.now(tzlocal())
         self.error_count = 0
         self.ws = None
-        self.sequence = None
+        self.publisher = publisher
 
-        self.order_book = OrderBook()
+        self.snapshot_provider = snapshot_provider
+        self.threaded_recovery = threaded_recovery
+        self.capture = capture
+        self.metrics = metrics
+        self.checkpointer = checkpointer
+        self.trades = trades
+        self.reconnect = reconnect
+        self.standby = standby
+        self.reconnects = 0
+        self.failovers = 0
+        # websocket, open time and last message time of the primary and standby connections, see _primary
+        self._connections = [None, None]
+        self._opened_at = [None, None]
+        self._last_message = [None, None]
+        self._primary = 0
+        # last full channel sequence delivered by either connection, key is product id
+        self._delivered = {}
+        # last full channel sequence received by each connection, key is product id
+        self._seen = [{}, {}]
+        # messages after a missing sequence, key is product id, value is dict of sequence -> (raw, message),
+        # and time.monotonic() when the first of them was held
+        self._held = {}
+        self._held_since = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._subscribed = threading.Event()
+        # thread running connect(), joined by close() before the books and the capture are closed
+        self._connect_thread = None
+        self._connected_once = False
+        # ongoing recoveries, key is product id
+        self._recoveries = {}
 
-    @staticmethod
-    def _decimal_round(num, num_digits=8):
-        """
-        round the number to num_digits decimal places
+        # message handlers, key is message type, received and activate messages are only sequenced
+        self._handlers = {
+            "heartbeat": self._on_heartbeat,
+            "error": self._on_error_message,
+            "open": self._apply_message,
+            "done": self._apply_message,
+            "change": self._apply_message,
+            "match": self._apply_message,
+            "snapshot": self._apply_message,
+            "l2update": self._apply_message,
+        }
 
-        :param num: number
-        :param num_digits: number of decimal places, either 2 or 8
-        :return: rounded number
+    def _default_channels(self):
+        """:return: heartbeat channel, and the full or level2 channel of every product"""
+        full = [product_id for product_id in self.product_ids if not self.books.is_level2(product_id)]
+        level2 = [product_id for product_id in self.product_ids if self.books.is_level2(product_id)]
+        if not level2:
+            return ["heartbeat", "full"]
+        if not full:
+            return ["heartbeat", self.LEVEL2_CHANNEL]
+        return ["heartbeat", {"name": "full", "product_ids": full},
+                {"name": self.LEVEL2_CHANNEL, "product_ids": level2}]
 
-        """
-        digit = "1.00000000" if num_digits == 8 else "1.00"
-        return Decimal(num).quantize(Decimal(digit))
+    @property
+    def order_book(self):
+        """order book of the first product, None when the order books live in worker processes"""
+        return self.books.book(self.product_ids[0])
 
     def on_open(self, ws):
         """on open"""
@@ -53,17 +168,19 @@ class CoinbaseWebsocketClient:
 
     def _subscribe(self, ws):
         """subscribe to the channels"""
-        ws.send(
-            json.dumps(
-                {
-                    "type": "subscribe",
-                    "product_ids": self.product_ids,
-                    "channels": self.channels,
-                }
-            )
-        )
+        ws.send(self._subscribe_message())
         logging.info(f"Subscribed to channels:{self.channels}")
 
+    def _subscribe_message(self):
+        """:return: subscribe message of the products and channels"""
+        return json.dumps(
+            {
+                "type": "subscribe",
+                "product_ids": self.product_ids,
+                "channels": self.channels,
+            }
+        )
+
     def on_message(self, ws, message: str):
         """
         on message
@@ -72,15 +189,174 @@ class CoinbaseWebsocketClient:
         :param message: incoming message
 
         """
-        message = json.loads(message)
+        if self.metrics is not None:
+            if self.capture is not None:
+                self.capture.write(message)
+            # websocket-client does not tell when the frame was read, the receive stage is not timed
+            self._handle_message_timed(ws, message)
+            return
+
+        if self.capture is not None:
+            self.capture.write(message)
+        message = decode_message(message)
+        order_book = self._handle_message(ws, message)
+        if order_book is not None:
+            self._publish(message, order_book)
+
+    def _publish(self, message: dict, order_book):
+        """
+        publish the order book of the message's product
+
+        :param message: message dict
+        :param order_book: order book
+
+        """
+        if self.publisher is not None:
+            product_id = message["product_id"]
+            self.publisher.notify(order_book, product_id, self.books.sequences.get(product_id))
+        else:
+            order_book.print_price()
+
+    def _handle_message_timed(self, ws, message: str, received_ns=None):
+        """
+        decode, check the sequence, apply and publish the message, timing every stage
 
-        # checking for sequence error
-        self._check_sequence(ws, message)
+        :param ws: websocket
+        :param message: incoming message
+        :param received_ns: time.perf_counter_ns() when the frame was read off the websocket, the
+                            receive stage is the wait until its processing starts, default None to
+                            skip the receive stage
+
+        """
+        clock = time.perf_counter_ns
+        metrics = self.metrics
+        start = clock()
+        if received_ns is not None:
+            metrics.observe("receive", start - received_ns)
+
+        message = decode_message(message)
+        parsed = clock()
+        metrics.observe("parse", parsed - start)
+        self._apply_timed(ws, message, parsed)
+
+    def _apply_timed(self, ws, message: dict, parsed):
+        """
+        check the sequence, apply and publish a decoded message, timing every stage
+
+        :param ws: websocket
+        :param message: message dict
+        :param parsed: time.perf_counter_ns() when the message was decoded
+
+        """
+        clock = time.perf_counter_ns
+        metrics = self.metrics
+        apply = self._check_sequence(ws, message)
+        sequenced = clock()
+        metrics.observe("sequence", sequenced - parsed)
+
+        if apply:
+            self._process_message(ws, message)
+        if self._recoveries:
+            self._poll_recoveries(ws)
+        if self.checkpointer is not None:
+            self.checkpointer.maybe_checkpoint(self.books)
+        applied = clock()
+        metrics.observe("apply", applied - sequenced)
+        metrics.message(message)
+
+        order_book = self.books.book(message["product_id"]) if "product_id" in message else None
+        if order_book is not None:
+            published = clock()
+            self._publish(message, order_book)
+            metrics.observe("publish", clock() - published)
+
+    def _handle_message(self, ws, message: dict):
+        """
+        check the sequence of the message and apply it
+
+        :param ws: websocket
+        :param message: message dict
+        :return: order book of the message's product, None if there is none in this process
+
+        """
+        # checking for sequence error, messages are buffered during recovery
+        if self._check_sequence(ws, message):
+            # processing message
+            self._process_message(ws, message)
 
-        # processing message
-        self._process_message(ws, message)
+        if self._recoveries:
+            self._poll_recoveries(ws)
+        if self.checkpointer is not None:
+            self.checkpointer.maybe_checkpoint(self.books)
 
-        self.order_book.print_price()
+        return self.books.book(message["product_id"]) if "product_id" in message else None
+
+    def _handle_batch(self, ws, messages):
+        """
+        check the sequences of a batch of messages and apply them, each product's order book once
+
+        :param ws: websocket
+        :param messages: list of message dicts, in arrival order
+        :return: dict of product id -> (last message, order book) of the batch's products in this process
+
+        """
+        batch = []
+        for message in messages:
+            if self._check_sequence(ws, message):
+                handler = self._handlers.get(message["type"])
+                if handler == self._apply_message:
+                    batch.append(message)
+                    self._record_trade(message)
+                elif handler is not None:
+                    handler(ws, message)
+        if batch:
+            self.books.apply_batch(batch)
+
+        if self._recoveries:
+            self._poll_recoveries(ws)
+        if self.checkpointer is not None:
+            self.checkpointer.maybe_checkpoint(self.books)
+
+        books = {}
+        for message in messages:
+            if "product_id" in message:
+                order_book = self.books.book(message["product_id"])
+                if order_book is not None:
+                    books[message["product_id"]] = (message, order_book)
+        return books
+
+    def warm_start(self, capture_path=None):
+        """
+        restore the order books from the latest checkpoints, then replay the capture file after them
+
+        the products without a checkpoint are skipped by the replay and bootstrapped as usual from the live feed
+
+        :param capture_path: optional capture file recorded alongside the checkpoints
+        :return: dict of product id -> restored sequence, empty without checkpointer
+
+        """
+        from checkpoint import load_into
+        from capture import replay_capture
+
+        restored = {}
+        if self.checkpointer is None:
+            logging.warning("No checkpointer, nothing to warm start from")
+            return restored
+        for product_id in self.product_ids:
+            state = self.checkpointer.latest(product_id)
+            product = self.books.product(product_id)
+            if state is None or product is None:
+                continue
+            load_into(product, state)
+            self.books.sequences[product_id] = state["sequence"]
+            restored[product_id] = state["sequence"]
+            logging.info(f"Restored {product_id} from checkpoint at sequence {state['sequence']}")
+
+        if capture_path is not None and restored:
+            # every product has its own sequences, each one is replayed after its own checkpoint
+            count = replay_capture(capture_path, self, after_sequences=restored)
+            logging.info(f"Replayed {count} captured messages after the checkpoints")
+        return restored
 
     def _check_sequence(self, ws, message: dict):
         """
@@ -88,21 +364,101 @@ class CoinbaseWebsocketClient:
 
         :param ws: websocket
         :param message: incoming json message
+        :return: True if the message should be processed, False if it is stale or buffered for recovery
 
         """
-        full_channel = {"open", "done", "match", "change", "activate", "received"}
-        if message["type"] in full_channel:
+        if message["type"] in self.FULL_CHANNEL:
+            product_id = message["product_id"]
+            if product_id in self._recoveries:
+                self._recoveries[product_id].add(message)
+                # the trade is recorded now, whether the replay after the snapshot keeps the message or not
+                self._record_trade(message)
+                return False
             sequence = message["sequence"]
-            if self.sequence is None:
-                self.sequence = sequence
-            elif sequence <= self.sequence:
-                logging.warning(f"Sequence error: new sequence <= old sequence")
-                return
+            last_sequence = self.books.sequences.get(product_id)
+            if last_sequence is None:
+                if self.snapshot_provider is not None:
+                    self._start_recovery(product_id, message)
+                    return False
+                self.books.sequences[product_id] = sequence
+            elif sequence <= last_sequence:
+                logging.warning(f"Sequence error: {product_id} new sequence <= old sequence")
+                if self.metrics is not None:
+                    self.metrics.duplicate()
+                return False
+            elif sequence - last_sequence != 1:
+                if self.metrics is not None:
+                    self.metrics.gap(sequence - last_sequence - 1)
+                error = f"Sequence error: {product_id} missing {sequence - last_sequence - 1} sequences"
+                if self.snapshot_provider is not None:
+                    logging.warning(f"{error}, recovering from snapshot")
+                    self._start_recovery(product_id, message)
+                    return False
+                self.on_error(ws, error)
             else:
-                if sequence - self.sequence != 1:
-                    self.on_error(ws, f"Sequence error: missing {sequence - self.sequence - 1} sequences")
-                    return
-                self.sequence = sequence
+                self.books.sequences[product_id] = sequence
+        return True
+
+    def _start_recovery(self, product_id, message: dict):
+        """
+        buffer live messages of the product and start fetching its snapshot
+
+        :param product_id: product id
+        :param message: first message to buffer
+
+        """
+        recovery = BookRecovery(product_id, self.snapshot_provider, self.threaded_recovery,
+                                self.MAX_RECOVERY_BUFFER)
+        recovery.add(message)
+        self._record_trade(message)
+        self._recoveries[product_id] = recovery
+        recovery.start()
+
+    def _poll_recoveries(self, ws):
+        """
+        load the fetched snapshots and replay the buffered messages after them, retry the failed fetches
+
+        :param ws: websocket
+        :return: list of the recovered product ids
+
+        """
+        recovered = []
+        for product_id, recovery in list(self._recoveries.items()):
+            if not recovery.done():
+                continue
+            if recovery.snapshot is None:
+                # a failing snapshot endpoint is retried with backoff, not counted as a websocket error
+                if recovery.retry_at is None:
+                    delay = recovery.schedule_retry()
+                    logging.warning(f"Snapshot error: {product_id} {recovery.error}, retrying in {delay:.2f}s")
+                elif time.monotonic() >= recovery.retry_at:
+                    recovery.start()
+                continue
+
+            del self._recoveries[product_id]
+            self.books.load_snapshot(product_id, recovery.snapshot)
+            pending = recovery.pending()
+            if recovery.dropped:
+                logging.warning(f"Recovery buffer of {product_id} full, dropped the {recovery.dropped} oldest messages")
+            logging.info(f"Recovered {product_id} at sequence {recovery.snapshot['sequence']}, "
+                         f"replaying {len(pending)} buffered messages")
+            for message in pending:
+                if self._check_sequence(ws, message):
+                    self._process_message(ws, message)
+            recovered.append(product_id)
+        return recovered
+
+    def _poll_recoveries_timed(self, ws):
+        """
+        poll the recoveries when no message arrives, and publish the recovered order books
+
+        :param ws: websocket
+
+        """
+        for product_id in self._poll_recoveries(ws):
+            order_book = self.books.book(product_id)
+            if order_book is not None:
+                self._publish({"product_id": product_id}, order_book)
 
     def _process_message(self, ws, message: dict):
         """
@@ -112,37 +468,53 @@ class CoinbaseWebsocketClient:
         :param message: message dict
 
         """
-        if message["type"] == "heartbeat":
-            # if heartbeat is not received for 5 seconds, close websocket
-            if (datetime.datetime.now(tzlocal()) -
-                    self.heartbeat).total_seconds() > 5:
-                logging.warning("Websocket heartbeat timeout")
-                self.close()
-            self.heartbeat = datetime.datetime.now(tzlocal())
-        elif message["type"] == "error":
-            self.on_error(ws, message["message"])
-        elif message["type"] == "open":
-            side = "bid" if message["side"] == "buy" else "ask"
-            self.order_book.insert_order(message["order_id"],
-                                         self._decimal_round(message["remaining_size"]),
-                                         self._decimal_round(message["price"], 2), side)
-        elif message["type"] == "done":
-            side = "bid" if message["side"] == "buy" else "ask"
-            self.order_book.delete_order(message["order_id"], side)
-        elif message["type"] == "change":
-            side = "bid" if message["side"] == "buy" else "ask"
-            if "new_price" in message:
-                self.order_book.change_order_price(message["order_id"],
-                                                   self._decimal_round(message["old_price"], 2),
-                                                   self._decimal_round(message["new_price"], 2), side)
-            if "new_size" in message and message["new_size"] != message["old_size"]:
-                # string comparison, no need to worry about precision
-                self.order_book.change_order_size(message["order_id"],
-                                                  self._decimal_round(message["new_size"]), side)
-        elif message["type"] == "match":
-            order_id = message["maker_order_id"]
-            side = "bid" if message["side"] == "sell" else "ask"
-            self.order_book.match_order(order_id, self._decimal_round(message["size"]), side)
+        handler = self._handlers.get(message["type"])
+        if handler is not None:
+            handler(ws, message)
+
+    def _on_heartbeat(self, ws, message: dict):
+        """
+        process heartbeat message
+
+        :param ws: websocket
+        :param message: message dict
+
+        """
+        # a silent connection is closed by the watchdog, see _watch
+        self.heartbeat = datetime.datetime.now(tzlocal())
+
+    def _on_error_message(self, ws, message: dict):
+        """
+        process error message
+
+        :param ws: websocket
+        :param message: message dict
+
+        """
+        self.on_error(ws, message["message"])
+
+    def _apply_message(self, ws, message: dict):
+        """
+        apply full or level2 channel message to the order book of its product
+
+        :param ws: websocket
+        :param message: message dict
+
+        """
+        self.books.apply(message)
+        self._record_trade(message)
+
+    def _record_trade(self, message: dict):
+        """
+        record the trade of a match message
+
+        :param message: message dict
+
+        """
+        if self.trades is not None and message["type"] == "match":
+            # in fixed point mode the trades are on the grid of the order book
+            product = self.books.product(message["product_id"]) if self.books.fixed_point else None
+            self.trades.add(message, product)
 
     def on_error(self, ws, error: str):
         """
@@ -151,6 +523,10 @@ class CoinbaseWebsocketClient:
         :param error: error message
 
         """
+        if isinstance(error, KeyboardInterrupt):
+            # run_forever passes the interrupt here instead of raising it, stop reconnecting
+            self._closed.set()
+            return
         logging.error(error)
         self.error_count += 1
         if self.error_count > self.MAX_ERROR_COUNT:
@@ -158,25 +534,313 @@ class CoinbaseWebsocketClient:
             ws.close()
 
     def connect(self):
-        """connect websocket"""
+        """connect websocket, blocking until close() is called, or until the connection closes without reconnect"""
         websocket.setdefaulttimeout(5)
-        self.ws = WebSocketApp(
-            self.url,
-            on_open=self.on_open,
-            on_message=self.on_message,
-            on_error=self.on_error,
-            keep_running=True,
-        )
-        self.ws.run_forever()
+        self.books.start()
+        if self.publisher is not None:
+            self.publisher.start()
+        self._closed.clear()
+        self._subscribed.clear()
+        self._connect_thread = threading.current_thread()
+        threading.Thread(target=self._watch, name="websocket-watchdog", daemon=True).start()
+        standby = None
+        if self.standby:
+            standby = threading.Thread(target=self._run_standby, name="websocket-standby", daemon=True)
+            standby.start()
+        try:
+            self._run_connection(0)
+        finally:
+            if standby is not None:
+                self._closed.set()
+                self._close_connections()
+                standby.join()
+            self._connect_thread = None
+
+    def _run_connection(self, connection):
+        """
+        run a connection, reconnecting after a jittered backoff when it closes
+
+        :param connection: 0 for the first connection, 1 for the standby one
+
+        """
+        attempt = 0
+        while not self._closed.is_set():
+            ws = WebSocketApp(
+                self.url,
+                on_open=lambda ws: self._on_connection_open(connection, ws),
+                on_message=lambda ws, message: self._on_connection_message(connection, ws, message),
+                on_error=self.on_error,
+                keep_running=True,
+            )
+            self._connections[connection] = ws
+            if connection == self._primary:
+                self.ws = ws
+            # the select loop wakes up at least every ping_timeout seconds, so that a connection closed from
+            # another thread returns even when its socket is gone before the loop noticed
+            ws.run_forever(ping_timeout=self.HEARTBEAT_TIMEOUT / 4)
+            opened_at = self._opened_at[connection]
+            self._on_connection_closed(connection)
+            if self._closed.is_set() or not self.reconnect:
+                break
+
+            # a connection that stayed up resets the backoff, one dropped right away keeps growing it
+            attempt = 0 if opened_at is not None and time.monotonic() - opened_at > self.HEARTBEAT_TIMEOUT \
+                else attempt + 1
+            delay = self._backoff(attempt)
+            self.reconnects += 1
+            logging.warning(f"Websocket connection {connection} closed, reconnecting in {delay:.2f}s")
+            self._closed.wait(delay)
+
+    def _run_standby(self):
+        """run the standby connection, once the first connection subscribed so that it is the primary one"""
+        self._subscribed.wait(self.HEARTBEAT_TIMEOUT)
+        self._run_connection(1)
+
+    def _backoff(self, attempt):
+        """
+        delay before a reconnect, jittered so that clients dropped together do not reconnect together
+
+        :param attempt: number of reconnects since the connection last stayed up
+        :return: delay in seconds, between half and all of RECONNECT_BACKOFF * 2 ** attempt, capped
+                 by MAX_RECONNECT_BACKOFF
+
+        """
+        delay = min(self.MAX_RECONNECT_BACKOFF, self.RECONNECT_BACKOFF * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def _on_connection_open(self, connection, ws):
+        """
+        connection opened, resubscribe to the channels, and resync the order books after a reconnect
+
+        :param connection: 0 or 1
+        :param ws: websocket
+
+        """
+        if self._closed.is_set():
+            # close() was called while connecting
+            ws.close()
+            return
+        if self._opened_at[self._primary] is None or connection == self._primary:
+            # no other connection kept delivering the messages, resync the order books
+            with self._lock:
+                if self._connected_once:
+                    self._resync()
+                self._primary = connection
+                self.ws = ws
+                self.error_count = 0
+        self._connected_once = True
+        self._seen[connection] = {}
+        self._opened_at[connection] = self._last_message[connection] = time.monotonic()
+        self.on_open(ws)
+        self._subscribed.set()
+
+    def _resync(self):
+        """
+        drop the full channel order books and sequences after the messages were missed while disconnected
+
+        the order books are bootstrapped again from a snapshot, or rebuilt from the live messages without
+        snapshot provider, level2 order books are reloaded from the level2 snapshot of the new subscription
+
+        """
+        product_ids = [product_id for product_id in self.product_ids if not self.books.is_level2(product_id)]
+        for product_id in product_ids:
+            self.books.reset(product_id)
+            self._delivered.pop(product_id, None)
+            self._held.pop(product_id, None)
+            self._held_since.pop(product_id, None)
+            self._recoveries.pop(product_id, None)
+        if not product_ids:
+            return
+        if self.snapshot_provider is None:
+            logging.warning("Websocket reconnected without snapshot provider, the order books are rebuilt from "
+                            "the live messages and miss the orders resting before")
+        else:
+            logging.info("Websocket reconnected, bootstrapping the order books from snapshots")
+
+    def _on_connection_closed(self, connection):
+        """
+        connection closed, the standby connection becomes the primary one if it is open
+
+        :param connection: 0 or 1
+
+        """
+        self._opened_at[connection] = None
+        other = 1 - connection
+        if (connection == self._primary and self.standby and self._opened_at[other] is not None
+                and not self._closed.is_set()):
+            with self._lock:
+                self._primary = other
+                self.ws = self._connections[other]
+                self.error_count = 0
+            self.failovers += 1
+            logging.warning(f"Websocket connection {connection} closed, failed over to connection {other}")
+
+    def _on_connection_message(self, connection, ws, message: str):
+        """
+        on message of a connection
+
+        :param connection: 0 or 1
+        :param ws: websocket
+        :param message: incoming message
+
+        """
+        self._last_message[connection] = time.monotonic()
+        if not self.standby:
+            # the watchdog polls the recoveries holding the lock as well
+            with self._lock:
+                self.on_message(ws, message)
+            return
+
+        with self._lock:
+            start = time.perf_counter_ns() if self.metrics is not None else None
+            raw, message = message, decode_message(message)
+            if self.metrics is not None:
+                self.metrics.observe("parse", time.perf_counter_ns() - start)
+            for raw, message in self._ordered_delivery(connection, raw, message):
+                self._deliver(ws, raw, message)
+
+    def _deliver(self, ws, raw: str, message: dict):
+        """
+        capture, handle and publish a message taken from one of the connections
+
+        :param ws: websocket
+        :param raw: incoming message
+        :param message: message dict
+
+        """
+        if self.capture is not None:
+            self.capture.write(raw)
+        if self.metrics is not None:
+            self._apply_timed(ws, message, time.perf_counter_ns())
+            return
+        order_book = self._handle_message(ws, message)
+        if order_book is not None:
+            self._publish(message, order_book)
+
+    def _ordered_delivery(self, connection, raw: str, message: dict):
+        """
+        merge the messages of both connections into one contiguous stream per product
+
+        full channel messages are deduplicated against the last delivered sequence of their product, and the
+        next sequence is taken from whichever connection delivers it first. A message after a missing sequence
+        is held back while the other connection may still deliver the missing one; the held messages are
+        passed on once it did, or once it passed the missing sequence too, closed, or HOLD_TIMEOUT seconds or
+        MAX_HELD messages are reached, leaving the gap to the sequence check. The other messages carry no
+        sequence and are only taken from the primary connection.
+
+        :param connection: 0 or 1
+        :param raw: incoming message
+        :param message: message dict
+        :return: list of (raw, message) to deliver, in sequence order
+
+        """
+        if message["type"] not in self.FULL_CHANNEL:
+            return [(raw, message)] if connection == self._primary else []
+        product_id, sequence = message["product_id"], message["sequence"]
+        self._seen[connection][product_id] = sequence
+        delivered = self._delivered.get(product_id)
+        if delivered is None or sequence == delivered + 1:
+            self._delivered[product_id] = sequence
+            return [(raw, message)] + self._release(product_id)
+        if sequence <= delivered:
+            return []
+
+        held = self._held.setdefault(product_id, {})
+        if not held:
+            self._held_since[product_id] = time.monotonic()
+        held[sequence] = (raw, message)
+        other = 1 - connection
+        if (self._opened_at[other] is None or self._seen[other].get(product_id, delivered) > delivered
+                or len(held) > self.MAX_HELD):
+            return self._release(product_id, gap=True)
+        return []
+
+    def _release(self, product_id, gap=False):
+        """
+        take the held messages of a product which can be delivered
+
+        :param product_id: product id
+        :param gap: give up on the missing sequences and take every held message, default False to take
+                    only the ones contiguous to the last delivered sequence
+        :return: list of (raw, message), in sequence order
+
+        """
+        held = self._held.get(product_id)
+        if not held:
+            return []
+        released = []
+        if gap:
+            for sequence in sorted(held):
+                released.append(held[sequence])
+            self._delivered[product_id] = sequence
+            held.clear()
+        else:
+            sequence = self._delivered[product_id] + 1
+            while sequence in held:
+                released.append(held.pop(sequence))
+                self._delivered[product_id] = sequence
+                sequence += 1
+        if held:
+            self._held_since[product_id] = time.monotonic()
+        return released
+
+    def _release_expired(self):
+        """deliver the messages held for longer than HOLD_TIMEOUT seconds, called with the lock held"""
+        now = time.monotonic()
+        for product_id, held in list(self._held.items()):
+            if held and now - self._held_since[product_id] > self.HOLD_TIMEOUT:
+                logging.warning(f"Sequence {self._delivered[product_id] + 1} of {product_id} missing on both "
+                                f"connections")
+                for raw, message in self._release(product_id, gap=True):
+                    self._deliver(self.ws, raw, message)
+
+    def _watch(self):
+        """
+        watchdog, close the connections that received no message for HEARTBEAT_TIMEOUT seconds, and poll
+        the recoveries and the held standby messages every RECOVERY_POLL_INTERVAL seconds so that they
+        complete without new messages
+
+        """
+        while not self._closed.wait(self.RECOVERY_POLL_INTERVAL):
+            if self._recoveries:
+                with self._lock:
+                    self._poll_recoveries_timed(self.ws)
+            if self._held:
+                with self._lock:
+                    self._release_expired()
+            now = time.monotonic()
+            for connection, ws in enumerate(self._connections):
+                last_message = self._last_message[connection]
+                if self._opened_at[connection] is not None and now - last_message > self.HEARTBEAT_TIMEOUT:
+                    logging.warning(f"Websocket connection {connection} heartbeat timeout, closing it")
+                    self._last_message[connection] = now
+                    # no wait for the close frame a dead connection never answers
+                    ws.close(timeout=0)
+
+    def _close_connections(self):
+        """close the open websockets"""
+        for ws in self._connections:
+            if ws is not None:
+                ws.close()
 
     def close(self):
-        """close websocket"""
+        """close websocket, then the order books, the publisher and the capture once no message is handled"""
+        self._closed.set()
         if self.ws:
-            self.ws.close()
+            self._close_connections()
             self.ws = None
             logging.info("Websocket closed")
+        connect_thread = self._connect_thread
+        if connect_thread is not None and connect_thread is not threading.current_thread():
+            connect_thread.join(self.HEARTBEAT_TIMEOUT)
+        self.books.stop()
+        if self.publisher is not None:
+            self.publisher.stop()
+        if self.capture is not None:
+            self.capture.close()
 
 
 if __name__ == "__main__":
+    setup_logging()
     websocket_client = CoinbaseWebsocketClient()
     websocket_client.connect()
@@ -0,0 +1,111 @@
+import json
+import logging
+import urllib.request
+from decimal import Decimal, ROUND_HALF_EVEN
+
+# (quote increment, base increment) of the products, used as price tick size and size increment.
+# Only a fallback when no increments are given, see fetch_increments for the exchange's product
+# metadata; other products get DEFAULT_INCREMENTS, which is wrong for products with other increments
+PRODUCT_INCREMENTS = {
+    "BTC-USD": ("0.01", "0.00000001"),
+    "ETH-USD": ("0.01", "0.00000001"),
+}
+DEFAULT_INCREMENTS = ("0.01", "0.00000001")
+
+
+class FixedPoint:
+    """
+    Scaled integer representation of decimal numbers
+
+    A number is stored as an int counting units of 10 ** -places, e.g. with increment "0.01"
+    the price "18882.2" is stored as 1888220. Ints are parsed straight from the feed strings,
+    so no Decimal is built on the message processing path.
+
+    """
+    def __init__(self, increment):
+        """
+        initialize fixed point scale
+
+        :param increment: smallest increment as a decimal string, e.g. "0.01"
+
+        """
+        self.increment = increment
+        self.places = max(0, -Decimal(increment).as_tuple().exponent)
+        self.scale = 10 ** self.places
+
+    def parse(self, num: str):
+        """
+        parse a decimal string into a scaled int, a number off the increment grid is rounded half to even
+        as Decimal.quantize does
+
+        :param num: decimal string, e.g. "18882.2"
+        :return: scaled int
+
+        """
+        whole, _, fraction = num.partition(".")
+        if len(fraction) != self.places:
+            if len(fraction) > self.places and fraction[self.places:].strip("0"):
+                return self.from_decimal(num)
+            fraction = fraction[:self.places].ljust(self.places, "0")
+        return int(whole + fraction)
+
+    def to_decimal(self, value):
+        """
+        convert a scaled int back to Decimal
+
+        :param value: scaled int
+        :return: Decimal with the increment's number of decimal places
+
+        """
+        return Decimal(value).scaleb(-self.places)
+
+    def from_decimal(self, value):
+        """
+        convert a Decimal, int or decimal string to a scaled int, rounded half to even
+
+        :param value: number
+        :return: scaled int
+
+        """
+        return int(Decimal(value).scaleb(self.places).to_integral_value(ROUND_HALF_EVEN))
+
+
+def product_scales(product_id, increments=None):
+    """
+    fixed point price and size scales of a product
+
+    :param product_id: product id, e.g. "BTC-USD"
+    :param increments: optional dict of product id -> (quote increment, base increment),
+                       e.g. from fetch_increments, overriding PRODUCT_INCREMENTS
+    :return: tuple of (price FixedPoint, size FixedPoint)
+
+    """
+    if increments and product_id in increments:
+        price_increment, size_increment = increments[product_id]
+    elif product_id in PRODUCT_INCREMENTS:
+        price_increment, size_increment = PRODUCT_INCREMENTS[product_id]
+    else:
+        logging.warning(f"No increments of {product_id}, falling back to {DEFAULT_INCREMENTS}")
+        price_increment, size_increment = DEFAULT_INCREMENTS
+    return FixedPoint(price_increment), FixedPoint(size_increment)
+
+
+def fetch_increments(product_ids, url=None, timeout=10):
+    """
+    fetch the increments of products from the Coinbase Exchange REST API product metadata
+
+    :param product_ids: list of product ids
+    :param url: REST API url, default Coinbase Exchange REST API
+    :param timeout: request timeout in seconds, default 10
+    :return: dict of product id -> (quote increment, base increment), the increments argument of the clients
+
+    """
+    url = "https://api.exchange.coinbase.com" if not url else url.rstrip("/")
+    increments = {}
+    for product_id in product_ids:
+        request = urllib.request.Request(f"{url}/products/{product_id}",
+                                         headers={"User-Agent": "coinbase-l2-orderbook"})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            product = json.loads(response.read())
+        increments[product_id] = (product["quote_increment"], product["base_increment"])
+    return increments
@@ -1,6 +1,13 @@
-from coinbase_websocket_client import CoinbaseWebsocketClient
+from coinbase_websocket_client import CoinbaseWebsocketClient, setup_logging
+from publisher import BookPublisher
+from recovery import HttpSnapshotProvider
 
 if __name__ == "__main__":
-    websocket_client = CoinbaseWebsocketClient()
-    websocket_client.connect()
-    websocket_client.close()
+    setup_logging()
+    # reconnects until interrupted, resyncing the order book from a REST snapshot after a sequence gap
+    websocket_client = CoinbaseWebsocketClient(publisher=BookPublisher(mode=BookPublisher.INTERVAL, interval=0.5),
+                                               snapshot_provider=HttpSnapshotProvider())
+    try:
+        websocket_client.connect()
+    finally:
+        websocket_client.close()
@@ -0,0 +1,40 @@
+import re
+import json
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    orjson = None
+    loads = json.loads
+
+# full channel message types not changing the order book, only their sequence is needed
+IGNORED_TYPES = frozenset({"received", "activate"})
+
+_TYPE = re.compile(r'"type"\s*:\s*"([^"]*)"')
+_PRODUCT_ID = re.compile(r'"product_id"\s*:\s*"([^"]*)"')
+_SEQUENCE = re.compile(r'"sequence"\s*:\s*(\d+)')
+
+
+def decode_message(raw: str):
+    """
+    decode a websocket message
+
+    received and activate messages are not parsed, only their type, product id and sequence are
+    extracted, every other message is parsed with orjson when it is installed, else with json;
+    the type is only searched in the frames containing one of the quoted ignored types
+
+    :param raw: incoming message
+    :return: message dict
+
+    """
+    # substring searches are cheaper than the type regex, which only runs on the candidate frames
+    if '"received"' in raw or '"activate"' in raw:
+        match = _TYPE.search(raw)
+        if match is not None and match.group(1) in IGNORED_TYPES:
+            product_id = _PRODUCT_ID.search(raw)
+            sequence = _SEQUENCE.search(raw)
+            if product_id is not None and sequence is not None:
+                return {"type": match.group(1), "product_id": product_id.group(1),
+                        "sequence": int(sequence.group(1))}
+    return loads(raw)
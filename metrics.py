@@ -0,0 +1,274 @@
+import json
+import time
+import logging
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# message processing stages, timed in ns, receive is the wait from the frame being read off the
+# websocket to its processing, only known to the AsyncCoinbaseClient
+STAGES = ("receive", "parse", "sequence", "apply", "publish")
+
+
+def parse_time_ns(text):
+    """
+    parse the exchange timestamp of a message
+
+    :param text: ISO 8601 UTC timestamp, e.g. "2022-09-26T03:10:27.067787Z"
+    :return: ns since epoch
+
+    """
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
+    moment = datetime.datetime.fromisoformat(text)
+    return int(moment.timestamp()) * 1000000000 + moment.microsecond * 1000
+
+
+class Histogram:
+    """Histogram of non-negative ns values with power of 2 buckets"""
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self):
+        # counts[i] counts the values 2 ** (i - 1) < v <= 2 ** i, and 0 and 1 for i == 0, so 2 ** i
+        # is the inclusive upper bound of the bucket, as the Prometheus le label
+        self.counts = [0] * 65
+        self.count = 0
+        self.total = 0
+
+    def record(self, value):
+        """
+        record a value
+
+        :param value: value in ns, negative values are recorded as 0
+
+        """
+        if value < 0:
+            value = 0
+        self.counts[min((value - 1).bit_length() if value else 0, 64)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        """
+        approximate quantile
+
+        :param q: quantile, 0 to 1
+        :return: upper bound of the bucket holding the quantile, 0 if empty
+
+        """
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return 2 ** i
+        return 2 ** 64
+
+
+class Metrics:
+    """
+    Hot path latency and message counters of the websocket client
+
+    Stage timings, message type counters, sequence gaps, dropped duplicates and the lag between
+    the exchange timestamp and the local apply time. Clients only touch it when it is passed in,
+    so disabled instrumentation costs a single None check per message.
+
+    """
+
+    def __init__(self):
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.exchange_lag = Histogram()
+        self.message_types = {}
+        self.sequence_gaps = 0
+        self.missing_sequences = 0
+        self.duplicates = 0
+
+    def observe(self, stage, elapsed_ns):
+        """
+        record the time spent in a stage
+
+        :param stage: stage name, see STAGES
+        :param elapsed_ns: elapsed ns
+
+        """
+        self.stages[stage].record(elapsed_ns)
+
+    def message(self, message: dict, applied_ns=None):
+        """
+        count a message, and record its exchange lag when it has a timestamp
+
+        :param message: message dict
+        :param applied_ns: local apply time in ns since epoch, default now
+
+        """
+        message_type = message["type"]
+        self.message_types[message_type] = self.message_types.get(message_type, 0) + 1
+        if "time" in message:
+            applied_ns = time.time_ns() if applied_ns is None else applied_ns
+            self.exchange_lag.record(applied_ns - parse_time_ns(message["time"]))
+
+    def gap(self, missing):
+        """
+        count a sequence gap
+
+        :param missing: number of missing sequences
+
+        """
+        self.sequence_gaps += 1
+        self.missing_sequences += missing
+
+    def duplicate(self):
+        """count a dropped duplicate or stale message"""
+        self.duplicates += 1
+
+    def snapshot(self):
+        """
+        :return: dict of the current metrics, latencies as count, mean, p50 and p99 in ns
+
+        """
+        def summary(histogram):
+            return {"count": histogram.count,
+                    "mean_ns": histogram.total // histogram.count if histogram.count else 0,
+                    "p50_ns": histogram.quantile(0.5),
+                    "p99_ns": histogram.quantile(0.99)}
+
+        return {"stages": {stage: summary(histogram) for stage, histogram in self.stages.items()},
+                "exchange_lag": summary(self.exchange_lag),
+                "message_types": dict(self.message_types),
+                "sequence_gaps": self.sequence_gaps,
+                "missing_sequences": self.missing_sequences,
+                "duplicates": self.duplicates}
+
+    def render_prometheus(self):
+        """
+        :return: metrics in the Prometheus text exposition format
+
+        """
+        lines = ["# TYPE orderbook_stage_latency_nanoseconds histogram"]
+        for stage, histogram in self.stages.items():
+            lines.extend(self._histogram_lines("orderbook_stage_latency_nanoseconds", histogram, f'stage="{stage}",'))
+        lines.append("# TYPE orderbook_exchange_lag_nanoseconds histogram")
+        lines.extend(self._histogram_lines("orderbook_exchange_lag_nanoseconds", self.exchange_lag, ""))
+        lines.append("# TYPE orderbook_messages_total counter")
+        for message_type, count in sorted(self.message_types.items()):
+            lines.append(f'orderbook_messages_total{{type="{message_type}"}} {count}')
+        lines.append("# TYPE orderbook_sequence_gaps_total counter")
+        lines.append(f"orderbook_sequence_gaps_total {self.sequence_gaps}")
+        lines.append("# TYPE orderbook_missing_sequences_total counter")
+        lines.append(f"orderbook_missing_sequences_total {self.missing_sequences}")
+        lines.append("# TYPE orderbook_duplicates_total counter")
+        lines.append(f"orderbook_duplicates_total {self.duplicates}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _histogram_lines(name, histogram, labels):
+        """
+        Prometheus lines of a histogram, only up to the highest non-empty bucket
+
+        :param name: metric name
+        :param histogram: Histogram
+        :param labels: extra labels, ending with a comma
+        :return: list of lines
+
+        """
+        counts = list(histogram.counts)
+        last = max((i for i, count in enumerate(counts) if count), default=0)
+        lines = []
+        cumulative = 0
+        for i in range(last + 1):
+            cumulative += counts[i]
+            lines.append(f'{name}_bucket{{{labels}le="{2 ** i}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {histogram.count}')
+        labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+        lines.append(f"{name}_sum{labels} {histogram.total}")
+        lines.append(f"{name}_count{labels} {histogram.count}")
+        return lines
+
+
+class PrometheusExporter:
+    """Serve the metrics at http://host:port/metrics in the Prometheus text format"""
+
+    def __init__(self, metrics, host="127.0.0.1", port=9100):
+        """
+        initialize Prometheus exporter
+
+        :param metrics: Metrics
+        :param host: listening host, default "127.0.0.1"
+        :param port: listening port, default 9100, 0 to pick a free port
+
+        """
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def start(self):
+        """start serving on a background thread"""
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._server.server_port
+        threading.Thread(target=self._server.serve_forever, name="metrics-exporter", daemon=True).start()
+        logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    def stop(self):
+        """stop serving"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class PeriodicExporter:
+    """Dump the metrics as json every interval seconds"""
+
+    def __init__(self, metrics, interval=10, sink=None):
+        """
+        initialize periodic exporter
+
+        :param metrics: Metrics
+        :param interval: seconds between two dumps, default 10
+        :param sink: callable receiving the json string, default logging.info
+
+        """
+        self.metrics = metrics
+        self.interval = interval
+        self.sink = logging.info if sink is None else sink
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """start dumping on a background thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics-dump", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """stop dumping, after a last dump"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        """dump the metrics until stopped"""
+        while not self._stop.wait(self.interval):
+            self.sink(json.dumps(self.metrics.snapshot()))
+        self.sink(json.dumps(self.metrics.snapshot()))
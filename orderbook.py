@@ -1,21 +1,234 @@
-from collections import deque
+import threading
+from itertools import islice
 from sortedcontainers import SortedDict
-from decimal import Decimal
 
 
-class OrderBook:
-    """L2 order book"""
+class _Level(dict):
+    """price level, an insertion-ordered dict of order id -> size, so orders keep FIFO order"""
+    __slots__ = ("price",)
 
-    def __init__(self):
+    def __init__(self, price):
+        super().__init__()
+        self.price = price
+
+
+class BaseOrderBook:
+    """
+    Read API shared by the order books
+
+    Subclasses keep _price_level, a dict of side -> sorted dict keyed by price, and _level_size,
+    a dict of side -> dict of price -> aggregate size of the price level.
+
+    The book is not thread safe. The BookManager holds lock while it changes the book, other threads
+    reading the book, e.g. the BookPublisher, hold it as well.
+
+    """
+
+    def __init__(self, price_scale=None, size_scale=None):
         """
         initialize order book
 
-        _price_level: dict of sorted dict, key is price, value is list of order id
-        _orders: dict of orders dict, key is order id, value is list of [size, price]
+        prices and sizes are stored as given, e.g. Decimal. With fixed point scales they are
+        scaled ints, and are converted back to Decimal only by the read methods.
+
+        :param price_scale: optional FixedPoint of the prices
+        :param size_scale: optional FixedPoint of the sizes
+
+        """
+        self._level_listeners = []
+        self.lock = threading.Lock()
+
+        self.price_scale = price_scale
+        self.size_scale = size_scale
+        self._price_out = price_scale.to_decimal if price_scale else _identity
+        self._size_out = size_scale.to_decimal if size_scale else _identity
+
+    def add_level_listener(self, listener):
+        """
+        call a listener whenever the aggregate size of a price level changes
+
+        :param listener: callable receiving (side, price, size) as stored, e.g. scaled ints in fixed
+                         point mode, size is 0 when the price level is removed
+
+        """
+        self._level_listeners.append(listener)
+
+    def remove_level_listener(self, listener):
+        """
+        stop calling a level listener
+
+        :param listener: listener added by add_level_listener
+
+        """
+        self._level_listeners.remove(listener)
+
+    def _level_changed(self, side, price):
+        """
+        call the level listeners with the current aggregate size of a price level
+
+        :param side: "bid" or "ask"
+        :param price: price level
+
+        """
+        size = self._level_size[side].get(price, 0)
+        for listener in self._level_listeners:
+            listener(side, price, size)
+
+    def clear(self):
+        """remove every price level"""
+        for side in ("bid", "ask"):
+            prices = list(self._level_size[side]) if self._level_listeners else ()
+            self._price_level[side].clear()
+            self._level_size[side].clear()
+            for price in prices:
+                self._level_changed(side, price)
+
+    def best_bid(self):
+        """
+        best bid price and aggregate size
+
+        :return: tuple of (price, size), None if there is no bid
+
+        """
+        if not self._price_level["bid"]:
+            return None
+        price = self._price_level["bid"].keys()[-1]
+        return self._price_out(price), self._size_out(self._level_size["bid"][price])
+
+    def best_ask(self):
+        """
+        best ask price and aggregate size
+
+        :return: tuple of (price, size), None if there is no ask
+
+        """
+        if not self._price_level["ask"]:
+            return None
+        price = self._price_level["ask"].keys()[0]
+        return self._price_out(price), self._size_out(self._level_size["ask"][price])
+
+    def spread(self):
+        """
+        difference between best ask price and best bid price
+
+        :return: spread, None if either side is empty
+
+        """
+        if not self._price_level["bid"] or not self._price_level["ask"]:
+            return None
+        return self._price_out(self._price_level["ask"].keys()[0] - self._price_level["bid"].keys()[-1])
+
+    def top_levels(self, side="bid", k=5):
+        """
+        k best aggregated price levels of one side
+
+        :param side: "bid" or "ask", default "bid"
+        :param k: number of price levels, default 5
+        :return: list of (price, size), best price first
+
+        """
+        price_out, size_out = self._price_out, self._size_out
+        return [(price_out(price), size_out(size)) for price, size in islice(self.iter_levels(side), k)]
+
+    def iter_levels(self, side="bid"):
+        """
+        every aggregated price level of one side
+
+        :param side: "bid" or "ask", default "bid"
+        :return: generator of (price, size) as stored, e.g. scaled ints in fixed point mode, best price first
 
         """
+        prices = self._price_level[side].keys()
+        if side == "bid":
+            prices = reversed(prices)
+        level_size = self._level_size[side]
+        for price in prices:
+            yield price, level_size[price]
+
+    def level_count(self, side="bid"):
+        """
+        number of price levels of one side
+
+        :param side: "bid" or "ask", default "bid"
+        :return: number of price levels
+
+        """
+        return len(self._level_size[side])
+
+    def level_out(self, price, size):
+        """
+        convert a price level as stored, e.g. passed to the level listeners, to Decimal
+
+        :param price: price as stored
+        :param size: size as stored
+        :return: tuple of (price, size)
+
+        """
+        return self._price_out(price), self._size_out(size)
+
+    def top_orders(self, side="bid", k=5):
+        """
+        k best orders of one side, the aggregated price levels unless the book keeps every order
+
+        :param side: "bid" or "ask", default "bid"
+        :param k: number of orders, default 5
+        :return: list of (size, price), best price first
+
+        """
+        return [(size, price) for price, size in self.top_levels(side, k)]
+
+    def snapshot(self, depth=5):
+        """
+        snapshot of the best bid and ask orders
+
+        :param depth: number of orders per side, default 5
+        :return: dict of side -> list of (size, price), best price first
+
+        """
+        # make sure highest bid < lowest ask
+        spread = self.spread()
+        if spread is not None:
+            assert spread > 0, \
+                f"lowest ask price {self.best_ask()[0]} is not greater than highest bid price {self.best_bid()[0]}"
+
+        return {"ask": self.top_orders("ask", depth), "bid": self.top_orders("bid", depth)}
+
+    def print_price(self):
+        """
+        print 5 best bid and ask price and size
+        """
+        print(format_snapshot(self.snapshot()), end="")
+
+
+class OrderBook(BaseOrderBook):
+    """L3 order book, keeping every resting order"""
+
+    def __init__(self, price_scale=None, size_scale=None):
+        """
+        initialize order book
+
+        :param price_scale: optional FixedPoint of the prices
+        :param size_scale: optional FixedPoint of the sizes
+
+        _price_level: dict of sorted dict, key is price, value is the _Level dict of order id -> size
+        _level_size: dict of dict, key is price, value is the aggregate size of the price level
+        _orders: dict of orders dict, key is order id, value is the _Level of the order
+
+        a resting order is only two dict entries, its size in its level and its level in _orders,
+        there is no per order container for the garbage collector to track, and the orders of a
+        level share the level's price
+
+        """
+        super().__init__(price_scale, size_scale)
         self._orders = {"bid": {}, "ask": {}}
         self._price_level = {"bid": SortedDict(), "ask": SortedDict()}
+        self._level_size = {"bid": {}, "ask": {}}
+
+    def clear(self):
+        """remove every order and price level"""
+        super().clear()
+        for side in ("bid", "ask"):
+            self._orders[side].clear()
 
     def _insert_price_level(self, price, side="bid"):
         """
@@ -23,10 +236,35 @@ class OrderBook:
 
         :param price: price level
         :param side: "bid" or "ask", default "bid"
+        :return: _Level of the price
 
         """
-        if price not in self._price_level[side]:
-            self._price_level[side][price] = []
+        level = self._price_level[side].get(price)
+        if level is None:
+            level = self._price_level[side][price] = _Level(price)
+            self._level_size[side][price] = 0
+        return level
+
+    def _remove_from_price_level(self, order_id, level, side="bid", notify=True):
+        """
+        unlink order from its price level, drop the level if it becomes empty
+
+        :param order_id: order id
+        :param level: _Level of the order
+        :param side: "bid" or "ask", default "bid"
+        :param notify: call the level listeners, default True
+        :return: order size
+
+        """
+        size = level.pop(order_id)
+        if not level:
+            del self._price_level[side][level.price]
+            del self._level_size[side][level.price]
+        else:
+            self._level_size[side][level.price] -= size
+        if notify and self._level_listeners:
+            self._level_changed(side, level.price)
+        return size
 
     def insert_order(self, order_id, size, price, side="bid"):
         """
@@ -38,10 +276,13 @@ class OrderBook:
         :param side: "bid" or "ask", default "bid"
 
         """
-        self._insert_price_level(price, side)
-        self._price_level[side][price].append(order_id)
+        level = self._insert_price_level(price, side)
+        level[order_id] = size
+        self._level_size[side][price] += size
 
-        self._orders[side][order_id] = [size, price]
+        self._orders[side][order_id] = level
+        if self._level_listeners:
+            self._level_changed(side, price)
 
     def change_order_price(self, order_id, old_price, new_price, side="bid"):
         """
@@ -53,13 +294,18 @@ class OrderBook:
         :param side: "bid" or "ask", default "bid"
 
         """
-        if order_id in self._orders[side]:
-            self._insert_price_level(new_price, side)
-            self._price_level[side][new_price].append(order_id)
-            self._orders[side][order_id][1] = new_price
-            self._price_level[side][old_price].remove(order_id)
-            if not self._price_level[side][old_price]:
-                del self._price_level[side][old_price]
+        level = self._orders[side].get(order_id)
+        if level is not None:
+            size = self._remove_from_price_level(order_id, level, side, notify=False)
+            new_level = self._insert_price_level(new_price, side)
+            new_level[order_id] = size
+            self._level_size[side][new_price] += size
+            self._orders[side][order_id] = new_level
+            # listeners only see the order book once both price levels are updated
+            if self._level_listeners:
+                if level.price != new_price:
+                    self._level_changed(side, level.price)
+                self._level_changed(side, new_price)
 
     def change_order_size(self, order_id, size, side="bid"):
         """
@@ -70,8 +316,12 @@ class OrderBook:
         :param side: "bid" or "ask", default "bid"
 
         """
-        if order_id in self._orders[side]:
-            self._orders[side][order_id][0] = size
+        level = self._orders[side].get(order_id)
+        if level is not None:
+            self._level_size[side][level.price] += size - level[order_id]
+            level[order_id] = size
+            if self._level_listeners:
+                self._level_changed(side, level.price)
 
     def delete_order(self, order_id, side="bid"):
         """
@@ -81,12 +331,9 @@ class OrderBook:
         :param side: "bid" or "ask", default "bid"
 
         """
-        if order_id in self._orders[side]:
-            price = self._orders[side][order_id][1]
-            self._price_level[side][price].remove(order_id)
-            if not self._price_level[side][price]:
-                del self._price_level[side][price]
-            del self._orders[side][order_id]
+        level = self._orders[side].pop(order_id, None)
+        if level is not None:
+            self._remove_from_price_level(order_id, level, side)
 
     def match_order(self, order_id, size, side="bid"):
         """
@@ -97,50 +344,234 @@ class OrderBook:
         :param side: "bid" or "ask", default "bid"
 
         """
-        if order_id in self._orders[side]:
-            original_size = self._orders[side][order_id][0]
+        level = self._orders[side].get(order_id)
+        if level is not None:
+            original_size = level[order_id]
             if original_size == size:
                 self.delete_order(order_id, side)
             elif original_size > size:
                 self.change_order_size(order_id, original_size - size, side)
 
-    def print_price(self):
+    def apply_batch(self, events):
         """
-        print 5 best bid and ask price and size
+        apply a batch of order events, with the same result as calling the methods one by one
+
+        the events of one order are netted first, e.g. an order opened and done within the batch
+        never reaches its price level, then every touched price level is updated once
+
+        :param events: iterable of (method name, *method args), e.g. ("insert_order", order_id, size, price, side),
+                       ("change_order_price", order_id, old_price, new_price, side),
+                       ("change_order_size", order_id, size, side), ("delete_order", order_id, side)
+                       or ("match_order", order_id, size, side)
+
         """
-        ask, bid = 5, 5
-        ask_stack = deque()
-        for i in range(len(self._price_level["ask"])):
-            _, ids = self._price_level["ask"].peekitem(i)
-            num = min(ask, len(ids))
-            for order_id in ids[:num]:
-                ask_stack.appendleft(f"{self._orders['ask'][order_id][0]}@{self._orders['ask'][order_id][1]}")
-            ask -= num
-            if ask <= 0:
-                break
+        # key is (side, order_id), value is the netted [size, price], None if the order is gone
+        current = {}
+        # _Level of the touched orders before the batch, None if they were not on the book
+        original = {}
+        # orders (re)inserted at the back of their price level, in insertion order
+        appended = {}
 
-        # make sure highest bid < lowest ask
-        lowest_ask = ask_stack[-1].split("@")[1] if ask_stack else None
-        highest_bid = self._price_level["bid"].peekitem(0)[0] if self._price_level["bid"] else None
-
-        if lowest_ask and highest_bid:
-            assert Decimal(lowest_ask) > Decimal(highest_bid), \
-                f"lowest ask price {lowest_ask} is not greater than highest bid price {highest_bid}"
-
-        # print out 5 best bid and ask price and size
-        for i in range(len(ask_stack)):
-            print(f"{ask_stack[0]}")
-            ask_stack.popleft()
-
-        print("----------------------")
-
-        for i in range(len(self._price_level["bid"])):
-            _, ids = self._price_level["bid"].peekitem(len(self._price_level["bid"]) - i - 1)
-            num = min(bid, len(ids))
-            for order_id in ids[:num]:
-                print(f"{self._orders['bid'][order_id][0]}@{self._orders['bid'][order_id][1]}")
-            bid -= num
-            if bid <= 0:
+        for event in events:
+            action, order_id, side = event[0], event[1], event[-1]
+            key = side, order_id
+            if key in current:
+                order = current[key]
+            else:
+                level = original[key] = self._orders[side].get(order_id)
+                order = current[key] = [level[order_id], level.price] if level is not None else None
+
+            if action == "insert_order":
+                current[key] = [event[2], event[3]]
+                appended.pop(key, None)
+                appended[key] = True
+            elif order is None:
+                continue
+            elif action == "delete_order":
+                current[key] = None
+                appended.pop(key, None)
+            elif action == "change_order_size":
+                order[0] = event[2]
+            elif action == "change_order_price":
+                order[1] = event[3]
+                appended.pop(key, None)
+                appended[key] = True
+            elif action == "match_order":
+                if order[0] == event[2]:
+                    current[key] = None
+                    appended.pop(key, None)
+                elif order[0] > event[2]:
+                    order[0] -= event[2]
+            else:
+                raise ValueError(f"unknown order book event {action}")
+
+        # aggregate size change of each touched price level, key is (side, price)
+        deltas = {}
+        for key, order in current.items():
+            side, order_id = key
+            level = original[key]
+            if level is not None:
+                price = level.price
+                if order is None or key in appended:
+                    deltas[side, price] = deltas.get((side, price), 0) - level.pop(order_id)
+                else:
+                    deltas[side, price] = deltas.get((side, price), 0) + order[0] - level[order_id]
+                    level[order_id] = order[0]
+            if order is None:
+                self._orders[side].pop(order_id, None)
+
+        for key in appended:
+            side, order_id = key
+            size, price = current[key]
+            level = self._price_level[side].get(price)
+            if level is None:
+                level = self._price_level[side][price] = _Level(price)
+                self._level_size[side][price] = 0
+            level[order_id] = size
+            self._orders[side][order_id] = level
+            deltas[side, price] = deltas.get((side, price), 0) + size
+
+        for (side, price), delta in deltas.items():
+            if self._price_level[side][price]:
+                self._level_size[side][price] += delta
+            else:
+                del self._price_level[side][price]
+                del self._level_size[side][price]
+        # listeners only see the order book once every price level is updated
+        if self._level_listeners:
+            for side, price in deltas:
+                self._level_changed(side, price)
+
+    def top_orders(self, side="bid", k=5):
+        """
+        k best individual orders of one side
+
+        :param side: "bid" or "ask", default "bid"
+        :param k: number of orders, default 5
+        :return: list of (size, price), best price first and FIFO within a price level
+
+        """
+        levels = self._price_level[side].values()
+        if side == "bid":
+            levels = reversed(levels)
+        price_out, size_out = self._price_out, self._size_out
+        top = []
+        for level in levels:
+            price = price_out(level.price)
+            for size in islice(level.values(), k - len(top)):
+                top.append((size_out(size), price))
+            if len(top) >= k:
                 break
+        return top
+
+    def level_orders(self, price, side="bid"):
+        """
+        copy of the orders of one price level
+
+        :param price: price level as stored, e.g. a scaled int in fixed point mode
+        :param side: "bid" or "ask", default "bid"
+        :return: dict of order id -> size in FIFO order, empty if there is no such price level
+
+        """
+        level = self._price_level[side].get(price)
+        return level.copy() if level is not None else {}
+
+    def copy_levels(self, side="bid"):
+        """
+        copy of the orders of every price level of one side
+
+        :param side: "bid" or "ask", default "bid"
+        :return: dict of price -> dict of order id -> size in FIFO order, in no particular price order
+
+        """
+        # iterating the SortedDict as a plain dict skips keeping the prices sorted
+        return {price: level.copy() for price, level in dict.items(self._price_level[side])}
+
+    def iter_orders(self, side="bid"):
+        """
+        every order of one side, from the lowest price level to the highest and FIFO within a price level
+
+        :param side: "bid" or "ask", default "bid"
+        :return: generator of (order_id, size, price) as stored, e.g. scaled ints in fixed point mode
+
+        """
+        for level in self._price_level[side].values():
+            price = level.price
+            for order_id, size in level.items():
+                yield order_id, size, price
+
+
+class L2OrderBook(BaseOrderBook):
+    """
+    Aggregated order book of the level2 channels, keeping only the size of every price level
+
+    The price levels are a single sorted dict of price -> size per side, which is both
+    _price_level and _level_size, so there is nothing per order to parse, store or collect.
+
+    """
+
+    def __init__(self, price_scale=None, size_scale=None):
+        """
+        initialize level 2 order book
+
+        :param price_scale: optional FixedPoint of the prices
+        :param size_scale: optional FixedPoint of the sizes
+
+        """
+        super().__init__(price_scale, size_scale)
+        self._price_level = {"bid": SortedDict(), "ask": SortedDict()}
+        self._level_size = self._price_level
+
+    def update_level(self, price, size, side="bid"):
+        """
+        set the aggregate size of a price level
+
+        :param price: price level
+        :param size: new aggregate size, 0 to remove the price level
+        :param side: "bid" or "ask", default "bid"
+
+        """
+        levels = self._price_level[side]
+        if size:
+            levels[price] = size
+        elif price in levels:
+            del levels[price]
+        else:
+            return
+        if self._level_listeners:
+            self._level_changed(side, price)
+
+    def apply_batch(self, events):
+        """
+        apply a batch of level updates, only the last size of each price level is written
+
+        :param events: iterable of ("update_level", price, size, side)
+
+        """
+        latest = {}
+        for action, price, size, side in events:
+            if action != "update_level":
+                raise ValueError(f"unknown order book event {action}")
+            latest[side, price] = size
+        for (side, price), size in latest.items():
+            self.update_level(price, size, side)
+
+
+def _identity(value):
+    """return the value unchanged"""
+    return value
+
+
+def format_snapshot(snapshot):
+    """
+    format an order book snapshot, asks from the highest to the lowest price above the bids
+
+    :param snapshot: dict of side -> list of (size, price), best price first, and optional "product_id"
+    :return: formatted string
 
-        print("\n\n")
+    """
+    lines = [snapshot["product_id"]] if "product_id" in snapshot else []
+    lines.extend(f"{size}@{price}" for size, price in reversed(snapshot["ask"]))
+    lines.append("----------------------")
+    lines.extend(f"{size}@{price}" for size, price in snapshot["bid"])
+    return "\n".join(lines) + "\n\n\n\n"
@@ -1,9 +1,88 @@
 import io
+import os
+import argparse
 import json
+import time
+import random
+import asyncio
+import tempfile
+import threading
+import urllib.request
 import unittest.mock
+import numpy as np
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from decimal import Decimal
-from orderbook import OrderBook
+from orderbook import OrderBook, L2OrderBook
 from coinbase_websocket_client import CoinbaseWebsocketClient
+from publisher import BookPublisher
+from fixed_point import FixedPoint, fetch_increments, product_scales
+from book_manager import BookManager
+from recovery import BookRecovery, SnapshotProvider, FileSnapshotProvider, HttpSnapshotProvider
+from async_client import AsyncCoinbaseWebsocketClient
+from message_decoder import decode_message
+from capture import CaptureWriter, read_capture, replay_capture
+from checkpoint import Checkpointer, dump_book, load_book, load_into
+import benchmark
+from analytics import BookAnalytics
+from book_diffs import BookDiffStream
+from trades import Trade, TradeRecorder, ProductTrades
+from shared_book import SharedBookPublisher, SharedBookReader
+from metrics import Histogram, Metrics, PrometheusExporter, parse_time_ns
+
+
+def price_levels(orderbook, side):
+    """
+    helper function for reading the FIFO order ids of every price level
+    :param orderbook: order book
+    :param side: "bid" or "ask"
+
+    """
+    return {price: list(ids) for price, ids in orderbook._price_level[side].items()}
+
+
+def resting_orders(orderbook, side):
+    """
+    helper function for reading every resting order as order id -> [size, price]
+    :param orderbook: order book
+    :param side: "bid" or "ask"
+
+    """
+    return {order_id: [size, price] for order_id, size, price in orderbook.iter_orders(side)}
+
+
+def level3_snapshot(messages):
+    """
+    helper function building the level 3 snapshot after full channel messages
+    :param messages: list of message dicts
+    :return: snapshot dict
+
+    """
+    books = BookManager(["BTC-USD"])
+    for message in messages:
+        if "side" in message:
+            books.apply(message)
+    order_book = books.book("BTC-USD")
+    snapshot = {"sequence": [message for message in messages if "sequence" in message][-1]["sequence"]}
+    for side, key in (("bid", "bids"), ("ask", "asks")):
+        levels = order_book._price_level[side].items()
+        if side == "bid":
+            levels = reversed(levels)
+        snapshot[key] = [[str(price), str(size), order_id]
+                         for price, level in levels for order_id, size in level.items()]
+    return snapshot
+
+
+def read_shared_book(name, product_id, results):
+    """
+    helper function reading a shared book in another process
+    :param name: shared memory segment name
+    :param product_id: product id
+    :param results: queue receiving the snapshot
+
+    """
+    reader = SharedBookReader(name)
+    results.put(reader.read(product_id))
+    reader.close()
 
 
 class TestWebSocket(unittest.TestCase):
@@ -11,48 +90,62 @@ class TestWebSocket(unittest.TestCase):
         """
         test websocket message_process function
         """
-        self.message_helper("test_message_1.json", "0.00989427@18882.20\n"
-                                                   "----------------------\n"
-                                                   "0.02684411@18878.53\n\n\n\n")
-
-        self.message_helper("test_message_2.json", "0.61228293@18895.24\n"
-                                                   "0.10000000@18893.94\n"
-                                                   "0.01256973@18891.92\n"
-                                                   "----------------------\n"
-                                                   "0.61103843@18888.14\n\n\n\n")
-        self.message_helper("test_message_3.json", "0.37980402@18862.79\n"
-                                                   "0.01504935@18862.79\n"
-                                                   "0.02534887@18862.17\n"
-                                                   "0.02534887@18862.03\n"
-                                                   "0.00574054@18861.71\n"
-                                                   "----------------------\n"
-                                                   "0.06000000@18859.46\n"
-                                                   "0.04500000@18859.46\n"
-                                                   "0.00228234@18859.46\n"
-                                                   "0.02196434@18859.08\n"
-                                                   "0.05000000@18859.03\n\n\n\n")
-        self.message_helper("test_message_4.json", "0.01197769@18866.10\n"
-                                                   "0.00828186@18866.10\n"
-                                                   "0.05000000@18866.10\n"
-                                                   "0.00153006@18866.10\n"
-                                                   "0.00254019@18866.10\n"
-                                                   "----------------------\n"
-                                                   "0.00400000@18865.38\n"
-                                                   "0.02097098@18863.69\n"
-                                                   "0.01504935@18863.55\n"
-                                                   "0.10000000@18862.96\n"
-                                                   "0.23726241@18857.63\n\n\n\n")
+        self.messages_helper(fixed_point=False)
+
+    def test_message_fixed_point(self):
+        """
+        test websocket message_process function with fixed point prices and sizes
+        """
+        self.messages_helper(fixed_point=True)
+
+    def messages_helper(self, fixed_point):
+        """
+        helper function running every test message file
+        :param fixed_point: use fixed point prices and sizes
+
+        """
+        self.message_helper("test_message_1.json", fixed_point, "0.00989427@18882.20\n"
+                                                                "----------------------\n"
+                                                                "0.02684411@18878.53\n\n\n\n")
+
+        self.message_helper("test_message_2.json", fixed_point, "0.61228293@18895.24\n"
+                                                                "0.10000000@18893.94\n"
+                                                                "0.01256973@18891.92\n"
+                                                                "----------------------\n"
+                                                                "0.61103843@18888.14\n\n\n\n")
+        self.message_helper("test_message_3.json", fixed_point, "0.37980402@18862.79\n"
+                                                                "0.01504935@18862.79\n"
+                                                                "0.02534887@18862.17\n"
+                                                                "0.02534887@18862.03\n"
+                                                                "0.00574054@18861.71\n"
+                                                                "----------------------\n"
+                                                                "0.06000000@18859.46\n"
+                                                                "0.04500000@18859.46\n"
+                                                                "0.00228234@18859.46\n"
+                                                                "0.02196434@18859.08\n"
+                                                                "0.05000000@18859.03\n\n\n\n")
+        self.message_helper("test_message_4.json", fixed_point, "0.01197769@18866.10\n"
+                                                                "0.00828186@18866.10\n"
+                                                                "0.05000000@18866.10\n"
+                                                                "0.00153006@18866.10\n"
+                                                                "0.00254019@18866.10\n"
+                                                                "----------------------\n"
+                                                                "0.00400000@18865.38\n"
+                                                                "0.02097098@18863.69\n"
+                                                                "0.01504935@18863.55\n"
+                                                                "0.10000000@18862.96\n"
+                                                                "0.23726241@18857.63\n\n\n\n")
 
     @unittest.mock.patch('sys.stdout', new_callable=io.StringIO)
-    def message_helper(self, file_name, expected, mock_stdout):
+    def message_helper(self, file_name, fixed_point, expected, mock_stdout):
         """
         helper function for testing websocket message_process function
         :param file_name: file name of the json message
+        :param fixed_point: use fixed point prices and sizes
         :param expected: expected output
 
         """
-        order_book = OrderBook()
-        client = CoinbaseWebsocketClient(order_book)
+        client = CoinbaseWebsocketClient(fixed_point=fixed_point)
         f = open(file_name, "r")
         messages = json.load(f)
         for message in messages:
@@ -60,6 +153,17 @@ class TestWebSocket(unittest.TestCase):
         client.order_book.print_price()
         self.assertEqual(mock_stdout.getvalue(), expected)
 
+    def test_match_maker_side(self):
+        """
+        Test match message reduces the size of the maker order on the side of the message
+        """
+        client = CoinbaseWebsocketClient()
+        client._process_message(None, {"type": "open", "side": "sell", "order_id": "1", "price": "18858.91",
+                                       "remaining_size": "0.5", "product_id": "BTC-USD"})
+        client._process_message(None, {"type": "match", "side": "sell", "maker_order_id": "1", "taker_order_id": "2",
+                                       "size": "0.2", "price": "18858.91", "product_id": "BTC-USD"})
+        self.assertEqual(client.order_book.best_ask(), (Decimal("18858.91"), Decimal("0.30000000")))
+
 
 class TestOrderBook(unittest.TestCase):
     @unittest.mock.patch('sys.stdout', new_callable=io.StringIO)
@@ -80,19 +184,19 @@ class TestOrderBook(unittest.TestCase):
         orderbook.insert_order("10", size=Decimal("0.0001"), price=Decimal("201.11"), side="ask")
         orderbook.insert_order("11", size=Decimal("0.0001"), price=Decimal("201.12"), side="ask")
 
-        self.assertEqual(orderbook._price_level["bid"], {Decimal("200.01"): ["1", "2", "4"],
+        self.assertEqual(price_levels(orderbook, "bid"), {Decimal("200.01"): ["1", "2", "4"],
                                                          Decimal("200.1"): ["3"], Decimal("201"): ["5"]})
-        self.assertEqual(orderbook._price_level["ask"], {Decimal('201.1'): ['6', '7'],
+        self.assertEqual(price_levels(orderbook, "ask"), {Decimal('201.1'): ['6', '7'],
                                                          Decimal('201.11'): ['9', '10'],
                                                          Decimal('201.12'): ['11'], Decimal('201.2'): ['8']})
 
-        self.assertEqual(orderbook._orders["bid"], {"1": [Decimal("0.0001"), Decimal("200.01")],
+        self.assertEqual(resting_orders(orderbook, "bid"), {"1": [Decimal("0.0001"), Decimal("200.01")],
                                                     "2": [Decimal("0.0001"), Decimal("200.01")],
                                                     "3": [Decimal("0.0001"), Decimal("200.1")],
                                                     "4": [Decimal("0.0001"), Decimal("200.01")],
                                                     "5": [Decimal("0.0001"), Decimal("201")]})
 
-        self.assertEqual(orderbook._orders["ask"], {"6": [Decimal("0.0001"), Decimal("201.1")],
+        self.assertEqual(resting_orders(orderbook, "ask"), {"6": [Decimal("0.0001"), Decimal("201.1")],
                                                     "7": [Decimal("0.0001"), Decimal("201.1")],
                                                     "8": [Decimal("0.0001"), Decimal("201.2")],
                                                     "9": [Decimal("0.0001"), Decimal("201.11")],
@@ -119,13 +223,13 @@ class TestOrderBook(unittest.TestCase):
         orderbook.change_order_price("6", old_price=Decimal("201.1"), new_price=Decimal("203.1"), side="ask")
         orderbook.change_order_size("6", size=Decimal("0.00005"), side="ask")
 
-        self.assertEqual(orderbook._price_level["bid"], {Decimal("200.01"): ["1", "2", "3"]})
-        self.assertEqual(orderbook._price_level["ask"], {Decimal("203.1"): ["6"]})
-        self.assertEqual(orderbook._orders["bid"], {"1": [Decimal("0.0001"), Decimal("200.01")],
+        self.assertEqual(price_levels(orderbook, "bid"), {Decimal("200.01"): ["1", "2", "3"]})
+        self.assertEqual(price_levels(orderbook, "ask"), {Decimal("203.1"): ["6"]})
+        self.assertEqual(resting_orders(orderbook, "bid"), {"1": [Decimal("0.0001"), Decimal("200.01")],
                                                     "2": [Decimal("0.0001"), Decimal("200.01")],
                                                     "3": [Decimal("1"), Decimal("200.01")]})
 
-        self.assertEqual(orderbook._orders["ask"], {"6": [Decimal("0.00005"), Decimal("203.1")]})
+        self.assertEqual(resting_orders(orderbook, "ask"), {"6": [Decimal("0.00005"), Decimal("203.1")]})
 
         orderbook.print_price()
         self.assertEqual(mock_stdout.getvalue(), "0.00005@203.1\n----------------------\n"
@@ -145,17 +249,96 @@ class TestOrderBook(unittest.TestCase):
         orderbook.delete_order("6", side="ask")
         orderbook.insert_order("11", size=Decimal("0.001"), price=Decimal("202.1"), side="ask")
 
-        self.assertEqual(orderbook._price_level["bid"], {Decimal("200.01"): ["2", "3"]})
-        self.assertEqual(orderbook._price_level["ask"], {Decimal("202.1"): ["11"]})
-        self.assertEqual(orderbook._orders["bid"], {"2": [Decimal("0.0001"), Decimal("200.01")],
+        self.assertEqual(price_levels(orderbook, "bid"), {Decimal("200.01"): ["2", "3"]})
+        self.assertEqual(price_levels(orderbook, "ask"), {Decimal("202.1"): ["11"]})
+        self.assertEqual(resting_orders(orderbook, "bid"), {"2": [Decimal("0.0001"), Decimal("200.01")],
                                                     "3": [Decimal("0.0001"), Decimal("200.01")]})
 
-        self.assertEqual(orderbook._orders["ask"], {"11": [Decimal("0.001"), Decimal("202.1")]})
+        self.assertEqual(resting_orders(orderbook, "ask"), {"11": [Decimal("0.001"), Decimal("202.1")]})
 
         orderbook.print_price()
         self.assertEqual(mock_stdout.getvalue(), "0.001@202.1\n----------------------\n"
                                                  "0.0001@200.01\n0.0001@200.01\n\n\n\n")
 
+    def test_level_size(self):
+        """
+        Test per-level aggregate size and FIFO order after unlinking orders
+        """
+        orderbook = OrderBook()
+        orderbook.insert_order("1", size=Decimal("0.1"), price=Decimal("200.01"), side="bid")
+        orderbook.insert_order("2", size=Decimal("0.2"), price=Decimal("200.01"), side="bid")
+        orderbook.insert_order("3", size=Decimal("0.3"), price=Decimal("200.01"), side="bid")
+        orderbook.delete_order("2", side="bid")
+        orderbook.match_order("3", size=Decimal("0.1"), side="bid")
+        orderbook.insert_order("4", size=Decimal("0.4"), price=Decimal("200.01"), side="bid")
+        orderbook.change_order_price("1", old_price=Decimal("200.01"), new_price=Decimal("200.02"), side="bid")
+
+        self.assertEqual(price_levels(orderbook, "bid"), {Decimal("200.01"): ["3", "4"], Decimal("200.02"): ["1"]})
+        self.assertEqual(orderbook._level_size["bid"], {Decimal("200.01"): Decimal("0.6"),
+                                                        Decimal("200.02"): Decimal("0.1")})
+
+        orderbook.match_order("1", size=Decimal("0.1"), side="bid")
+        self.assertEqual(orderbook._level_size["bid"], {Decimal("200.01"): Decimal("0.6")})
+
+    def test_depth(self):
+        """
+        Test aggregated depth view, best bid/ask and spread
+        """
+        orderbook = OrderBook()
+        self.assertIsNone(orderbook.best_bid())
+        self.assertIsNone(orderbook.best_ask())
+        self.assertIsNone(orderbook.spread())
+
+        orderbook.insert_order("1", size=Decimal("0.1"), price=Decimal("200.01"), side="bid")
+        orderbook.insert_order("2", size=Decimal("0.2"), price=Decimal("200.01"), side="bid")
+        orderbook.insert_order("3", size=Decimal("0.3"), price=Decimal("199.5"), side="bid")
+        orderbook.insert_order("4", size=Decimal("0.4"), price=Decimal("201.1"), side="ask")
+        orderbook.insert_order("5", size=Decimal("0.5"), price=Decimal("201.2"), side="ask")
+        orderbook.insert_order("6", size=Decimal("0.6"), price=Decimal("201.1"), side="ask")
+
+        self.assertEqual(orderbook.best_bid(), (Decimal("200.01"), Decimal("0.3")))
+        self.assertEqual(orderbook.best_ask(), (Decimal("201.1"), Decimal("1.0")))
+        self.assertEqual(orderbook.spread(), Decimal("1.09"))
+        self.assertEqual(orderbook.top_levels("bid", 5), [(Decimal("200.01"), Decimal("0.3")),
+                                                          (Decimal("199.5"), Decimal("0.3"))])
+        self.assertEqual(orderbook.top_levels("ask", 1), [(Decimal("201.1"), Decimal("1.0"))])
+
+        orderbook.match_order("4", size=Decimal("0.4"), side="ask")
+        orderbook.change_order_size("6", size=Decimal("0.1"), side="ask")
+        orderbook.delete_order("1", side="bid")
+        orderbook.delete_order("2", side="bid")
+        self.assertEqual(orderbook.best_bid(), (Decimal("199.5"), Decimal("0.3")))
+        self.assertEqual(orderbook.best_ask(), (Decimal("201.1"), Decimal("0.1")))
+
+    def test_apply_batch(self):
+        """
+        Test a netted batch of events gives the same order book as applying them one by one
+        """
+        events = [("insert_order", "1", Decimal("0.1"), Decimal("200.01"), "bid"),
+                  ("insert_order", "2", Decimal("0.2"), Decimal("200.01"), "bid"),
+                  ("insert_order", "3", Decimal("0.3"), Decimal("200.02"), "bid"),
+                  ("insert_order", "4", Decimal("0.4"), Decimal("201.1"), "ask")]
+        batch = [("insert_order", "5", Decimal("0.5"), Decimal("200.03"), "bid"),
+                 ("delete_order", "5", "bid"),
+                 ("change_order_price", "1", Decimal("200.01"), Decimal("200.01"), "bid"),
+                 ("change_order_size", "2", Decimal("0.15"), "bid"),
+                 ("match_order", "2", Decimal("0.05"), "bid"),
+                 ("match_order", "3", Decimal("0.3"), "bid"),
+                 ("insert_order", "6", Decimal("0.6"), Decimal("200.01"), "bid"),
+                 ("match_order", "4", Decimal("0.1"), "ask"),
+                 ("delete_order", "7", "ask")]
+        sequential, batched = OrderBook(), OrderBook()
+        for name, *args in events + batch:
+            getattr(sequential, name)(*args)
+        batched.apply_batch(events)
+        batched.apply_batch(batch)
+
+        self.assertEqual(price_levels(batched, "bid"), {Decimal("200.01"): ["2", "1", "6"]})
+        for side in ("bid", "ask"):
+            self.assertEqual(price_levels(batched, side), price_levels(sequential, side))
+            self.assertEqual(list(batched.iter_orders(side)), list(sequential.iter_orders(side)))
+            self.assertEqual(batched._level_size[side], sequential._level_size[side])
+
     def test_bid_crossover_ask(self):
         """
         Test bid price crossover ask price
@@ -170,5 +353,1242 @@ class TestOrderBook(unittest.TestCase):
             orderbook.print_price()
 
 
+class TestMessageDecoder(unittest.TestCase):
+    def test_decode(self):
+        """
+        Test received messages are only sequenced, other messages are fully parsed
+        """
+        with open("test_message_3.json", "r") as f:
+            messages = json.load(f)
+        for message in messages:
+            for raw in (json.dumps(message), json.dumps(message, separators=(",", ":"))):
+                if message["type"] == "received":
+                    self.assertEqual(decode_message(raw), {"type": "received", "product_id": "BTC-USD",
+                                                           "sequence": message["sequence"]})
+                else:
+                    self.assertEqual(decode_message(raw), message)
+
+
+class TestBookManager(unittest.TestCase):
+    def messages(self):
+        """
+        helper function loading the full channel messages of test_message_3.json,
+        relabeling every message of a sell order as ETH-USD with its own sequence numbers
+        """
+        with open("test_message_3.json", "r") as f:
+            messages = [message for message in json.load(f) if "side" in message]
+        sequences = {"BTC-USD": 100, "ETH-USD": 200}
+        for message in messages:
+            if message["side"] == "sell":
+                message["product_id"] = "ETH-USD"
+            sequences[message["product_id"]] += 1
+            message["sequence"] = sequences[message["product_id"]]
+        return messages
+
+    def test_route(self):
+        """
+        Test messages are routed to the order book and the sequence tracker of their product
+        """
+        messages = self.messages()
+        client = CoinbaseWebsocketClient(products=["BTC-USD", "ETH-USD"])
+        with unittest.mock.patch.object(client, "on_error") as on_error:
+            for message in messages:
+                client._check_sequence(None, message)
+                client._process_message(None, message)
+
+        on_error.assert_not_called()
+        self.assertEqual(client.books.sequences["BTC-USD"],
+                         100 + sum(message["product_id"] == "BTC-USD" for message in messages))
+        self.assertEqual(client.books.sequences["ETH-USD"],
+                         200 + sum(message["product_id"] == "ETH-USD" for message in messages))
+        self.assertEqual(client.books.book("BTC-USD").top_levels("ask"), [])
+        self.assertEqual(client.books.book("ETH-USD").top_levels("bid"), [])
+        self.assertEqual(client.books.book("BTC-USD").best_bid(), (Decimal("18859.46"), Decimal("0.10728234")))
+        self.assertEqual(client.books.book("ETH-USD").best_ask(), (Decimal("18861.71"), Decimal("0.00574054")))
+
+    def test_workers(self):
+        """
+        Test order books spread over worker processes match the order books in this process
+        """
+        messages = self.messages()
+        local_books = BookManager(["BTC-USD", "ETH-USD"])
+        worker_books = BookManager(["BTC-USD", "ETH-USD"], workers=2)
+        try:
+            for message in messages:
+                local_books.apply(message)
+                worker_books.apply(message)
+            self.assertIsNone(worker_books.book("BTC-USD"))
+            for product_id in ("BTC-USD", "ETH-USD"):
+                self.assertEqual(worker_books.top_levels(product_id), local_books.top_levels(product_id))
+        finally:
+            worker_books.stop()
+        with self.assertRaises(ValueError):
+            CoinbaseWebsocketClient(workers=2, publisher=BookPublisher())
+        with tempfile.TemporaryDirectory() as directory, self.assertRaises(ValueError):
+            CoinbaseWebsocketClient(workers=2, checkpointer=Checkpointer(directory))
+
+    def test_apply_batch(self):
+        """
+        Test batches of synthetic messages give the same order books as applying them one by one
+        """
+        messages = benchmark.generate_messages(3000, depth=5, seed=1)
+        for fixed_point in (False, True):
+            sequential = BookManager(["BTC-USD"], fixed_point=fixed_point)
+            batched = BookManager(["BTC-USD"], fixed_point=fixed_point)
+            start = 0
+            for size in (1, 7, 50, 300, 3000):
+                for message in messages[start:start + size]:
+                    sequential.apply(message)
+                batched.apply_batch(messages[start:start + size])
+                start += size
+                for side in ("bid", "ask"):
+                    self.assertEqual(list(batched.book("BTC-USD").iter_orders(side)),
+                                     list(sequential.book("BTC-USD").iter_orders(side)))
+                self.assertEqual(batched.top_levels("BTC-USD", 10), sequential.top_levels("BTC-USD", 10))
+
+
+class TestRecovery(unittest.TestCase):
+    def setUp(self):
+        with open("test_message_3.json", "r") as f:
+            self.messages = [message for message in json.load(f) if "side" in message]
+
+    def reference_book(self, count):
+        """
+        helper function applying the first count messages to a fresh order book
+        :param count: number of messages
+        :return: OrderBook
+
+        """
+        books = BookManager(["BTC-USD"])
+        for message in self.messages[:count]:
+            books.apply(message)
+        return books.book("BTC-USD")
+
+    def snapshot(self, count):
+        """
+        helper function building the level 3 snapshot after the first count messages
+        :param count: number of messages
+        :return: snapshot dict
+
+        """
+        return level3_snapshot(self.messages[:count])
+
+    def assertBookEqual(self, order_book, expected):
+        for side in ("bid", "ask"):
+            self.assertEqual(price_levels(order_book, side), price_levels(expected, side))
+            self.assertEqual(resting_orders(order_book, side), resting_orders(expected, side))
+
+    @unittest.mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_bootstrap(self, mock_stdout):
+        """
+        Test order book bootstrap from a snapshot file, dropping buffered messages before the snapshot
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "{product_id}.json")
+            with open(path.format(product_id="BTC-USD"), "w") as f:
+                json.dump(self.snapshot(100), f)
+
+            client = CoinbaseWebsocketClient(snapshot_provider=FileSnapshotProvider(path), threaded_recovery=False)
+            for message in self.messages[90:]:
+                client.on_message(None, json.dumps(message))
+
+        self.assertEqual(client.books.sequences["BTC-USD"], self.messages[-1]["sequence"])
+        self.assertBookEqual(client.order_book, self.reference_book(len(self.messages)))
+
+    @unittest.mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_gap(self, mock_stdout):
+        """
+        Test recovery after a sequence gap with a snapshot from a stub http server
+        """
+        snapshot = json.dumps(self.snapshot(200)).encode()
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(snapshot)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            provider = HttpSnapshotProvider(f"http://127.0.0.1:{server.server_port}")
+            client = CoinbaseWebsocketClient(snapshot_provider=provider)
+            client.books.sequences["BTC-USD"] = self.messages[0]["sequence"] - 1
+            with unittest.mock.patch.object(client, "on_error") as on_error:
+                # messages 150 to 169 are lost
+                for message in self.messages[:150] + self.messages[170:250]:
+                    client.on_message(None, json.dumps(message))
+                client._recoveries["BTC-USD"]._done.wait(5)
+                for message in self.messages[250:]:
+                    client.on_message(None, json.dumps(message))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        on_error.assert_not_called()
+        self.assertEqual(requests, ["/products/BTC-USD/book?level=3"])
+        self.assertEqual(client._recoveries, {})
+        self.assertBookEqual(client.order_book, self.reference_book(len(self.messages)))
+
+    @unittest.mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_retry(self, mock_stdout):
+        """
+        Test a failed snapshot fetch is retried after its backoff without counting as an error, and the
+        recovery completes from the timer poll without new messages
+        """
+        snapshot = self.snapshot(100)
+        calls = []
+
+        class FlakyProvider(SnapshotProvider):
+            def fetch(self, product_id):
+                calls.append(time.monotonic())
+                if len(calls) < 3:
+                    raise OSError("unavailable")
+                return snapshot
+
+        client = CoinbaseWebsocketClient(snapshot_provider=FlakyProvider(), threaded_recovery=False)
+        with unittest.mock.patch.object(BookRecovery, "RETRY_BACKOFF", 0.05):
+            for message in self.messages[90:150]:
+                client.on_message(None, json.dumps(message))
+            self.assertEqual(len(calls), 1)
+            for _ in range(100):
+                if not client._recoveries:
+                    break
+                time.sleep(0.01)
+                client._poll_recoveries_timed(None)
+
+        self.assertEqual(client.error_count, 0)
+        self.assertEqual(len(calls), 3)
+        self.assertGreaterEqual(calls[2] - calls[1], 0.1)
+        self.assertEqual(client._recoveries, {})
+        self.assertBookEqual(client.order_book, self.reference_book(150))
+
+    def test_buffer_limit(self):
+        """
+        Test the recovery buffer keeps the latest messages
+        """
+        recovery = BookRecovery("BTC-USD", None, max_buffer=3)
+        for sequence in range(5):
+            recovery.add({"sequence": sequence})
+        self.assertEqual(recovery.dropped, 2)
+        self.assertEqual([message["sequence"] for message in recovery.buffer], [2, 3, 4])
+        with self.assertRaises(TypeError):
+            SnapshotProvider()
+
+
+class TestAsyncClient(unittest.TestCase):
+    def run_helper(self, batch_size):
+        """
+        helper function running the asyncio client against a local websocket server replaying test_message_3.json
+        :param batch_size: batch size of the client
+
+        """
+        import websockets
+
+        with open("test_message_3.json", "r") as f:
+            frames = [json.dumps(message) for message in json.load(f)]
+        subscriptions = []
+
+        async def handler(ws, *args):
+            subscriptions.append(json.loads(await ws.recv()))
+            for frame in frames:
+                await ws.send(frame)
+
+        async def run():
+            async with websockets.serve(handler, "127.0.0.1", 0) as server:
+                port = server.sockets[0].getsockname()[1]
+                client = AsyncCoinbaseWebsocketClient(f"ws://127.0.0.1:{port}", queue_size=16, batch_size=batch_size)
+                updates = client.updates(depth=1, maxsize=len(frames))
+                received = []
+
+                async def consume():
+                    async for update in updates:
+                        received.append(update)
+
+                consumer = asyncio.create_task(consume())
+                await client.run()
+                await consumer
+                return client, received
+
+        client, received = asyncio.run(run())
+        self.assertEqual(subscriptions, [{"type": "subscribe", "product_ids": ["BTC-USD"],
+                                          "channels": ["heartbeat", "full"]}])
+        self.assertEqual(received[-1], {"product_id": "BTC-USD", "sequence": json.loads(frames[-1])["sequence"],
+                                        "bid": [(Decimal("18859.46"), Decimal("0.10728234"))],
+                                        "ask": [(Decimal("18861.71"), Decimal("0.00574054"))]})
+        self.assertEqual(client.order_book.top_levels("bid", 1), received[-1]["bid"])
+        return frames, received
+
+    def test_run(self):
+        """
+        Test asyncio client publishing every message
+        """
+        frames, received = self.run_helper(batch_size=1)
+        self.assertEqual(len(received), len(frames) - 1)
+
+    def test_run_batched(self):
+        """
+        Test asyncio client applying the queued messages in batches, published once per batch
+        """
+        frames, received = self.run_helper(batch_size=1000)
+        self.assertLessEqual(len(received), len(frames) - 1)
+        sequences = [update["sequence"] for update in received]
+        self.assertEqual(sequences, sorted(set(sequences)))
+
+
+class TestCapture(unittest.TestCase):
+    def capture_helper(self, file_name):
+        """
+        helper function capturing test_message_3.json through on_message and replaying it
+        :param file_name: capture file name
+
+        """
+        with open("test_message_3.json", "r") as f:
+            frames = [json.dumps(message) for message in json.load(f)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, file_name)
+            client = CoinbaseWebsocketClient(capture=CaptureWriter(path))
+            with unittest.mock.patch('sys.stdout', new_callable=io.StringIO):
+                for frame in frames[:100]:
+                    client.on_message(None, frame)
+            client.capture.close()
+            # appending to an existing capture file
+            capture = CaptureWriter(path)
+            for frame in frames[100:]:
+                capture.write(frame)
+            capture.close()
+
+            records = list(read_capture(path))
+            self.assertEqual([frame for _, frame in records], frames)
+            self.assertEqual(sorted(records), records)
+
+            replayed = CoinbaseWebsocketClient()
+            self.assertEqual(replay_capture(path, replayed), len(frames))
+            self.assertEqual(replayed.books.sequences, {"BTC-USD": json.loads(frames[-1])["sequence"]})
+        return replayed
+
+    def test_capture(self):
+        """
+        Test capturing messages and replaying the memory-mapped capture file
+        """
+        replayed = self.capture_helper("capture.bin")
+        self.assertEqual(replayed.order_book.top_levels("bid", 1), [(Decimal("18859.46"), Decimal("0.10728234"))])
+
+    def test_compressed_capture(self):
+        """
+        Test capturing messages to a gzip compressed file and replaying it
+        """
+        replayed = self.capture_helper("capture.bin.gz")
+        self.assertEqual(replayed.order_book.top_levels("ask", 1), [(Decimal("18861.71"), Decimal("0.00574054"))])
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_round_trip(self):
+        """
+        Test dumping and loading an order book with uuid, empty, long and other order ids, across fixed point modes
+        """
+        books = BookManager(["BTC-USD"])
+        order_book = books.book("BTC-USD")
+        order_book.insert_order("2f8d8b6e-0a3c-4b59-9f2c-2b8f6b3d1f5a", Decimal("0.5"), Decimal("100.01"), "bid")
+        order_book.insert_order("order-2", Decimal("1.25"), Decimal("100.01"), "bid")
+        order_book.insert_order("3", Decimal("2"), Decimal("101.5"), "ask")
+        order_book.insert_order("", Decimal("1"), Decimal("101.5"), "ask")
+        order_book.insert_order("x" * 300, Decimal("1"), Decimal("101.5"), "ask")
+        orders = {side: list(order_book.iter_orders(side)) for side in ("bid", "ask")}
+
+        state = load_book(dump_book("BTC-USD", 42, orders))
+        self.assertEqual((state["product_id"], state["sequence"], state["price_increment"]), ("BTC-USD", 42, None))
+        self.assertEqual({side: state[side] for side in ("bid", "ask")}, orders)
+
+        fixed = BookManager(["BTC-USD"], fixed_point=True)
+        load_into(fixed.product("BTC-USD"), state)
+        fixed_book = fixed.book("BTC-USD")
+        self.assertEqual(list(fixed_book.iter_orders("bid")),
+                         [("2f8d8b6e-0a3c-4b59-9f2c-2b8f6b3d1f5a", 50000000, 10001), ("order-2", 125000000, 10001)])
+
+        # and back to Decimal
+        state = load_book(dump_book("BTC-USD", 42, {side: fixed_book.iter_orders(side) for side in ("bid", "ask")},
+                                    fixed_book.price_scale, fixed_book.size_scale))
+        self.assertEqual(state["price_increment"], "0.01")
+        load_into(books.product("BTC-USD"), state)
+        self.assertEqual({side: list(order_book.iter_orders(side)) for side in ("bid", "ask")}, orders)
+
+    def test_level_copies(self):
+        """
+        Test a checkpoint only copies the changed price levels, and leaves the previous captures unchanged
+        """
+        books = BookManager(["BTC-USD"])
+        books.sequences["BTC-USD"] = 1
+        order_book = books.book("BTC-USD")
+        order_book.insert_order("1", Decimal("0.5"), Decimal("100.01"), "bid")
+        order_book.insert_order("2", Decimal("1.25"), Decimal("100.01"), "bid")
+        order_book.insert_order("3", Decimal("2"), Decimal("101.5"), "ask")
+        with tempfile.TemporaryDirectory() as directory:
+            checkpointer = Checkpointer(directory)
+            first = checkpointer._capture("BTC-USD", order_book)
+            order_book.delete_order("1", "bid")
+            order_book.insert_order("4", Decimal("1"), Decimal("99"), "bid")
+            order_book.delete_order("3", "ask")
+            self.assertEqual(checkpointer._copies["BTC-USD"].changed,
+                             {("bid", Decimal("100.01")), ("bid", Decimal("99")), ("ask", Decimal("101.5"))})
+            second = checkpointer._capture("BTC-USD", order_book)
+
+            self.assertEqual(first, {"bid": {Decimal("100.01"): {"1": Decimal("0.5"), "2": Decimal("1.25")}},
+                                     "ask": {Decimal("101.5"): {"3": Decimal("2")}}})
+            self.assertEqual(second, {"bid": {Decimal("100.01"): {"2": Decimal("1.25")},
+                                              Decimal("99"): {"4": Decimal("1")}}, "ask": {}})
+            self.assertTrue(checkpointer.checkpoint(books))
+            checkpointer.wait()
+            state = checkpointer.latest("BTC-USD")
+            for side in ("bid", "ask"):
+                self.assertEqual(state[side], list(order_book.iter_orders(side)))
+
+    def test_warm_start(self):
+        """
+        Test a checkpoint written on a background thread and a warm start replaying the capture after it
+        """
+        with open("test_message_3.json", "r") as f:
+            frames = [json.dumps(message) for message in json.load(f)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "capture.bin")
+            checkpointer = Checkpointer(os.path.join(directory, "checkpoints"), keep=1)
+            client = CoinbaseWebsocketClient(capture=CaptureWriter(path), checkpointer=checkpointer)
+            with unittest.mock.patch('sys.stdout', new_callable=io.StringIO):
+                for i, frame in enumerate(frames):
+                    client.on_message(None, frame)
+                    if i in (50, 100):
+                        self.assertTrue(checkpointer.checkpoint(client.books))
+                        checkpointer.wait()
+            client.capture.close()
+            self.assertEqual(len(checkpointer.checkpoints("BTC-USD")), 1)
+
+            restarted = CoinbaseWebsocketClient(checkpointer=Checkpointer(checkpointer.directory))
+            with unittest.mock.patch('sys.stdout', new_callable=io.StringIO):
+                restored = restarted.warm_start(path)
+            self.assertEqual(restored, {"BTC-USD": json.loads(frames[100])["sequence"]})
+            self.assertEqual(restarted.books.sequences, client.books.sequences)
+            for side in ("bid", "ask"):
+                self.assertEqual(list(restarted.order_book.iter_orders(side)), list(client.order_book.iter_orders(side)))
+
+    def test_warm_start_products(self):
+        """
+        Test replaying every product after its own checkpoint, and skipping the products without checkpoint
+        """
+        with open("test_message_3.json", "r") as f:
+            messages = [message for message in json.load(f) if "side" in message]
+        eth = [dict(message, product_id="ETH-USD", sequence=message["sequence"] + 10 ** 12) for message in messages]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "capture.bin")
+            checkpointer = Checkpointer(os.path.join(directory, "checkpoints"))
+            client = CoinbaseWebsocketClient(products=["BTC-USD", "ETH-USD"], capture=CaptureWriter(path),
+                                             checkpointer=checkpointer)
+            with unittest.mock.patch('sys.stdout', new_callable=io.StringIO):
+                for message in messages[:100]:
+                    client.on_message(None, json.dumps(message))
+                self.assertTrue(checkpointer.checkpoint(client.books))
+                checkpointer.wait()
+                for btc_message, eth_message in zip(messages[100:], eth[100:]):
+                    client.on_message(None, json.dumps(btc_message))
+                    client.on_message(None, json.dumps(eth_message))
+            client.capture.close()
+
+            self.assertEqual(CoinbaseWebsocketClient().warm_start(path), {})
+            restarted = CoinbaseWebsocketClient(products=["BTC-USD", "ETH-USD"],
+                                                checkpointer=Checkpointer(checkpointer.directory))
+            with unittest.mock.patch('sys.stdout', new_callable=io.StringIO):
+                self.assertEqual(restarted.warm_start(path), {"BTC-USD": messages[99]["sequence"]})
+            self.assertEqual(restarted.books.sequences, {"BTC-USD": messages[-1]["sequence"], "ETH-USD": None})
+            self.assertEqual(list(restarted.order_book.iter_orders("bid")), list(client.order_book.iter_orders("bid")))
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generate_messages(self):
+        """
+        Test synthetic message stream is sequenced and keeps the order book uncrossed
+        """
+        messages = benchmark.generate_messages(5000, depth=20, cancel_ratio=0.3, volatility=2.0, seed=1)
+        self.assertEqual([message["sequence"] for message in messages], list(range(1, len(messages) + 1)))
+        self.assertEqual({message["type"] for message in messages}, {"received", "open", "done", "change", "match"})
+
+        client = CoinbaseWebsocketClient()
+        with unittest.mock.patch.object(client, "on_error") as on_error:
+            for message in messages:
+                client._handle_message(None, message)
+                self.assertGreater(client.order_book.spread() or 1, 0)
+        on_error.assert_not_called()
+
+    def test_run(self):
+        """
+        Test benchmark results are json serializable and cover every timed operation
+        """
+        args = argparse.Namespace(orders=200, messages=200, depth=10, cancel_ratio=0.45, volatility=1.0,
+                                  seed=0, fixed_point=True)
+        results = json.loads(json.dumps(benchmark.run(args)))
+        self.assertEqual(set(results["order_book"]),
+                         {"insert_order", "change_order_price", "match_order", "delete_order"})
+        self.assertEqual(set(results["pipeline"]), {"_process_message", "_handle_message", "on_message"})
+        self.assertEqual(results["order_book"]["delete_order"]["ops"], 200)
+
+        comparison = benchmark.compare(results, results)
+        self.assertEqual(len(comparison), 7)
+        self.assertEqual(comparison["pipeline.on_message"],
+                         {"ops_per_second_ratio": 1.0, "p50_ratio": 1.0, "regression": False})
+        baseline = json.loads(json.dumps(results))
+        baseline["order_book"]["insert_order"]["ops_per_second"] *= 2
+        self.assertTrue(benchmark.compare(results, baseline)["order_book.insert_order"]["regression"])
+
+
+class TestMetrics(unittest.TestCase):
+    @unittest.mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_metrics(self, mock_stdout):
+        """
+        Test stage timings, message counters, sequence gaps and duplicates, and the Prometheus endpoint
+        """
+        with open("test_message_3.json", "r") as f:
+            messages = json.load(f)
+        metrics = Metrics()
+        client = CoinbaseWebsocketClient(metrics=metrics)
+        with unittest.mock.patch.object(client, "on_error"):
+            for message in messages[:100] + messages[99:100] + messages[100:-4] + messages[-1:]:
+                client.on_message(None, json.dumps(message))
+
+        self.assertEqual(metrics.duplicates, 1)
+        self.assertEqual(metrics.sequence_gaps, 1)
+        self.assertEqual(metrics.missing_sequences, 3)
+        self.assertEqual(sum(metrics.message_types.values()), len(messages) - 2)
+        self.assertEqual(metrics.message_types["subscriptions"], 1)
+        for stage in ("parse", "sequence", "apply"):
+            self.assertEqual(metrics.stages[stage].count, len(messages) - 2)
+        # websocket-client does not tell when a frame was read
+        self.assertEqual(metrics.stages["receive"].count, 0)
+        # the subscriptions message has no product
+        self.assertEqual(metrics.stages["publish"].count, len(messages) - 3)
+        self.assertEqual(metrics.exchange_lag.count, len(messages) - 2 - 1 - metrics.message_types["received"])
+        self.assertGreater(metrics.exchange_lag.quantile(0.5), 10 ** 9)
+
+        exporter = PrometheusExporter(metrics, port=0)
+        exporter.start()
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{exporter.port}/metrics", timeout=5) as response:
+                body = response.read().decode()
+        finally:
+            exporter.stop()
+        self.assertIn(f'orderbook_stage_latency_nanoseconds_count{{stage="parse"}} {len(messages) - 2}\n', body)
+        self.assertIn('orderbook_messages_total{type="subscriptions"} 1\n', body)
+        self.assertIn("orderbook_sequence_gaps_total 1\n", body)
+        self.assertIn("orderbook_duplicates_total 1\n", body)
+
+    def test_histogram(self):
+        """
+        Test histogram buckets include their upper bound, as the Prometheus le label
+        """
+        histogram = Histogram()
+        for value in (0, 1, 2, 3, 4, 5, 1024, 1025):
+            histogram.record(value)
+        self.assertEqual(histogram.counts[:12], [2, 1, 2, 1, 0, 0, 0, 0, 0, 0, 1, 1])
+        self.assertEqual(histogram.quantile(0.5), 4)
+        lines = Metrics._histogram_lines("latency", histogram, "")
+        self.assertIn('latency_bucket{le="4"} 5', lines)
+        self.assertIn('latency_bucket{le="1024"} 7', lines)
+
+    def test_parse_time(self):
+        """
+        Test parsing the exchange timestamp
+        """
+        self.assertEqual(parse_time_ns("2022-09-26T03:10:27.067787Z"), 1664161827067787000)
+
+
+class TestFixedPoint(unittest.TestCase):
+    def test_parse(self):
+        """
+        Test parsing decimal strings into scaled ints and back
+        """
+        price, size = FixedPoint("0.01"), FixedPoint("0.00000001")
+        self.assertEqual(price.parse("18882.2"), 1888220)
+        self.assertEqual(price.parse("18882"), 1888200)
+        self.assertEqual(price.parse("18882.20000000"), 1888220)
+        self.assertEqual(size.parse("0.00989427"), 989427)
+        self.assertEqual(size.parse("1"), 100000000)
+        self.assertEqual(str(price.to_decimal(1888220)), "18882.20")
+        self.assertEqual(size.from_decimal(Decimal("0.0001")), 10000)
+        # off the grid, rounded half to even as Decimal.quantize
+        for num in ("18882.205", "18882.215", "18882.2151", "18882.2049", "0.001", "18882.21500"):
+            self.assertEqual(price.parse(num), int(Decimal(num).quantize(Decimal("0.01")).scaleb(2)))
+
+    def test_order_book(self):
+        """
+        Test order book keyed on scaled ints returns Decimal at the read methods
+        """
+        price, size = FixedPoint("0.01"), FixedPoint("0.00000001")
+        orderbook = OrderBook(price, size)
+        orderbook.insert_order("1", size=size.parse("0.1"), price=price.parse("200.01"), side="bid")
+        orderbook.insert_order("2", size=size.parse("0.2"), price=price.parse("200.01"), side="bid")
+        orderbook.insert_order("3", size=size.parse("0.3"), price=price.parse("201.1"), side="ask")
+
+        self.assertEqual(orderbook._level_size["bid"], {20001: 30000000})
+        self.assertEqual(orderbook.best_bid(), (Decimal("200.01"), Decimal("0.3")))
+        self.assertEqual(orderbook.best_ask(), (Decimal("201.10"), Decimal("0.3")))
+        self.assertEqual(str(orderbook.spread()), "1.09")
+        self.assertEqual(orderbook.top_orders("bid", 1), [(Decimal("0.1"), Decimal("200.01"))])
+
+    def test_fetch_increments(self):
+        """
+        Test the increments are taken from the product metadata of a stub http server
+        """
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(json.dumps({"id": self.path.rsplit("/", 1)[-1], "quote_increment": "0.0001",
+                                             "base_increment": "0.1"}).encode())
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            increments = fetch_increments(["SHIB-USD"], f"http://127.0.0.1:{server.server_port}")
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(increments, {"SHIB-USD": ("0.0001", "0.1")})
+        price, size = product_scales("SHIB-USD", increments)
+        self.assertEqual((price.parse("0.00001234"), size.parse("12.35")), (0, 124))
+
+
+class TestBookPublisher(unittest.TestCase):
+    def test_change_mode(self):
+        """
+        Test publisher only publishes when the top price levels of a product changed
+        """
+        snapshots = []
+        publisher = BookPublisher(mode=BookPublisher.CHANGE, depth=2, sink=snapshots.append)
+        books = {}
+        for product_id in ("BTC-USD", "ETH-USD"):
+            books[product_id] = OrderBook()
+            books[product_id].insert_order("1", size=Decimal("0.1"), price=Decimal("200.01"), side="bid")
+            books[product_id].insert_order("2", size=Decimal("0.2"), price=Decimal("201.1"), side="ask")
+            books[product_id].insert_order("3", size=Decimal("0.3"), price=Decimal("199"), side="bid")
+
+        orderbook = books["BTC-USD"]
+        publisher.notify(orderbook, "BTC-USD")
+        publisher.notify(orderbook, "BTC-USD")
+        # same levels as BTC-USD, but another product
+        publisher.notify(books["ETH-USD"], "ETH-USD")
+        # outside of the top 2 price levels
+        orderbook.insert_order("4", size=Decimal("0.4"), price=Decimal("198"), side="bid")
+        publisher.notify(orderbook, "BTC-USD")
+        orderbook.change_order_size("1", size=Decimal("0.5"), side="bid")
+        publisher.notify(orderbook, "BTC-USD")
+        publisher.start()
+        publisher.stop()
+
+        self.assertEqual((publisher.published, publisher.dropped), (2, 1))
+        self.assertEqual(snapshots, [{"product_id": "BTC-USD", "ask": [(Decimal("0.2"), Decimal("201.1"))],
+                                      "bid": [(Decimal("0.5"), Decimal("200.01")), (Decimal("0.3"), Decimal("199"))]},
+                                     {"product_id": "ETH-USD", "ask": [(Decimal("0.2"), Decimal("201.1"))],
+                                      "bid": [(Decimal("0.1"), Decimal("200.01")), (Decimal("0.3"), Decimal("199"))]}])
+
+    def test_interval_mode(self):
+        """
+        Test publisher throttles snapshots in interval mode, and publishes the last change at the end of the interval
+        """
+        snapshots = []
+        publisher = BookPublisher(mode=BookPublisher.INTERVAL, interval=0.2, depth=1, sink=snapshots.append)
+        orderbook = OrderBook()
+        orderbook.insert_order("1", size=Decimal("0.1"), price=Decimal("200.01"), side="bid")
+        publisher.start()
+        try:
+            publisher.notify(orderbook, "BTC-USD")
+            for _ in range(1000):
+                if snapshots:
+                    break
+                time.sleep(0.001)
+            for i in range(2, 100):
+                orderbook.change_order_size("1", size=Decimal(i), side="bid")
+                publisher.notify(orderbook, "BTC-USD")
+            self.assertEqual(len(snapshots), 1)
+            for _ in range(100):
+                if len(snapshots) == 2:
+                    break
+                time.sleep(0.01)
+        finally:
+            publisher.stop()
+        self.assertEqual(snapshots, [{"product_id": "BTC-USD", "ask": [], "bid": [(Decimal("0.1"), Decimal("200.01"))]},
+                                     {"product_id": "BTC-USD", "ask": [], "bid": [(Decimal("99"), Decimal("200.01"))]}])
+
+    def test_crossed_book(self):
+        """
+        Test a trailing snapshot failing on a crossed book is logged and the other products are still published
+        """
+        snapshots = []
+        publisher = BookPublisher(mode=BookPublisher.INTERVAL, interval=60, depth=1, sink=snapshots.append)
+        books = {}
+        for product_id in ("BTC-USD", "ETH-USD"):
+            books[product_id] = OrderBook()
+            books[product_id].insert_order("1", size=Decimal("0.1"), price=Decimal("200.01"), side="bid")
+            books[product_id].insert_order("2", size=Decimal("0.2"), price=Decimal("201.1"), side="ask")
+            publisher.notify(books[product_id], product_id)
+        # both books change within the interval, the BTC-USD one gets crossed
+        books["BTC-USD"].insert_order("3", size=Decimal("0.3"), price=Decimal("202"), side="bid")
+        books["ETH-USD"].change_order_size("1", size=Decimal("0.5"), side="bid")
+        for product_id in ("BTC-USD", "ETH-USD"):
+            publisher.notify(books[product_id], product_id)
+        with self.assertLogs(level="ERROR") as logs:
+            publisher.start()
+            publisher.stop()
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("Publisher snapshot error of BTC-USD", logs.output[0])
+        self.assertEqual(publisher.published, 3)
+        self.assertEqual(snapshots[-1], {"product_id": "ETH-USD", "ask": [(Decimal("0.2"), Decimal("201.1"))],
+                                         "bid": [(Decimal("0.5"), Decimal("200.01"))]})
+
+
+class TestLevel2(unittest.TestCase):
+    def test_order_book(self):
+        """
+        Test the level 2 order book read API
+        """
+        orderbook = L2OrderBook()
+        orderbook.update_level(Decimal("200.01"), Decimal("0.3"), side="bid")
+        orderbook.update_level(Decimal("199.5"), Decimal("0.1"), side="bid")
+        orderbook.update_level(Decimal("201.1"), Decimal("1.0"), side="ask")
+        orderbook.update_level(Decimal("201.2"), Decimal("0.5"), side="ask")
+        orderbook.update_level(Decimal("201.2"), Decimal("0"), side="ask")
+        orderbook.update_level(Decimal("202"), Decimal("0"), side="ask")
+
+        self.assertEqual(orderbook.best_bid(), (Decimal("200.01"), Decimal("0.3")))
+        self.assertEqual(orderbook.spread(), Decimal("1.09"))
+        self.assertEqual(orderbook.top_levels("ask"), [(Decimal("201.1"), Decimal("1.0"))])
+        self.assertEqual(orderbook.snapshot(2), {"ask": [(Decimal("1.0"), Decimal("201.1"))],
+                                                 "bid": [(Decimal("0.3"), Decimal("200.01")),
+                                                         (Decimal("0.1"), Decimal("199.5"))]})
+
+        orderbook.apply_batch([("update_level", Decimal("200.01"), Decimal("0"), "bid"),
+                               ("update_level", Decimal("200.01"), Decimal("0.7"), "bid"),
+                               ("update_level", Decimal("199.5"), Decimal("0"), "bid")])
+        self.assertEqual(orderbook.top_levels("bid"), [(Decimal("200.01"), Decimal("0.7"))])
+
+    def test_client(self):
+        """
+        Test the client tracking level 2 books from the level changes of test_message_3.json
+        """
+        with open("test_message_3.json", "r") as f:
+            frames = [json.dumps(message) for message in json.load(f)]
+        full = CoinbaseWebsocketClient()
+        changes = []
+        full.order_book.add_level_listener(lambda side, price, size: changes.append(
+            ["buy" if side == "bid" else "sell", str(price), str(size)]))
+        with unittest.mock.patch('sys.stdout', new_callable=io.StringIO):
+            for frame in frames[:100]:
+                full.on_message(None, frame)
+            snapshot = {"type": "snapshot", "product_id": "BTC-USD",
+                        "bids": [[str(price), str(size)] for price, size in full.order_book.top_levels("bid", 1000)],
+                        "asks": [[str(price), str(size)] for price, size in full.order_book.top_levels("ask", 1000)]}
+            updates = []
+            for frame in frames[100:]:
+                del changes[:]
+                full.on_message(None, frame)
+                if changes:
+                    updates.append({"type": "l2update", "product_id": "BTC-USD", "changes": list(changes),
+                                    "time": "2022-09-26T03:10:27.067787Z"})
+
+        for fixed_point in (False, True):
+            client = CoinbaseWebsocketClient(level2=True, fixed_point=fixed_point)
+            self.assertEqual(client.channels, ["heartbeat", "level2_batch"])
+            self.assertIsInstance(client.order_book, L2OrderBook)
+            with unittest.mock.patch('sys.stdout', new_callable=io.StringIO):
+                client.on_message(None, json.dumps(snapshot))
+                for update in updates[:50]:
+                    client.on_message(None, json.dumps(update))
+            client._handle_batch(None, updates[50:])
+            for side in ("bid", "ask"):
+                self.assertEqual(client.order_book.top_levels(side, 1000), full.order_book.top_levels(side, 1000))
+
+        client = CoinbaseWebsocketClient(products=["BTC-USD", "ETH-USD"], level2=["ETH-USD"])
+        self.assertEqual(json.loads(client._subscribe_message())["channels"],
+                         ["heartbeat", {"name": "full", "product_ids": ["BTC-USD"]},
+                          {"name": "level2_batch", "product_ids": ["ETH-USD"]}])
+        self.assertIsInstance(client.books.book("BTC-USD"), OrderBook)
+        self.assertIsInstance(client.books.book("ETH-USD"), L2OrderBook)
+
+
+class TestBookDiffs(unittest.TestCase):
+    def test_mirror(self):
+        """
+        Test full depth and top 5 subscribers mirror the order book from the diffs
+        """
+        messages = benchmark.generate_messages(3000, depth=20, seed=4)
+        for fixed_point in (False, True):
+            books = BookManager(["BTC-USD"], fixed_point=fixed_point)
+            for message in messages[:500]:
+                books.apply(message)
+            order_book = books.book("BTC-USD")
+            stream = BookDiffStream(order_book)
+
+            mirrors = {None: {"bid": {}, "ask": {}}, 5: {"bid": {}, "ask": {}}}
+            tops = []
+
+            def mirror(depth):
+                def apply(diffs):
+                    for side, price, size in diffs:
+                        if size:
+                            mirrors[depth][side][price] = size
+                        else:
+                            del mirrors[depth][side][price]
+                return apply
+
+            stream.subscribe(mirror(None))
+            stream.subscribe(mirror(5), depth=5)
+            top = stream.subscribe_top(lambda bid, ask: tops.append((bid, ask)))
+
+            for start in range(500, len(messages), 100):
+                if start % 200:
+                    books.apply_batch(messages[start:start + 100])
+                else:
+                    for message in messages[start:start + 100]:
+                        books.apply(message)
+                for depth, levels in mirrors.items():
+                    for side in ("bid", "ask"):
+                        expected = order_book.top_levels(side, depth or 1000)
+                        self.assertEqual(sorted(levels[side].items(), reverse=side == "bid"), expected)
+                self.assertEqual(tops[-1], (order_book.best_bid(), order_book.best_ask()))
+            self.assertTrue(all(a != b for a, b in zip(tops, tops[1:])))
+
+            stream.unsubscribe(top)
+            stream.close()
+            order_book.clear()
+            self.assertTrue(mirrors[None]["bid"])
+
+    def test_change_price(self):
+        """
+        Test level listeners of a price change see both price levels updated
+        """
+        orderbook = OrderBook()
+        orderbook.insert_order("1", size=Decimal("0.1"), price=Decimal("200.01"), side="bid")
+        orderbook.insert_order("2", size=Decimal("0.2"), price=Decimal("200.01"), side="bid")
+        seen = []
+        orderbook.add_level_listener(lambda side, price, size: seen.append((price, size, orderbook.top_levels(side))))
+        orderbook.change_order_price("1", old_price=Decimal("200.01"), new_price=Decimal("200.02"), side="bid")
+
+        levels = [(Decimal("200.02"), Decimal("0.1")), (Decimal("200.01"), Decimal("0.2"))]
+        self.assertEqual(seen, [(Decimal("200.01"), Decimal("0.2"), levels), (Decimal("200.02"), Decimal("0.1"), levels)])
+
+
+class TestTrades(unittest.TestCase):
+    def test_product_trades(self):
+        """
+        Test the trade tape, rolling window and candles against recomputing them from every trade
+        """
+        rng = random.Random(5)
+        second = 1000000000
+        trades = ProductTrades(capacity=50, windows=(10,), intervals=(5, 60), history=3)
+        history = []
+        time_ns = 1664164467 * second
+        for trade_id in range(1000):
+            time_ns += rng.randint(0, second // 2) if trade_id != 500 else 100 * second
+            trade = Trade(trade_id, time_ns, Decimal(rng.randint(1000, 1100)), Decimal(rng.randint(1, 9)).scaleb(-2),
+                          rng.choice(("buy", "sell")))
+            trades.add(trade)
+            history.append(trade)
+
+        self.assertEqual(len(trades.tape), 50)
+        self.assertEqual(trades.tape.last(), history[-50:])
+        self.assertEqual(trades.tape.last(2), history[-2:])
+
+        window = trades.windows[10]
+        recent = [trade for trade in history if trade.time_ns // second > time_ns // second - 10]
+        self.assertEqual(window.volume, sum(trade.size for trade in recent))
+        self.assertEqual(window.count, len(recent))
+        self.assertEqual(window.vwap(), sum(trade.price * trade.size for trade in recent) / window.volume)
+        window.update(time_ns + 60 * second)
+        self.assertEqual((window.volume, window.count, window.vwap()), (0, 0, None))
+
+        for interval in (5, 60):
+            candles = {}
+            for trade in history:
+                candles.setdefault(trade.time_ns - trade.time_ns % (interval * second), []).append(trade)
+            expected = [{"start": start, "open": group[0].price, "high": max(trade.price for trade in group),
+                         "low": min(trade.price for trade in group), "close": group[-1].price,
+                         "volume": sum(trade.size for trade in group),
+                         "notional": sum(trade.price * trade.size for trade in group), "count": len(group)}
+                        for start, group in sorted(candles.items())]
+            self.assertEqual(trades.candles.current(interval), expected[-1])
+            self.assertEqual(trades.candles.candles(interval), expected[-4:-1])
+
+    @unittest.mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_client(self, mock_stdout):
+        """
+        Test the client recording the trades of the match messages of test_message_3.json
+        """
+        with open("test_message_3.json", "r") as f:
+            messages = json.load(f)
+        client = CoinbaseWebsocketClient(trades=TradeRecorder(intervals=(60,)))
+        for message in messages[:200]:
+            client.on_message(None, json.dumps(message))
+        client._handle_batch(None, messages[200:])
+
+        trades = client.trades.product("BTC-USD")
+        self.assertEqual([(trade.trade_id, trade.price, trade.size, trade.side) for trade in trades.tape.last()],
+                         [(418304778, Decimal("18858.91"), Decimal("0.00129966"), "buy"),
+                          (418304779, Decimal("18858.91"), Decimal("0.00000053"), "buy")])
+        self.assertEqual(trades.candles.current(60)["volume"], Decimal("0.00130019"))
+        self.assertEqual(trades.windows[60].vwap(), Decimal("18858.91"))
+
+    @unittest.mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_recovery(self, mock_stdout):
+        """
+        Test the trades of the messages buffered during a recovery are recorded once, even when the
+        snapshot is after them, on the order book grid in fixed point mode
+        """
+        with open("test_message_3.json", "r") as f:
+            messages = [message for message in json.load(f) if "side" in message]
+        matches = [message for message in messages if message["type"] == "match"]
+        fetched = threading.Event()
+
+        class SlowProvider(SnapshotProvider):
+            def fetch(self, product_id):
+                fetched.wait(5)
+                return level3_snapshot(messages[:40])
+
+        client = CoinbaseWebsocketClient(snapshot_provider=SlowProvider(), fixed_point=True,
+                                         trades=TradeRecorder(intervals=(60,)))
+        for message in messages[:35]:
+            client.on_message(None, json.dumps(message))
+        fetched.set()
+        client._recoveries["BTC-USD"]._done.wait(5)
+        for message in messages[35:]:
+            client.on_message(None, json.dumps(message))
+
+        self.assertEqual(client._recoveries, {})
+        trades = client.trades.product("BTC-USD").tape.last()
+        self.assertEqual([(trade.trade_id, trade.price, trade.size) for trade in trades],
+                         [(match["trade_id"], Decimal(match["price"]), Decimal(match["size"])) for match in matches])
+        self.assertEqual(type(trades[0].price), Decimal)
+
+
+class TestAnalytics(unittest.TestCase):
+    def test_metrics(self):
+        """
+        Test depth within bps, imbalance, vwap, slippage and microprice
+        """
+        orderbook = OrderBook()
+        orderbook.insert_order("1", size=Decimal("1"), price=Decimal("99"), side="bid")
+        orderbook.insert_order("2", size=Decimal("2"), price=Decimal("98"), side="bid")
+        analytics = BookAnalytics(orderbook, capacity=1)
+        orderbook.insert_order("3", size=Decimal("1"), price=Decimal("97"), side="bid")
+        orderbook.insert_order("4", size=Decimal("3"), price=Decimal("101"), side="ask")
+        orderbook.insert_order("5", size=Decimal("1"), price=Decimal("102"), side="ask")
+        orderbook.insert_order("6", size=Decimal("2"), price=Decimal("102"), side="ask")
+
+        prices, sizes = analytics.levels("bid")
+        self.assertEqual((list(prices), list(sizes)), ([99, 98, 97], [1, 2, 1]))
+        self.assertEqual(analytics.mid_price(), 100)
+        self.assertEqual(analytics.microprice(), (99 * 3 + 101 * 1) / 4)
+
+        depth = analytics.depth_within([50, 100, 200, 500])
+        self.assertEqual(list(depth["bid"]), [0, 1, 3, 4])
+        self.assertEqual(list(depth["ask"]), [0, 3, 6, 6])
+        self.assertEqual(list(analytics.imbalance([1, 2, 10])), [(1 - 3) / 4, (3 - 6) / 9, (4 - 6) / 10])
+
+        vwap = analytics.vwap([1, 3, 4, 6, 7])
+        self.assertEqual(list(vwap[:4]), [101, 101, (3 * 101 + 102) / 4, (3 * 101 + 3 * 102) / 6])
+        self.assertTrue(np.isnan(vwap[4]))
+        np.testing.assert_allclose(analytics.slippage([2, 3], side="bid"), [150, (100 - 295 / 3) * 100])
+
+        orderbook.delete_order("1", side="bid")
+        orderbook.match_order("4", size=Decimal("3"), side="ask")
+        self.assertEqual(analytics.microprice(), (98 * 3 + 102 * 2) / 5)
+        analytics.close()
+        orderbook.clear()
+        self.assertEqual(list(analytics.levels("ask")[0]), [102])
+
+    def test_incremental(self):
+        """
+        Test the level arrays follow the order book through single and batched messages
+        """
+        messages = benchmark.generate_messages(2000, depth=20, seed=3)
+        for fixed_point in (False, True):
+            books = BookManager(["BTC-USD"], fixed_point=fixed_point)
+            order_book = books.book("BTC-USD")
+            analytics = BookAnalytics(order_book, capacity=4)
+            for start in range(0, len(messages), 100):
+                if start % 200:
+                    books.apply_batch(messages[start:start + 100])
+                else:
+                    for message in messages[start:start + 100]:
+                        books.apply(message)
+                for side in ("bid", "ask"):
+                    prices, sizes = analytics.levels(side)
+                    self.assertEqual(list(zip(prices, sizes)), [(float(price), float(size)) for price, size
+                                                                in order_book.top_levels(side, 1000)])
+            books.product("BTC-USD").load_snapshot({"bids": [["100.00", "1.5", "a"]], "asks": []})
+            self.assertEqual(list(analytics.levels("bid")[1]), [1.5])
+            self.assertEqual(len(analytics.levels("ask")[0]), 0)
+
+
+class TestSharedBook(unittest.TestCase):
+    def test_client(self):
+        """
+        Test the client publishing test_message_3.json to a shared book read by another process
+        """
+        import multiprocessing
+
+        with open("test_message_3.json", "r") as f:
+            frames = [json.dumps(message) for message in json.load(f)]
+        publisher = SharedBookPublisher(["BTC-USD", "ETH-USD"], depth=3)
+        try:
+            client = CoinbaseWebsocketClient(publisher=publisher)
+            for frame in frames:
+                client.on_message(None, frame)
+
+            reader = SharedBookReader(publisher.name)
+            self.assertEqual((reader.product_ids, reader.depth), (["BTC-USD", "ETH-USD"], 3))
+            self.assertIsNone(reader.read("ETH-USD"))
+            snapshot = reader.read("BTC-USD")
+            self.assertEqual(snapshot["sequence"], json.loads(frames[-1])["sequence"])
+            self.assertEqual(snapshot["version"], 2 * publisher.published)
+            for side in ("bid", "ask"):
+                self.assertEqual(snapshot[side], [(float(price), float(size))
+                                                  for price, size in client.order_book.top_levels(side, 3)])
+            reader.close()
+
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=read_shared_book, args=(publisher.name, "BTC-USD", results))
+            process.start()
+            self.assertEqual(results.get(timeout=10), snapshot)
+            process.join()
+        finally:
+            publisher.stop()
+
+    def test_torn_read(self):
+        """
+        Test the reader retries while a write is in progress
+        """
+        publisher = SharedBookPublisher(["BTC-USD"], depth=1)
+        try:
+            orderbook = OrderBook()
+            orderbook.insert_order("1", size=Decimal("0.5"), price=Decimal("200.01"), side="bid")
+            publisher.notify(orderbook, "BTC-USD")
+            reader = SharedBookReader(publisher.name, max_retries=10)
+            self.assertEqual(reader.read("BTC-USD")["bid"], [(200.01, 0.5)])
+
+            # a writer stopped in the middle of a write
+            version = reader.version("BTC-USD")
+            publisher._shm.buf[publisher._slots["BTC-USD"]] = version + 1
+            self.assertIsNone(reader.read("BTC-USD"))
+            self.assertEqual(reader.retries, 10)
+            reader.close()
+        finally:
+            publisher.stop()
+
+    def test_unchanged_top(self):
+        """
+        Test the levels are only converted when the top changed, the sequence is always written
+        """
+        with self.assertRaises(ValueError):
+            SharedBookPublisher(["BTC-USD", "X" * 17])
+        publisher = SharedBookPublisher(["BTC-USD"], depth=1)
+        try:
+            orderbook = OrderBook()
+            orderbook.insert_order("1", size=Decimal("0.5"), price=Decimal("200.01"), side="bid")
+            publisher.notify(orderbook, "BTC-USD", 1)
+            reader = SharedBookReader(publisher.name)
+            # outside of the top level
+            orderbook.insert_order("2", size=Decimal("0.5"), price=Decimal("200"), side="bid")
+            with unittest.mock.patch.object(orderbook, "level_out") as level_out:
+                publisher.notify(orderbook, "BTC-USD", 2)
+            level_out.assert_not_called()
+            self.assertEqual((reader.read("BTC-USD")["sequence"], reader.read("BTC-USD")["bid"]), (2, [(200.01, 0.5)]))
+
+            orderbook.change_order_size("1", size=Decimal("0.25"), side="bid")
+            publisher.notify(orderbook, "BTC-USD", 3)
+            self.assertEqual((reader.read("BTC-USD")["sequence"], reader.read("BTC-USD")["bid"]), (3, [(200.01, 0.25)]))
+            reader.close()
+        finally:
+            publisher.stop()
+
+
+class TestReconnect(unittest.TestCase):
+    def setUp(self):
+        with open("test_message_3.json", "r") as f:
+            self.frames = [json.dumps(message) for message in json.load(f)]
+        self.subscriptions = []
+        self.sent = []
+
+    def serve_helper(self, sessions):
+        """
+        helper function starting a local websocket stand-in of the feed in a background thread
+        :param sessions: list of (frames, close) per connection, in connection order, the connection is closed
+                         after its frames if close is True and left silent otherwise, later connections stay silent
+        :return: tuple of (url, stop function)
+
+        """
+        import websockets
+
+        started = threading.Event()
+        state = {}
+
+        async def handler(ws, *args):
+            self.subscriptions.append(json.loads(await ws.recv()))
+            index = len(self.subscriptions) - 1
+            frames, close = sessions[index] if index < len(sessions) else ([], False)
+            for frame in frames:
+                await ws.send(frame)
+                self.sent.append(json.loads(frame))
+            if not close:
+                await ws.wait_closed()
+
+        async def serve():
+            state["stop"] = asyncio.get_running_loop().create_future()
+            # websocket-client leaves the socket of a connection closed by the server open, do not wait for it
+            async with websockets.serve(handler, "127.0.0.1", 0, close_timeout=0.5) as server:
+                state["port"] = server.sockets[0].getsockname()[1]
+                started.set()
+                await state["stop"]
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_until_complete, args=(serve(),), daemon=True)
+        thread.start()
+        started.wait(5)
+
+        def stop():
+            loop.call_soon_threadsafe(state["stop"].set_result, None)
+            thread.join(5)
+            loop.close()
+
+        return f"ws://127.0.0.1:{state['port']}", stop
+
+    def run_helper(self, client, frames=None):
+        """
+        helper function running the client until it applied the last frame, then closing it
+        :param client: CoinbaseWebsocketClient
+        :param frames: frames the order book is expected to be built from, default every frame
+
+        """
+        last_sequence = json.loads(self.frames[-1])["sequence"]
+        thread = threading.Thread(target=client.connect, daemon=True)
+        thread.start()
+        for _ in range(500):
+            if client.books.sequences.get("BTC-USD") == last_sequence:
+                break
+            thread.join(0.01)
+        client.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(client.books.sequences.get("BTC-USD"), last_sequence)
+
+        books = BookManager(["BTC-USD"])
+        for frame in self.frames if frames is None else frames:
+            message = json.loads(frame)
+            if "side" in message:
+                books.apply(message)
+        for side in ("bid", "ask"):
+            self.assertEqual(resting_orders(client.order_book, side), resting_orders(books.book("BTC-USD"), side))
+        self.assertEqual(set(json.dumps(subscription) for subscription in self.subscriptions),
+                         {client._subscribe_message()})
+
+    @unittest.mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_reconnect(self, mock_stdout):
+        """
+        Test reconnecting after the server closed the connection, and after the watchdog closed a silent one,
+        the order book is bootstrapped again from a snapshot after every reconnect
+        """
+        test = self
+
+        class SentSnapshotProvider(SnapshotProvider):
+            def fetch(self, product_id):
+                return level3_snapshot(list(test.sent))
+
+        url, stop = self.serve_helper([(self.frames[:100], True), (self.frames[100:200], False),
+                                       (self.frames[200:], False)])
+        try:
+            client = CoinbaseWebsocketClient(url, snapshot_provider=SentSnapshotProvider())
+            client.HEARTBEAT_TIMEOUT = 0.3
+            client.RECONNECT_BACKOFF = 0.01
+            self.run_helper(client)
+        finally:
+            stop()
+        self.assertGreaterEqual(len(self.subscriptions), 3)
+        self.assertGreaterEqual(client.reconnects, 2)
+
+    @unittest.mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_standby(self, mock_stdout):
+        """
+        Test failing over to the standby connection, the messages both connections deliver are applied once
+        """
+        url, stop = self.serve_helper([(self.frames[:150], True), (self.frames, False)])
+        try:
+            client = CoinbaseWebsocketClient(url, metrics=Metrics(), standby=True)
+            client.RECONNECT_BACKOFF = 0.01
+            self.run_helper(client)
+        finally:
+            stop()
+        self.assertGreaterEqual(len(self.subscriptions), 2)
+        self.assertEqual(client.failovers, 1)
+        self.assertEqual(client.metrics.duplicates, 0)
+        self.assertEqual(client.metrics.sequence_gaps, 0)
+
+    @unittest.mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_standby_interleaved(self, mock_stdout):
+        """
+        Test a sequence missing on the connection ahead is taken from the other one, and a sequence missing
+        on both is left as a gap
+        """
+        frames = [frame for frame in self.frames if "sequence" in json.loads(frame) and "side" in json.loads(frame)]
+        expected = CoinbaseWebsocketClient()
+        for frame in frames:
+            expected.on_message(None, frame)
+
+        for missing, gaps in (((50,), 0), ((50, 100), 0), ((), 1)):
+            client = CoinbaseWebsocketClient(metrics=Metrics(), standby=True)
+            client._opened_at = [1, 1]
+            # without a snapshot provider the client keeps reporting the gap, only the first report is checked
+            client.on_error = unittest.mock.Mock()
+            # connection 1 is ahead and misses some sequences, connection 0 lags and misses 150 as well
+            ahead = [frame for i, frame in enumerate(frames) if i not in missing and i != 150]
+            behind = [frame for i, frame in enumerate(frames) if gaps == 0 or i != 150]
+            for i in range(len(frames) + 3):
+                # connection 0 runs 3 messages behind
+                for connection, stream, index in ((1, ahead, i), (0, behind, i - 3)):
+                    if 0 <= index < len(stream):
+                        client._on_connection_message(connection, None, stream[index])
+            client._release_expired()
+            client.HOLD_TIMEOUT = 0
+            client._release_expired()
+
+            self.assertEqual(client._held.get("BTC-USD", {}), {})
+            self.assertEqual(client.metrics.duplicates, 0)
+            if gaps:
+                self.assertEqual(client.on_error.call_args_list[0].args[1],
+                                 "Sequence error: BTC-USD missing 1 sequences")
+            else:
+                self.assertEqual(client.metrics.sequence_gaps, 0)
+                client.on_error.assert_not_called()
+                for side in ("bid", "ask"):
+                    self.assertEqual(price_levels(client.order_book, side), price_levels(expected.order_book, side))
+
+    @unittest.mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_resync(self, mock_stdout):
+        """
+        Test dropping the order book after a reconnect without snapshot provider, it is rebuilt from the live messages
+        """
+        url, stop = self.serve_helper([(self.frames[:100], True), (self.frames[:1] + self.frames[100:], False)])
+        try:
+            client = CoinbaseWebsocketClient(url)
+            client.RECONNECT_BACKOFF = 0.01
+            self.run_helper(client, self.frames[100:])
+        finally:
+            stop()
+        self.assertEqual(client.reconnects, 1)
+
+
 if __name__ == '__main__':
     unittest.main()
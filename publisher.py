@@ -0,0 +1,179 @@
+import sys
+import time
+import logging
+import threading
+
+from orderbook import format_snapshot
+
+
+def print_snapshot(snapshot):
+    """
+    default publisher sink, write the formatted snapshot to stdout
+
+    :param snapshot: dict of side -> list of (size, price), best price first, and "product_id" when known
+
+    """
+    sys.stdout.write(format_snapshot(snapshot))
+    sys.stdout.flush()
+
+
+class BookPublisher:
+    """
+    Publish order book snapshots off the message processing thread
+
+    The ingest thread only takes a small top-of-book snapshot when the publish mode allows it,
+    and hands it over to a background thread which runs the sink. A pending snapshot of a product
+    that is not consumed yet is replaced by its newer one, so a slow sink never blocks the websocket.
+    In interval mode the first change of an interval is published right away, later changes only
+    mark the product stale. Once the interval ended the background thread takes the trailing snapshot
+    itself, holding the order book lock, so the ingest thread never snapshots a throttled change.
+
+    """
+    # publish after every message
+    EVERY = "every"
+    # publish at most once every interval seconds per product, the last change at the end of the interval
+    INTERVAL = "interval"
+    # publish only when the top depth aggregated price levels changed
+    CHANGE = "change"
+
+    def __init__(self, mode=INTERVAL, interval=0.5, depth=5, sink=None):
+        """
+        initialize publisher
+
+        :param mode: "every", "interval" or "change", default "interval"
+        :param interval: minimum seconds between two snapshots in "interval" mode, default 0.5
+        :param depth: number of orders per side in the snapshot, and number of price levels
+                      watched in "change" mode, default 5
+        :param sink: callable receiving each snapshot, default print to stdout
+
+        """
+        if mode not in (self.EVERY, self.INTERVAL, self.CHANGE):
+            raise ValueError(f"Unknown publish mode: {mode}")
+        self.mode = mode
+        self.interval = interval
+        self.depth = depth
+        self.sink = print_snapshot if sink is None else sink
+        self.published = 0
+        self.dropped = 0
+
+        # key is product id, None when the publisher is notified without product id
+        self._last_publish = {}
+        self._last_top = {}
+        self._pending = {}
+        # product id -> order book changed since its last published snapshot, interval mode
+        self._stale = {}
+        self._running = False
+        self._thread = None
+        self._condition = threading.Condition()
+
+    def start(self):
+        """start the publishing thread"""
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="book-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """stop the publishing thread after the pending and the stale snapshots are published"""
+        if self._thread is None:
+            return
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        self._thread = None
+
+    def notify(self, order_book, product_id=None, sequence=None):
+        """
+        called on the ingest thread after the order book changed
+
+        :param order_book: order book
+        :param product_id: product id of the order book, added to the snapshot
+        :param sequence: last applied sequence of the order book, unused
+
+        """
+        if self.mode == self.INTERVAL:
+            now = time.monotonic()
+            last_publish = self._last_publish.get(product_id)
+            if last_publish is not None and now - last_publish < self.interval:
+                if product_id not in self._stale:
+                    with self._condition:
+                        self._stale[product_id] = order_book
+                        self._condition.notify()
+                return
+            self._last_publish[product_id] = now
+        elif self.mode == self.CHANGE:
+            top = (order_book.top_levels("bid", self.depth), order_book.top_levels("ask", self.depth))
+            if top == self._last_top.get(product_id):
+                return
+            self._last_top[product_id] = top
+
+        snapshot = self._snapshot(order_book, product_id)
+        with self._condition:
+            self._stale.pop(product_id, None)
+            if product_id in self._pending:
+                self.dropped += 1
+            self._pending[product_id] = snapshot
+            self._condition.notify()
+
+    def _snapshot(self, order_book, product_id):
+        """
+        take a snapshot of the top of the order book
+
+        :param order_book: order book
+        :param product_id: product id added to the snapshot, or None
+        :return: snapshot dict
+
+        """
+        snapshot = order_book.snapshot(self.depth)
+        if product_id is not None:
+            snapshot["product_id"] = product_id
+        return snapshot
+
+    def _take_stale(self, flush=False):
+        """
+        take the stale order books whose interval ended, called with the condition held
+
+        :param flush: take every stale order book, default False
+        :return: tuple of (list of (product id, order book), seconds until the next one is due or None)
+
+        """
+        now = time.monotonic()
+        due, wait = [], None
+        for product_id in list(self._stale):
+            remaining = self._last_publish[product_id] + self.interval - now
+            if flush or remaining <= 0:
+                due.append((product_id, self._stale.pop(product_id)))
+                self._last_publish[product_id] = now
+            else:
+                wait = remaining if wait is None else min(wait, remaining)
+        return due, wait
+
+    def _run(self):
+        """publishing thread, run the sink on the pending snapshots and on the trailing ones once due"""
+        running = True
+        while running:
+            with self._condition:
+                while True:
+                    running = self._running
+                    snapshots = list(self._pending.values())
+                    self._pending.clear()
+                    due, wait = self._take_stale(flush=not running)
+                    if snapshots or due or not running:
+                        break
+                    self._condition.wait(wait)
+            for product_id, order_book in due:
+                # the ingest thread keeps changing the order book, snapshot it under its lock
+                try:
+                    with order_book.lock:
+                        snapshots.append(self._snapshot(order_book, product_id))
+                except Exception as e:
+                    # e.g. a crossed book, skip this product and keep the publishing thread alive
+                    logging.error(f"Publisher snapshot error of {product_id}: {e}")
+            for snapshot in snapshots:
+                try:
+                    self.sink(snapshot)
+                    self.published += 1
+                except Exception as e:
+                    logging.error(f"Publisher sink error: {e}")
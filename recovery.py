@@ -0,0 +1,153 @@
+import abc
+import json
+import time
+import logging
+import threading
+import collections
+import urllib.request
+
+
+class SnapshotProvider(abc.ABC):
+    """Source of level 3 order book snapshots"""
+
+    @abc.abstractmethod
+    def fetch(self, product_id):
+        """
+        fetch a full level 3 snapshot
+
+        :param product_id: product id
+        :return: dict with "sequence", and "bids" and "asks" lists of [price, size, order_id],
+                 best price first and FIFO within a price level
+
+        """
+
+
+class HttpSnapshotProvider(SnapshotProvider):
+    """Fetch snapshots from the Coinbase Exchange REST API, or a server with the same endpoint"""
+
+    def __init__(self, url=None, timeout=10):
+        """
+        initialize http snapshot provider
+
+        :param url: REST API url, default Coinbase Exchange REST API
+        :param timeout: request timeout in seconds, default 10
+
+        """
+        self.url = "https://api.exchange.coinbase.com" if not url else url.rstrip("/")
+        self.timeout = timeout
+
+    def fetch(self, product_id):
+        request = urllib.request.Request(f"{self.url}/products/{product_id}/book?level=3",
+                                         headers={"User-Agent": "coinbase-l2-orderbook"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+
+class FileSnapshotProvider(SnapshotProvider):
+    """Read snapshots from local json files"""
+
+    def __init__(self, path):
+        """
+        initialize file snapshot provider
+
+        :param path: json file path, may contain "{product_id}"
+
+        """
+        self.path = path
+
+    def fetch(self, product_id):
+        with open(self.path.format(product_id=product_id), "r") as f:
+            return json.load(f)
+
+
+class BookRecovery:
+    """
+    Recover the order book of one product after a sequence gap, or bootstrap it
+
+    Live messages are buffered while the snapshot is fetched. Once it arrived, the order book is
+    loaded from the snapshot and only the buffered messages after the snapshot sequence are
+    replayed, so the websocket stays connected and the recovery time scales with the gap.
+    The buffer keeps the latest max_buffer messages, a snapshot older than the oldest kept message
+    leaves a gap which starts the next recovery. A failed fetch is retried with exponential backoff.
+
+    """
+    # delay before retrying a failed fetch, doubled after every failure up to MAX_RETRY_BACKOFF
+    RETRY_BACKOFF = 0.5
+    MAX_RETRY_BACKOFF = 30
+
+    def __init__(self, product_id, provider, threaded=True, max_buffer=100000):
+        """
+        initialize recovery
+
+        :param product_id: product id
+        :param provider: SnapshotProvider
+        :param threaded: fetch the snapshot on a background thread, default True
+        :param max_buffer: maximum number of buffered messages, the oldest ones are dropped, default 100000
+
+        """
+        self.product_id = product_id
+        self.provider = provider
+        self.threaded = threaded
+        self.buffer = collections.deque(maxlen=max_buffer)
+        self.dropped = 0
+        self.snapshot = None
+        self.error = None
+        self.failures = 0
+        # time.monotonic() when the failed fetch is retried, None while fetching
+        self.retry_at = None
+        self._done = threading.Event()
+
+    def start(self):
+        """start fetching the snapshot, keeping the buffered messages"""
+        self.snapshot, self.error, self.retry_at = None, None, None
+        self._done.clear()
+        if self.threaded:
+            threading.Thread(target=self._fetch, name=f"snapshot-{self.product_id}", daemon=True).start()
+        else:
+            self._fetch()
+
+    def _fetch(self):
+        """fetch the snapshot"""
+        try:
+            self.snapshot = self.provider.fetch(self.product_id)
+            logging.info(f"Fetched {self.product_id} snapshot at sequence {self.snapshot['sequence']}")
+        except Exception as e:
+            self.error = e
+        self._done.set()
+
+    def add(self, message: dict):
+        """
+        buffer a live message
+
+        :param message: message dict
+
+        """
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(message)
+
+    def done(self):
+        """:return: True if the snapshot fetch finished, successfully or not"""
+        return self._done.is_set()
+
+    def schedule_retry(self):
+        """
+        schedule the retry of a failed fetch
+
+        :return: delay in seconds, RETRY_BACKOFF doubled after every failure, capped by MAX_RETRY_BACKOFF
+
+        """
+        delay = min(self.MAX_RETRY_BACKOFF, self.RETRY_BACKOFF * 2 ** self.failures)
+        self.failures += 1
+        self.retry_at = time.monotonic() + delay
+        return delay
+
+    def pending(self):
+        """
+        buffered messages after the snapshot sequence
+
+        :return: list of message dicts to replay
+
+        """
+        sequence = self.snapshot["sequence"]
+        return [message for message in self.buffer if message["sequence"] > sequence]
@@ -0,0 +1,224 @@
+import sys
+import time
+import uuid
+import struct
+import logging
+from itertools import islice
+from multiprocessing import shared_memory, resource_tracker
+
+# segment header: magic, depth, number of products, slot size
+MAGIC = b"CBSHM\x01\x00\x00"
+HEADER = struct.Struct("<8sIII")
+# product slot header: seqlock version, product id, exchange sequence (-1 if unknown), publish time in ns
+# since epoch, number of bid and ask levels, followed by depth (price, size) doubles for bids then asks
+SLOT_HEADER = struct.Struct("<Q16sqqII")
+# maximum length of an utf-8 encoded product id in the slot header
+MAX_PRODUCT_ID = 16
+_VERSION = struct.Struct("<Q")
+_PUBLISH = struct.Struct("<qqII")
+# names of the segments created by this process, already tracked by its resource tracker
+_owned = set()
+
+
+def _levels_struct(depth):
+    """:return: struct of depth (price, size) doubles for bids, then for asks"""
+    return struct.Struct(f"<{4 * depth}d")
+
+
+def _attach(name):
+    """
+    attach to an existing shared memory segment without tracking it
+
+    before python 3.13 attaching registers the segment with this process's resource tracker,
+    which removes it when the process exits, although the publisher owns it, so it is unregistered
+    right after, unless this process created it and its tracker must keep it
+
+    :param name: shared memory segment name
+    :return: SharedMemory
+
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    shm = shared_memory.SharedMemory(name)
+    if name not in _owned:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class SharedBookPublisher:
+    """
+    Publish the top aggregated price levels of every product into a shared memory segment
+
+    Every product has a fixed slot guarded by a seqlock: the ingest thread makes the slot's
+    version odd, writes the levels and makes the version even again, so readers in other
+    processes never block the writer and retry when they raced with a write. Prices and sizes
+    are stored as doubles, converted only when the top levels changed; otherwise only the
+    sequence and the publish time are written. Drop-in replacement of BookPublisher for the
+    websocket clients.
+
+    """
+
+    def __init__(self, product_ids, depth=10, name=None):
+        """
+        initialize shared book publisher, and create its shared memory segment
+
+        :param product_ids: list of product ids, the books of other products are not published,
+                            at most MAX_PRODUCT_ID bytes each
+        :param depth: number of price levels per side, default 10
+        :param name: shared memory segment name, default a random name, see .name
+
+        """
+        for product_id in product_ids:
+            if len(product_id.encode()) > MAX_PRODUCT_ID:
+                raise ValueError(f"Product id {product_id} is longer than {MAX_PRODUCT_ID} bytes")
+        self.product_ids = list(product_ids)
+        self.depth = depth
+        self.published = 0
+        self._levels = _levels_struct(depth)
+        self.slot_size = SLOT_HEADER.size + self._levels.size
+        size = HEADER.size + self.slot_size * len(self.product_ids)
+        self._shm = shared_memory.SharedMemory(name or f"cbbook-{uuid.uuid4().hex[:12]}", create=True, size=size)
+        self.name = self._shm.name
+        _owned.add(self.name)
+
+        buffer = self._shm.buf
+        HEADER.pack_into(buffer, 0, MAGIC, depth, len(self.product_ids), self.slot_size)
+        # offset, last version and last written top levels as stored in the order book of each product's slot
+        self._slots = {}
+        self._versions = {}
+        self._tops = {}
+        for i, product_id in enumerate(self.product_ids):
+            offset = HEADER.size + i * self.slot_size
+            SLOT_HEADER.pack_into(buffer, offset, 0, product_id.encode(), -1, 0, 0, 0)
+            self._slots[product_id] = offset
+            self._versions[product_id] = 0
+            self._tops[product_id] = None
+        self._zeros = (0.0,) * (4 * depth)
+
+    def start(self):
+        """nothing to start, the levels are written on the ingest thread"""
+
+    def stop(self):
+        """release and remove the shared memory segment"""
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+            _owned.discard(self.name)
+
+    def notify(self, order_book, product_id=None, sequence=None):
+        """
+        called on the ingest thread after the order book changed, write its top levels
+
+        :param order_book: order book
+        :param product_id: product id of the order book
+        :param sequence: last applied sequence of the order book, optional
+
+        """
+        offset = self._slots.get(product_id)
+        if offset is None or self._shm is None:
+            return
+        bids = list(islice(order_book.iter_levels("bid"), self.depth))
+        asks = list(islice(order_book.iter_levels("ask"), self.depth))
+        values = None
+        if (bids, asks) != self._tops[product_id]:
+            self._tops[product_id] = (bids, asks)
+            values = list(self._zeros)
+            level_out = order_book.level_out
+            for base, levels in ((0, bids), (2 * self.depth, asks)):
+                for i, (price, size) in enumerate(levels):
+                    price, size = level_out(price, size)
+                    values[base + 2 * i] = float(price)
+                    values[base + 2 * i + 1] = float(size)
+
+        buffer = self._shm.buf
+        version = self._versions[product_id] + 1
+        _VERSION.pack_into(buffer, offset, version)
+        _PUBLISH.pack_into(buffer, offset + _VERSION.size + MAX_PRODUCT_ID, -1 if sequence is None else sequence,
+                           time.time_ns(), len(bids), len(asks))
+        if values is not None:
+            self._levels.pack_into(buffer, offset + SLOT_HEADER.size, *values)
+        _VERSION.pack_into(buffer, offset, version + 1)
+        self._versions[product_id] = version + 1
+        self.published += 1
+
+
+class SharedBookReader:
+    """
+    Read the order books published by a SharedBookPublisher, from any process
+
+    Reads unpack the levels from the shared memory segment into new lists of floats, with no
+    round trip to the publishing process.
+
+    """
+
+    def __init__(self, name, max_retries=1000):
+        """
+        attach to a shared book segment
+
+        :param name: shared memory segment name, SharedBookPublisher.name
+        :param max_retries: reads retried when racing with the writer before giving up, default 1000
+
+        """
+        self._shm = _attach(name)
+        self.max_retries = max_retries
+        self.retries = 0
+
+        magic, self.depth, count, self.slot_size = HEADER.unpack_from(self._shm.buf, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{name} is not a shared book segment")
+        self._levels = _levels_struct(self.depth)
+        self._slots = {}
+        for i in range(count):
+            offset = HEADER.size + i * self.slot_size
+            product_id = SLOT_HEADER.unpack_from(self._shm.buf, offset)[1].rstrip(b"\x00").decode()
+            self._slots[product_id] = offset
+        self.product_ids = list(self._slots)
+
+    def version(self, product_id):
+        """
+        :param product_id: product id
+        :return: seqlock version of the product's slot, changes whenever the book is published
+
+        """
+        return _VERSION.unpack_from(self._shm.buf, self._slots[product_id])[0]
+
+    def read(self, product_id):
+        """
+        consistent snapshot of a product's published levels
+
+        :param product_id: product id
+        :return: dict with "product_id", "version", "sequence" (None if unknown), "timestamp_ns", and the
+                 "bid" and "ask" lists of (price, size) floats, best price first; None if the product was
+                 never published or no consistent snapshot was read within max_retries
+
+        """
+        buffer = self._shm.buf
+        offset = self._slots[product_id]
+        for _ in range(self.max_retries):
+            (before,) = _VERSION.unpack_from(buffer, offset)
+            if before == 0:
+                return None
+            if before & 1:
+                self.retries += 1
+                continue
+            _, _, sequence, timestamp_ns, bid_count, ask_count = SLOT_HEADER.unpack_from(buffer, offset)
+            values = self._levels.unpack_from(buffer, offset + SLOT_HEADER.size)
+            (after,) = _VERSION.unpack_from(buffer, offset)
+            if before != after:
+                self.retries += 1
+                continue
+            base = 2 * self.depth
+            return {"product_id": product_id, "version": before,
+                    "sequence": None if sequence < 0 else sequence, "timestamp_ns": timestamp_ns,
+                    "bid": [(values[2 * i], values[2 * i + 1]) for i in range(bid_count)],
+                    "ask": [(values[base + 2 * i], values[base + 2 * i + 1]) for i in range(ask_count)]}
+        logging.warning(f"Shared book read of {product_id} gave up after {self.max_retries} retries")
+        return None
+
+    def close(self):
+        """detach from the segment"""
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
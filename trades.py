@@ -0,0 +1,287 @@
+from collections import deque, namedtuple
+from decimal import Decimal
+
+from metrics import parse_time_ns
+
+# a trade of a match message, side is the taker side, "buy" when the maker order was a sell
+Trade = namedtuple("Trade", ("trade_id", "time_ns", "price", "size", "side"))
+
+SECOND_NS = 1000000000
+
+
+class TradeTape:
+    """Ring buffer of the latest trades"""
+
+    def __init__(self, capacity=10000):
+        """
+        initialize trade tape
+
+        :param capacity: number of trades kept, default 10000
+
+        """
+        self.capacity = capacity
+        self.count = 0
+        self._trades = [None] * capacity
+
+    def append(self, trade):
+        """
+        append a trade, overwriting the oldest one when the tape is full
+
+        :param trade: Trade
+
+        """
+        self._trades[self.count % self.capacity] = trade
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def last(self, n=None):
+        """
+        latest trades
+
+        :param n: number of trades, default every trade on the tape
+        :return: list of Trade, oldest first
+
+        """
+        n = len(self) if n is None else min(n, len(self))
+        return [self._trades[i % self.capacity] for i in range(self.count - n, self.count)]
+
+
+class RollingWindow:
+    """
+    Traded volume and VWAP over the last seconds
+
+    Trades are summed into fixed time buckets, so the window is updated in O(1) per trade and
+    holds seconds / resolution buckets whatever the trade rate.
+
+    """
+
+    def __init__(self, seconds=60, resolution=1):
+        """
+        initialize rolling window
+
+        :param seconds: window length in seconds, default 60
+        :param resolution: bucket length in seconds, default 1
+
+        """
+        self.seconds = seconds
+        self.resolution_ns = int(resolution * SECOND_NS)
+        size = max(1, int(seconds / resolution))
+        # bucket number, volume, notional and count of each bucket, indexed by bucket number % size
+        self._buckets = [[None, 0, 0, 0] for _ in range(size)]
+        self._last = None
+        self.volume = 0
+        self.notional = 0
+        self.count = 0
+
+    def _advance(self, bucket):
+        """
+        drop the buckets leaving the window when time reaches a bucket
+
+        :param bucket: bucket number
+
+        """
+        if self._last is not None and bucket <= self._last:
+            return
+        size = len(self._buckets)
+        start = bucket - size + 1 if self._last is None else max(self._last + 1, bucket - size + 1)
+        for number in range(start, bucket + 1):
+            slot = self._buckets[number % size]
+            if slot[0] is not None:
+                self.volume -= slot[1]
+                self.notional -= slot[2]
+                self.count -= slot[3]
+            slot[:] = [number, 0, 0, 0]
+        self._last = bucket
+
+    def add(self, trade):
+        """
+        add a trade, trades older than the window are ignored
+
+        :param trade: Trade
+
+        """
+        bucket = trade.time_ns // self.resolution_ns
+        self._advance(bucket)
+        if bucket <= self._last - len(self._buckets):
+            return
+        slot = self._buckets[bucket % len(self._buckets)]
+        notional = trade.price * trade.size
+        slot[1] += trade.size
+        slot[2] += notional
+        slot[3] += 1
+        self.volume += trade.size
+        self.notional += notional
+        self.count += 1
+
+    def update(self, now_ns):
+        """
+        move the window to a time without trading
+
+        :param now_ns: time in ns since epoch
+
+        """
+        self._advance(now_ns // self.resolution_ns)
+
+    def vwap(self):
+        """:return: volume weighted average price of the window, None without trades"""
+        return self.notional / self.volume if self.volume else None
+
+
+class CandleAggregator:
+    """
+    OHLCV candles of several intervals
+
+    Each trade updates the open candle of every interval. A candle is closed into the bounded
+    history when the first trade of a later interval arrives, intervals without trades have no
+    candle.
+
+    """
+
+    def __init__(self, intervals=(60, 300, 3600), history=1000):
+        """
+        initialize candle aggregator
+
+        :param intervals: candle lengths in seconds, default 1 minute, 5 minutes and 1 hour
+        :param history: number of closed candles kept per interval, default 1000
+
+        """
+        self.intervals = tuple(intervals)
+        # open candle of each interval, see current
+        self._current = {interval: None for interval in self.intervals}
+        self._history = {interval: deque(maxlen=history) for interval in self.intervals}
+
+    def add(self, trade):
+        """
+        add a trade
+
+        :param trade: Trade
+
+        """
+        for interval in self.intervals:
+            length = interval * SECOND_NS
+            start = trade.time_ns - trade.time_ns % length
+            candle = self._current[interval]
+            if candle is None or start > candle["start"]:
+                if candle is not None:
+                    self._history[interval].append(candle)
+                self._current[interval] = {"start": start, "open": trade.price, "high": trade.price,
+                                           "low": trade.price, "close": trade.price, "volume": trade.size,
+                                           "notional": trade.price * trade.size, "count": 1}
+            elif start == candle["start"]:
+                if trade.price > candle["high"]:
+                    candle["high"] = trade.price
+                elif trade.price < candle["low"]:
+                    candle["low"] = trade.price
+                candle["close"] = trade.price
+                candle["volume"] += trade.size
+                candle["notional"] += trade.price * trade.size
+                candle["count"] += 1
+
+    def current(self, interval):
+        """
+        :param interval: candle length in seconds
+        :return: open candle dict with "start" in ns since epoch, "open", "high", "low", "close",
+                 "volume", "notional" and "count", None before the first trade
+
+        """
+        return self._current[interval]
+
+    def candles(self, interval):
+        """
+        :param interval: candle length in seconds
+        :return: list of closed candle dicts, oldest first
+
+        """
+        return list(self._history[interval])
+
+
+class ProductTrades:
+    """trade tape, rolling windows and candles of one product"""
+
+    def __init__(self, capacity=10000, windows=(60,), intervals=(60, 300, 3600), history=1000):
+        """
+        initialize product trades
+
+        :param capacity: number of trades on the tape, default 10000
+        :param windows: rolling window lengths in seconds, default 60
+        :param intervals: candle lengths in seconds, default 1 minute, 5 minutes and 1 hour
+        :param history: number of closed candles kept per interval, default 1000
+
+        """
+        self.tape = TradeTape(capacity)
+        self.windows = {seconds: RollingWindow(seconds) for seconds in windows}
+        self.candles = CandleAggregator(intervals, history)
+
+    def add(self, trade):
+        """
+        add a trade to the tape, the windows and the candles
+
+        :param trade: Trade
+
+        """
+        self.tape.append(trade)
+        for window in self.windows.values():
+            window.add(trade)
+        self.candles.add(trade)
+
+
+class TradeRecorder:
+    """
+    Record the trades of the match messages the websocket client already receives
+
+    Every product gets a trade tape, rolling volume and VWAP windows and multi-interval candles,
+    all updated in O(1) per trade with bounded memory. A match message is recorded once, the
+    ones with a sequence not after the last recorded one of their product are skipped.
+
+    """
+
+    def __init__(self, capacity=10000, windows=(60,), intervals=(60, 300, 3600), history=1000):
+        """
+        initialize trade recorder, see ProductTrades for the parameters
+
+        """
+        self.capacity = capacity
+        self.windows = tuple(windows)
+        self.intervals = tuple(intervals)
+        self.history = history
+        self.products = {}
+        # last recorded sequence, key is product id
+        self._sequences = {}
+
+    def product(self, product_id):
+        """
+        trades of a product, created on first use
+
+        :param product_id: product id
+        :return: ProductTrades
+
+        """
+        if product_id not in self.products:
+            self.products[product_id] = ProductTrades(self.capacity, self.windows, self.intervals, self.history)
+        return self.products[product_id]
+
+    def add(self, message: dict, product=None):
+        """
+        record the trade of a match message
+
+        :param message: match message dict
+        :param product: optional ProductBook, the price and size are then parsed on its order book's grid,
+                        e.g. with its fixed point scales, default Decimal of the message strings
+
+        """
+        product_id = message["product_id"]
+        sequence = message.get("sequence")
+        if sequence is not None:
+            if sequence <= self._sequences.get(product_id, -1):
+                return
+            self._sequences[product_id] = sequence
+        if product is None:
+            price, size = Decimal(message["price"]), Decimal(message["size"])
+        else:
+            price, size = product.order_book.level_out(product.parse_price(message["price"]),
+                                                       product.parse_size(message["size"]))
+        trade = Trade(message["trade_id"], parse_time_ns(message["time"]), price, size,
+                      "sell" if message["side"] == "buy" else "buy")
+        self.product(product_id).add(trade)